@@ -0,0 +1,111 @@
+import time
+import argparse
+import tracemalloc
+
+import tiktoken
+
+from ingestion import scrape_wikipedia_html, create_chunks_with_headers, iter_chunks_with_headers, iter_wikipedia_elements, iter_html_file_blocks
+from token_counter import TokenCounter
+
+
+
+
+# Benchmark of the chunking stage of the ingestion on the bundled wikipedia html.
+# Compares the current path (BeautifulSoup tree + list of chunks) with the streaming path (incremental parser + generator of chunks),
+# reporting the total time, the time until the first chunk is available and the peak memory (measured with tracemalloc in a separate run).
+# With --token-counting, it compares instead the exact, cached (cold and warm) and estimated token counting on the tree path.
+# Usage: python benchmark_chunking.py --html-path ../data/raw/es.wikipedia.org_wiki_Lionel_Messi.html [--token-counting]
+
+
+
+# Current path: the whole file is read, the whole tree is built and all the chunks are collected before returning
+def chunk_with_tree(html_path, encoding):
+    with open(html_path, "r", encoding="utf-8") as file:
+        html_content = file.read()
+    chunks = create_chunks_with_headers(scrape_wikipedia_html(html_content), source_url=html_path, encoding=encoding, max_chunk_size=500)
+    yield from chunks
+
+
+# Streaming path: the file is parsed by blocks and each chunk is yielded as soon as it is closed
+def chunk_streaming(html_path, encoding):
+    elements = iter_wikipedia_elements(iter_html_file_blocks(html_path))
+    yield from iter_chunks_with_headers(elements, source_url=html_path, encoding=encoding, max_chunk_size=500)
+
+
+# Function for measuring the time of a chunking path, and the time until its first chunk
+def measure_time(chunking_function, html_path, encoding):
+    start_time = time.perf_counter()
+    first_chunk_time = None
+    chunks_count = 0
+    for _ in chunking_function(html_path, encoding):
+        if first_chunk_time is None:
+            first_chunk_time = time.perf_counter() - start_time
+        chunks_count += 1
+    return chunks_count, time.perf_counter() - start_time, first_chunk_time
+
+
+# Function for measuring the peak memory of a chunking path. The chunks are discarded as they are consumed, as the pipeline does.
+def measure_peak_memory(chunking_function, html_path, encoding):
+    tracemalloc.start()
+    for _ in chunking_function(html_path, encoding):
+        pass
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak_memory
+
+
+
+# Function for measuring the chunking time of the tree path with a token counting mode.
+# The html is parsed once outside of the measure, so only the chunking and token counting are timed.
+def measure_token_counting(elements, encoding, mode, warm=False):
+    token_counter = TokenCounter(encoding, mode=mode)
+    if warm:
+        create_chunks_with_headers(elements, source_url="benchmark", encoding=token_counter, max_chunk_size=500)
+
+    start_time = time.perf_counter()
+    chunks = create_chunks_with_headers(elements, source_url="benchmark", encoding=token_counter, max_chunk_size=500,
+                                        prefetch_token_counts=(mode != "estimate"))
+    elapsed_time = time.perf_counter() - start_time
+
+    return chunks, elapsed_time, token_counter.stats()
+
+
+# Function for comparing the token counting modes
+def run_token_counting_benchmark(html_path, encoding, repeat):
+    with open(html_path, "r", encoding="utf-8") as file:
+        elements = scrape_wikipedia_html(file.read())
+
+    exact_chunks = create_chunks_with_headers(elements, source_url="benchmark", encoding=encoding, max_chunk_size=500)
+    exact_boundaries = [chunk["content"] for chunk in exact_chunks]
+
+    print(f"{'mode':>14} {'chunks':>8} {'seconds':>10} {'same chunks':>12} {'encoder calls':>14}")
+    for mode_name, mode, warm in [("exact", "exact", False), ("cached (cold)", "cached", False), ("cached (warm)", "cached", True),
+                                  ("estimate", "estimate", False)]:
+        timings = [measure_token_counting(elements, encoding, mode, warm=warm) for _ in range(repeat)]
+        chunks, elapsed_time, stats = min(timings, key=lambda timing: timing[1])
+        same_chunks = sum(1 for chunk in chunks if chunk["content"] in exact_boundaries)
+        encoder_calls = "all" if mode == "exact" else stats["misses"]
+        print(f"{mode_name:>14} {len(chunks):>8} {elapsed_time:>10.3f} {same_chunks:>12} {encoder_calls:>14}")
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Chunking time/memory benchmark")
+    parser.add_argument("--html-path", default="../data/raw/es.wikipedia.org_wiki_Lionel_Messi.html")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--token-counting", action="store_true", help="Compare the exact, cached and estimated token counting")
+    args = parser.parse_args()
+
+    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+
+    if args.token_counting:
+        run_token_counting_benchmark(args.html_path, encoding, args.repeat)
+        raise SystemExit(0)
+
+    print(f"{'path':>10} {'chunks':>8} {'seconds':>10} {'first chunk (s)':>16} {'peak MB':>10}")
+    for path_name, chunking_function in [("tree", chunk_with_tree), ("streaming", chunk_streaming)]:
+        timings = [measure_time(chunking_function, args.html_path, encoding) for _ in range(args.repeat)]
+        chunks_count, elapsed_time, first_chunk_time = min(timings, key=lambda timing: timing[1])
+        peak_memory = measure_peak_memory(chunking_function, args.html_path, encoding)
+        print(f"{path_name:>10} {chunks_count:>8} {elapsed_time:>10.3f} {first_chunk_time:>16.3f} {peak_memory / 1024 / 1024:>10.1f}")
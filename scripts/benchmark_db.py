@@ -0,0 +1,103 @@
+import os
+import re
+import time
+import uuid
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+os.environ['RUN_TIMEZONE_CHECK'] = '0'
+
+from db import ANSWER_COLUMNS, INSERT_ANSWER_SQL, ConnectionPool, get_answer_values, get_connection_params, get_db_connection, tz
+
+
+
+
+# Benchmark of the answers inserts against a local Postgres, comparing a new connection per insert with the pooled connections
+# and prepared statements of db.py. The rows are written to a copy of the answers table, which is dropped at the end.
+# Usage: python benchmark_db.py --inserts 500 --threads 1 4 8
+
+
+
+BENCHMARK_TABLE = "answers_benchmark"
+
+# Same insert of db.py, on the benchmark table
+INSERT_BENCHMARK_SQL = INSERT_ANSWER_SQL.replace("INTO answers", f"INTO {BENCHMARK_TABLE}")
+
+# The connect-per-call path sends the statement without preparing it
+UNPREPARED_INSERT_BENCHMARK_SQL = re.sub(r"\$\d+", "%s", INSERT_BENCHMARK_SQL)
+
+
+
+# Function for building the values of a fake answer row
+def build_answer_row():
+    answer_data = {column: 0 for column in ANSWER_COLUMNS}
+    answer_data.update({"question": "benchmark question", "answer": "benchmark answer", "model_used": "benchmark",
+                        "relevance": "UNKNOWN", "relevance_explanation": "UNKNOWN"})
+    return (str(uuid.uuid4()), *get_answer_values(answer_data), datetime.now(tz))
+
+
+# Insert opening a new connection, as db.py did before the pool
+def insert_unpooled(pool):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(UNPREPARED_INSERT_BENCHMARK_SQL, build_answer_row())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Insert with a pooled connection and a prepared statement
+def insert_pooled(pool):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            pool.execute_prepared(cur, "insert_answer_benchmark", INSERT_BENCHMARK_SQL, build_answer_row())
+        conn.commit()
+
+
+# Function for measuring the inserts/sec of an insert function with a number of threads
+def run_benchmark(insert_function, pool, inserts, threads):
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(insert_function, pool) for _ in range(inserts)]:
+            future.result()
+    elapsed_time = time.perf_counter() - start_time
+
+    return inserts / elapsed_time, elapsed_time
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Postgres inserts benchmark, pooled vs. unpooled")
+    parser.add_argument("--inserts", type=int, default=500)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE}")
+            cur.execute(f"CREATE TABLE {BENCHMARK_TABLE} (LIKE answers INCLUDING DEFAULTS)")
+        conn.commit()
+
+        pool = ConnectionPool(min_size=1, max_size=max(args.threads), **get_connection_params())
+
+        # Warming up the pool, so its connections and prepared statements are ready before measuring
+        run_benchmark(insert_pooled, pool, max(args.threads), max(args.threads))
+
+        print(f"{'mode':>10} {'threads':>8} {'seconds':>10} {'inserts/sec':>12}")
+        for threads in args.threads:
+            for mode, insert_function in [("unpooled", insert_unpooled), ("pooled", insert_pooled)]:
+                inserts_per_second, elapsed_time = run_benchmark(insert_function, pool, args.inserts, threads)
+                print(f"{mode:>10} {threads:>8} {elapsed_time:>10.2f} {inserts_per_second:>12.1f}")
+
+        pool.close()
+
+    finally:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE}")
+        conn.commit()
+        conn.close()
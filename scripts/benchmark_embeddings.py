@@ -0,0 +1,62 @@
+import time
+import argparse
+
+from sentence_transformers import SentenceTransformer
+
+import tiktoken
+
+from ingestion import scrape_wikipedia_html, create_chunks_with_headers
+from embeddings import EMBEDDINGS_MODEL_NAME, iter_embedded_chunks
+
+
+
+
+# Benchmark of the embeddings stage of the ingestion.
+# Chunks the bundled wikipedia html and reports the chunks/sec for each batch size and number of workers.
+# The cache is not used, so every run measures the real encoding cost.
+# Usage: python benchmark_embeddings.py --batch-sizes 1 8 32 64 --workers 1 2 4
+
+
+
+# Function for measuring the throughput of a single configuration
+def run_benchmark(chunks, embeddings_model, batch_size, num_workers):
+
+    # Copying the chunks so the embeddings of a previous run are not reused
+    chunks_copy = [dict(chunk) for chunk in chunks]
+
+    start_time = time.perf_counter()
+    for _ in iter_embedded_chunks(chunks_copy, embeddings_model, batch_size=batch_size, num_workers=num_workers, cache=None):
+        pass
+    elapsed_time = time.perf_counter() - start_time
+
+    return len(chunks_copy) / elapsed_time, elapsed_time
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Embeddings throughput benchmark")
+    parser.add_argument("--html-path", default="../data/raw/es.wikipedia.org_wiki_Lionel_Messi.html")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+
+    with open(args.html_path, "r", encoding="utf-8") as file:
+        html_content = file.read()
+
+    chunks = create_chunks_with_headers(scrape_wikipedia_html(html_content), source_url=args.html_path, encoding=encoding, max_chunk_size=500)
+    print(f"Chunks to embed: {len(chunks)}")
+
+    embeddings_model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+
+    # Warming up the model, so the first configuration does not pay the initialization cost
+    embeddings_model.encode(["warm up"])
+
+    print(f"{'batch_size':>10} {'workers':>8} {'seconds':>10} {'chunks/sec':>12}")
+    for num_workers in args.workers:
+        for batch_size in args.batch_sizes:
+            chunks_per_second, elapsed_time = run_benchmark(chunks, embeddings_model, batch_size, num_workers)
+            print(f"{batch_size:>10} {num_workers:>8} {elapsed_time:>10.2f} {chunks_per_second:>12.1f}")
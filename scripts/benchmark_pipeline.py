@@ -0,0 +1,102 @@
+import os
+import glob
+import time
+import argparse
+
+import numpy as np
+
+import pandas as pd
+
+from dotenv import load_dotenv
+
+from langchain.memory import ConversationBufferMemory
+
+import llm_backends
+from llm_backends import get_llm_backend
+
+# The OpenAI client of rag.py is created at import, and it is not used with the local backends
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+
+from rag import generate_answer, embeddings_model
+from bm25 import bm25_hybrid_search_rrf
+from context_assembler import ContextAssembler
+from evaluation import load_ground_truth
+
+
+
+
+# Benchmark of the whole RAG pipeline (retrieval, prompt assembly and generation) on the questions of the ground truth csv files.
+# With the embedded retrieval (local BM25 and vector indexes) and the fake LLM backend it runs offline, without elasticsearch
+# or API keys, so the latency of the pipeline itself can be compared between changes. The local indexes must be built first
+# (ingestion.py --local-vector-index --local-bm25-index).
+# It reports the p50/p99 of the total and LLM latency, and the tokens and cost of the answers, by backend.
+# Usage: python benchmark_pipeline.py --index messixpert_cosine --backend fake --limit 100
+#        python benchmark_pipeline.py --backend fake ollama --fake-latency-ms 500
+
+
+
+# Function for running the questions through the pipeline with an LLM backend. Returns a row per question.
+def run_pipeline(questions, index_name, llm_backend, context_assembler):
+
+    rows = []
+    for question in questions:
+        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+
+        start_time = time.perf_counter()
+        _, costs, tokens = generate_answer(question, None, index_name, memory, embeddings_model=embeddings_model,
+                                           search_function=bm25_hybrid_search_rrf, context_assembler=context_assembler, llm_backend=llm_backend)
+        total_time = time.perf_counter() - start_time
+
+        rows.append({"total_time": total_time, "cost": costs["total_cost"], "input_tokens": tokens["input_tokens"],
+                     "output_tokens": tokens["output_tokens"], **llm_backend.last_call_metrics()})
+
+    return rows
+
+
+# Function for building a row of the report
+def build_report_row(backend_name, rows):
+    total_times = [row["total_time"] for row in rows]
+    llm_latencies = [row["llm_latency"] for row in rows]
+    return {"backend": backend_name, "model": rows[0]["model_used"], "questions": len(rows),
+            "p50_ms": np.percentile(total_times, 50) * 1000, "p99_ms": np.percentile(total_times, 99) * 1000,
+            "llm_p50_ms": np.percentile(llm_latencies, 50) * 1000, "llm_p99_ms": np.percentile(llm_latencies, 99) * 1000,
+            "pipeline_p50_ms": np.percentile(np.subtract(total_times, llm_latencies), 50) * 1000,
+            "mean_input_tokens": np.mean([row["input_tokens"] for row in rows]),
+            "mean_output_tokens": np.mean([row["output_tokens"] for row in rows]),
+            "total_cost": sum(row["cost"] for row in rows)}
+
+
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Offline benchmark of the whole RAG pipeline")
+    parser.add_argument("--ground-truth", nargs="+", default=sorted(glob.glob("../tests/*GroundTruth.csv")))
+    parser.add_argument("--index", default="messixpert_cosine", help="Name of the local BM25 and vector indexes")
+    parser.add_argument("--backend", nargs="+", default=["fake"], help="LLM backends (fake, ollama, openai, provider:model or router)")
+    parser.add_argument("--limit", type=int, default=100, help="Number of questions of each ground truth")
+    parser.add_argument("--fake-latency-ms", type=float, default=None, help="Latency before the first token of the fake LLM")
+    parser.add_argument("--output", default=None, help="Csv file where the report is saved")
+    args = parser.parse_args()
+
+    # Starting the server of the fake backend with the latency of the benchmark
+    if args.fake_latency_ms is not None:
+        llm_backends.fake_llm_server = llm_backends.start_fake_llm_server(latency_ms=args.fake_latency_ms)
+
+    context_assembler = ContextAssembler()
+
+    questions = [record["question"] for ground_truth in load_ground_truth(args.ground_truth).values() for record in ground_truth[:args.limit]]
+
+    report = []
+    for backend_name in args.backend:
+        llm_backend = get_llm_backend(backend_name)
+        report.append(build_report_row(backend_name, run_pipeline(questions, args.index, llm_backend, context_assembler)))
+        print(llm_backend.metrics())
+
+    report_df = pd.DataFrame(report)
+    print(report_df.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+
+    if args.output:
+        report_df.to_csv(args.output, sep=";", index=False)
@@ -0,0 +1,143 @@
+import os
+import glob
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+
+import pandas as pd
+
+from dotenv import load_dotenv
+
+from elasticsearch import Elasticsearch
+
+from embeddings import encode_texts, get_embedding_service
+from evaluation import load_ground_truth, compute_metrics, get_retrieved_chunk_ids
+from vector_index import LocalVectorIndex, build_vector_index, iter_indexed_chunks
+from rag import knn_search, knn_rescore_search
+
+
+
+
+# Benchmark of the memory vs. recall trade-off of the quantized embeddings, on the ground truth csv files.
+# The local vector index is built with each quantization from the chunks of the elasticsearch index, and the elasticsearch
+# indexes passed with --es-index (e.g. one created with ES_VECTOR_INDEX_TYPE=int8_hnsw) are searched with and without rescoring.
+# The memory is the size of the vectors scanned by the local search, and the estimate of the elasticsearch docs for the
+# vectors kept in memory by the HNSW graph (the float vectors of a quantized index stay on disk).
+# Usage: python benchmark_quantization.py --index messixpert_cosine --es-index messixpert_cosine messixpert_int8 --size 10
+
+
+
+# Quantizations of the local vector index: (dtype, rescore with the float32 embeddings)
+LOCAL_QUANTIZATIONS = [("float32", False), ("int8", False), ("int8", True), ("binary", False), ("binary", True)]
+
+# Bytes per vector of each elasticsearch index type, besides the HNSW graph (4 * m bytes per vector, m=16)
+ES_BYTES_PER_VECTOR = {
+    "hnsw": lambda dims: 4 * dims,
+    "int8_hnsw": lambda dims: dims + 4,
+    "int4_hnsw": lambda dims: dims / 2 + 4,
+}
+
+
+
+# Function for getting the index type of the content_embeddings field of an elasticsearch index
+def get_es_vector_index_type(es_client, index_name):
+    mapping = es_client.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    index_options = mapping["properties"]["content_embeddings"].get("index_options", {})
+    # int8_hnsw is the default of the float vectors since elasticsearch 8.14
+    return index_options.get("type", "int8_hnsw")
+
+
+# Function for estimating the memory of the vectors of an elasticsearch index
+def estimate_es_vector_memory(count, dims, index_type):
+    return count * (ES_BYTES_PER_VECTOR.get(index_type, ES_BYTES_PER_VECTOR["hnsw"])(dims) + 4 * 16)
+
+
+# Function for running the questions of a ground truth with a search function of the query vectors.
+# Returns the relevance matrix and the latencies of the searches.
+def run_searches(ground_truth, query_vectors, search):
+
+    relevance_total = []
+    latencies = []
+    for record, query_vector in zip(ground_truth, query_vectors):
+        start_time = time.perf_counter()
+        hits = search(record["question"], query_vector)
+        latencies.append(time.perf_counter() - start_time)
+        relevance_total.append([chunk_id == record["chunk_id"] for chunk_id in get_retrieved_chunk_ids(hits)])
+
+    return relevance_total, latencies
+
+
+# Function for building a row of the report
+def build_report_row(ground_truth_name, backend, quantization, memory_bytes, relevance_total, latencies, cutoffs):
+    return {"ground_truth": ground_truth_name, "backend": backend, "quantization": quantization, "memory_mb": memory_bytes / 2 ** 20,
+            **compute_metrics(relevance_total, cutoffs), "p50_ms": np.percentile(latencies, 50) * 1000, "p99_ms": np.percentile(latencies, 99) * 1000}
+
+
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Memory vs. recall benchmark of the quantized embeddings")
+    parser.add_argument("--ground-truth", nargs="+", default=sorted(glob.glob("../tests/*GroundTruth.csv")))
+    parser.add_argument("--index", default="messixpert_cosine", help="Elasticsearch index with the chunks for the local vector index")
+    parser.add_argument("--es-index", nargs="*", default=[], help="Elasticsearch indexes to compare")
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument("--cutoffs", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--output", default=None, help="Csv file where the report is saved")
+    args = parser.parse_args()
+
+    es_client = Elasticsearch("http://localhost:9200")
+    embeddings_model = get_embedding_service()
+
+    chunks = list(iter_indexed_chunks(es_client, args.index))
+    dims = len(chunks[0]["content_embeddings"])
+
+    # Building the local vector index with every quantization
+    tmp_dir = tempfile.mkdtemp(prefix="vector_index_")
+    local_indexes = {}
+    for dtype, rescore in LOCAL_QUANTIZATIONS:
+        quantization = f"{dtype}+rescore" if rescore else dtype
+        index_dir = os.path.join(tmp_dir, quantization)
+        build_vector_index(chunks, index_dir, dtype=dtype, rescore=rescore)
+        local_indexes[quantization] = LocalVectorIndex(index_dir, use_hnsw=False, rescore_oversample=args.oversample)
+
+    report = []
+    for ground_truth_name, ground_truth in load_ground_truth(args.ground_truth).items():
+
+        query_vectors = encode_texts([record["question"] for record in ground_truth], embeddings_model)
+
+        for quantization, vector_index in local_indexes.items():
+            relevance_total, latencies = run_searches(ground_truth, query_vectors,
+                                                      lambda question, query_vector: vector_index.search(query_vector, k=args.size))
+            report.append(build_report_row(ground_truth_name, "local", quantization, vector_index.memory_bytes(), relevance_total, latencies,
+                                           args.cutoffs))
+
+        for es_index in args.es_index:
+            index_type = get_es_vector_index_type(es_client, es_index)
+            memory_bytes = estimate_es_vector_memory(es_client.count(index=es_index)["count"], dims, index_type)
+
+            searches = [(index_type, lambda question, query_vector: knn_search(question, es_client, es_index, embeddings_model, size=args.size,
+                                                                               query_vector=query_vector.tolist()))]
+            if index_type != "hnsw":
+                searches.append((f"{index_type}+rescore",
+                                 lambda question, query_vector: knn_rescore_search(question, es_client, es_index, embeddings_model, size=args.size,
+                                                                                   oversample=args.oversample, query_vector=query_vector.tolist())))
+
+            for quantization, search in searches:
+                relevance_total, latencies = run_searches(ground_truth, query_vectors, search)
+                report.append(build_report_row(ground_truth_name, f"es:{es_index}", quantization, memory_bytes, relevance_total, latencies,
+                                               args.cutoffs))
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report_df = pd.DataFrame(report)
+    print(report_df.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+
+    if args.output:
+        report_df.to_csv(args.output, sep=";", index=False)
@@ -0,0 +1,134 @@
+import glob
+import time
+import argparse
+
+import numpy as np
+
+import pandas as pd
+
+import tiktoken
+
+from dotenv import load_dotenv
+
+from elasticsearch import Elasticsearch
+
+from embeddings import get_embedding_service
+from evaluation import SEARCH_FUNCTIONS, load_ground_truth, compute_metrics, get_retrieved_chunk_ids
+from reranker import CrossEncoderReranker, deduplicate_hits, RERANKER_MODEL_NAME
+from token_counter import TokenCounter
+
+
+
+
+# Benchmark of the cross-encoder reranking on the ground truth csv files.
+# For each search, the chunks the RAG sends to the prompt (the search with its default size) are compared with the top-n of the
+# reranked candidates: hit rate, MRR, recall@k and nDCG@k, the context tokens of the prompt (and the tokens saved), and the
+# latency added by the reranking. The candidates of each question are scored once, and every top-n is a slice of the ranking.
+# The first pass over the questions scores every pair, and the latency of the cached pairs is reported with --cached-pass.
+# Usage: python benchmark_reranker.py --index messixpert_cosine --search hybrid rrf --candidates 20 --top-n 3 5
+#        python benchmark_reranker.py --index messixpert_cosine --search local_bm25_rrf --cached-pass
+
+
+
+# Function for getting the context tokens of the chunks sent to the prompt
+def count_context_tokens(hits, token_counter):
+    return sum(token_counter.count(hit["_source"]["content"]) for hit in hits)
+
+
+# Function for getting the relevance of the retrieved chunks of a question
+def get_relevance(hits, record):
+    return [chunk_id == record["chunk_id"] for chunk_id in get_retrieved_chunk_ids(hits)]
+
+
+# Function for running the questions of a ground truth with a search and the reranker.
+# Returns the baseline row and a row per top-n.
+def run_benchmark(ground_truth, search_name, es_client, index_name, embeddings_model, reranker, top_ns, cutoffs, token_counter):
+
+    search_function = SEARCH_FUNCTIONS[search_name]
+    size_kwargs = {} if search_name == "hybrid" else {"size": reranker.candidates}
+
+    baseline_relevance, baseline_tokens, baseline_latencies = [], [], []
+    reranked_relevance = {top_n: [] for top_n in top_ns}
+    reranked_tokens = {top_n: [] for top_n in top_ns}
+    candidates_latencies, rerank_latencies = [], []
+
+    for record in ground_truth:
+        question = record["question"]
+
+        # The chunks sent to the prompt without reranking
+        start_time = time.perf_counter()
+        baseline_hits = search_function(user_query=question, es_client=es_client, index=index_name, embeddings_model=embeddings_model)
+        baseline_latencies.append(time.perf_counter() - start_time)
+        baseline_relevance.append(get_relevance(deduplicate_hits(baseline_hits), record))
+        baseline_tokens.append(count_context_tokens(baseline_hits, token_counter))
+
+        start_time = time.perf_counter()
+        candidate_hits = search_function(user_query=question, es_client=es_client, index=index_name, embeddings_model=embeddings_model,
+                                         **size_kwargs)
+        candidates_latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        ranked_hits = reranker.rerank(question, candidate_hits, top_n=len(candidate_hits))
+        rerank_latencies.append(time.perf_counter() - start_time)
+
+        for top_n in top_ns:
+            reranked_relevance[top_n].append(get_relevance(ranked_hits[:top_n], record))
+            reranked_tokens[top_n].append(count_context_tokens(ranked_hits[:top_n], token_counter))
+
+    rows = [{"search": search_name, "reranked": "no", "chunks": np.mean([len(relevance) for relevance in baseline_relevance]),
+             **compute_metrics(baseline_relevance, cutoffs), "context_tokens": np.mean(baseline_tokens), "tokens_saved": 0.0,
+             "retrieval_p50_ms": np.percentile(baseline_latencies, 50) * 1000, "rerank_p50_ms": 0.0, "rerank_p99_ms": 0.0}]
+
+    for top_n in top_ns:
+        rows.append({"search": search_name, "reranked": f"top{top_n} of {reranker.candidates}", "chunks": top_n,
+                     **compute_metrics(reranked_relevance[top_n], cutoffs), "context_tokens": np.mean(reranked_tokens[top_n]),
+                     "tokens_saved": np.mean(baseline_tokens) - np.mean(reranked_tokens[top_n]),
+                     "retrieval_p50_ms": np.percentile(candidates_latencies, 50) * 1000,
+                     "rerank_p50_ms": np.percentile(rerank_latencies, 50) * 1000, "rerank_p99_ms": np.percentile(rerank_latencies, 99) * 1000})
+
+    return rows
+
+
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Retrieval quality, prompt tokens and latency of the cross-encoder reranking")
+    parser.add_argument("--ground-truth", nargs="+", default=sorted(glob.glob("../tests/*GroundTruth.csv")))
+    parser.add_argument("--index", default="messixpert_cosine")
+    parser.add_argument("--search", nargs="+", default=["hybrid", "rrf"], choices=list(SEARCH_FUNCTIONS))
+    parser.add_argument("--model", default=RERANKER_MODEL_NAME)
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--top-n", type=int, nargs="+", default=[3, 5])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--cutoffs", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--cached-pass", action="store_true", help="Runs the questions again, with the pair scores already cached")
+    parser.add_argument("--output", default=None, help="Csv file where the report is saved")
+    args = parser.parse_args()
+
+    es_client = Elasticsearch("http://localhost:9200")
+    embeddings_model = get_embedding_service()
+    token_counter = TokenCounter(tiktoken.encoding_for_model("gpt-4o-mini"), mode="cached")
+
+    reranker = CrossEncoderReranker(args.model, candidates=args.candidates, batch_size=args.batch_size)
+    reranker.model
+    print(f"Reranker model loaded in {reranker.model_load_time:.2f}s")
+
+    report = []
+    for ground_truth_name, ground_truth in load_ground_truth(args.ground_truth).items():
+        for search_name in args.search:
+            passes = ["cold", "cached"] if args.cached_pass else ["cold"]
+            for cache_pass in passes:
+                rows = run_benchmark(ground_truth, search_name, es_client, args.index, embeddings_model, reranker, args.top_n, args.cutoffs,
+                                     token_counter)
+                report.extend({"ground_truth": ground_truth_name, "pass": cache_pass, **row} for row in rows)
+
+    print(reranker.metrics())
+
+    report_df = pd.DataFrame(report)
+    print(report_df.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+
+    if args.output:
+        report_df.to_csv(args.output, sep=";", index=False)
@@ -0,0 +1,332 @@
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import threading
+import unicodedata
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+import pandas as pd
+
+from dotenv import load_dotenv
+
+from elasticsearch import Elasticsearch
+
+from vector_index import iter_indexed_chunks, local_knn_search
+
+
+
+
+# Default configuration of the local BM25 index, overridable from the environment.
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "../data/bm25_index/")
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+BM25_HEADERS_WEIGHT = float(os.getenv("BM25_HEADERS_WEIGHT", "0.5"))
+
+# Spanish (and a few english) stopwords, removed from the documents and the queries
+STOPWORDS = frozenset("""
+    a al algo algunas algunos ante antes como con contra cual cuales cuando de del desde donde durante e el ella ellas ellos
+    en entre era eran es esa esas ese eso esos esta estaba estas este esto estos fue fueron ha habia han hasta hay la las le
+    les lo los mas me mi mis muy no nos o otra otras otro otros para pero por porque que quien quienes se sea ser si sin sobre
+    son su sus tambien te tiene tienen tu un una uno unos y ya
+    the of and in to is was for on with at by an as from
+""".split())
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Local BM25 indexes already loaded in this process, by directory
+bm25_indexes = {}
+bm25_indexes_lock = threading.Lock()
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for removing the accents of a text. The ñ is kept, since it changes the word in spanish (e.g. año / ano).
+def fold_accents(text):
+
+    text = text.replace("ñ", "\0").replace("Ñ", "\0")
+    text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+
+    return text.replace("\0", "ñ")
+
+
+
+# Light spanish stemmer that only removes the plurals (goles -> gol, partidos -> partido)
+def stem_spanish(token):
+
+    if len(token) > 4 and token.endswith("es") and token[-3] not in "aeiou":
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and token[-2] in "aeo":
+        return token[:-1]
+
+    return token
+
+
+
+# Function for tokenizing a text: lowercase, accents folded, stopwords removed and plurals stemmed
+def tokenize(text):
+    return [stem_spanish(token) for token in TOKEN_PATTERN.findall(fold_accents(text.lower())) if token not in STOPWORDS]
+
+
+
+# Function for building the local BM25 index of a list of chunks, over the 'content' and 'headers_concat' fields.
+# The headers are weighted with headers_weight in the term frequencies and document lengths. The postings are stored as
+# flat arrays, with the postings of the term i in the range offsets[i]:offsets[i + 1] of doc_ids and term_frequencies.
+# The files are written to a temporary directory and swapped at the end, as the local vector index.
+def build_bm25_index(chunks, index_dir, headers_weight=BM25_HEADERS_WEIGHT):
+
+    chunks = list(chunks)
+    if not chunks:
+        raise ValueError("No chunks for building the BM25 index")
+
+    term_ids = {}
+    postings = []
+    doc_lengths = np.zeros(len(chunks), dtype=np.float32)
+
+    for doc_id, chunk in enumerate(chunks):
+        term_frequencies = Counter(tokenize(chunk.get("content") or ""))
+        content_length = sum(term_frequencies.values())
+
+        headers_tokens = tokenize(chunk.get("headers_concat") or "")
+        for token in headers_tokens:
+            term_frequencies[token] += headers_weight
+
+        doc_lengths[doc_id] = content_length + headers_weight * len(headers_tokens)
+        for term, term_frequency in term_frequencies.items():
+            term_id = term_ids.setdefault(term, len(term_ids))
+            if term_id == len(postings):
+                postings.append([])
+            postings[term_id].append((doc_id, term_frequency))
+
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term_postings) for term_postings in postings])
+    doc_ids = np.fromiter((doc_id for term_postings in postings for doc_id, _ in term_postings), dtype=np.int32, count=offsets[-1])
+    term_frequencies = np.fromiter((term_frequency for term_postings in postings for _, term_frequency in term_postings), dtype=np.float32,
+                                   count=offsets[-1])
+
+    # Same idf of the elasticsearch BM25, log(1 + (N - n + 0.5) / (n + 0.5))
+    document_frequencies = np.diff(offsets).astype(np.float32)
+    idf = np.log1p((len(chunks) - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+
+    tmp_dir = index_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    for name, array in [("offsets", offsets), ("doc_ids", doc_ids), ("term_frequencies", term_frequencies), ("idf", idf), ("doc_lengths", doc_lengths)]:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+
+    with open(os.path.join(tmp_dir, "terms.json"), "w", encoding="utf-8") as terms_file:
+        json.dump(list(term_ids), terms_file, ensure_ascii=False)
+
+    with open(os.path.join(tmp_dir, "chunks.jsonl"), "w", encoding="utf-8") as chunks_file:
+        for chunk in chunks:
+            source = {key: value for key, value in chunk.items() if key != "content_embeddings"}
+            chunks_file.write(json.dumps(source, default=str, ensure_ascii=False) + "\n")
+
+    metadata = {"count": len(chunks), "terms": len(term_ids), "postings": int(offsets[-1]), "avg_doc_length": float(doc_lengths.mean()),
+                "headers_weight": headers_weight, "built_at": datetime.now().isoformat()}
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+    return metadata
+
+
+
+# In-process BM25 index of the chunks. The postings arrays are memory-mapped, and the scores of a query are accumulated
+# with vectorized operations over the postings of each query term.
+class BM25Index:
+
+    def __init__(self, index_dir, k1=BM25_K1, b=BM25_B):
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.loaded_mtime = os.path.getmtime(os.path.join(index_dir, "meta.json"))
+
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(index_dir, "doc_ids.npy"), mmap_mode="r")
+        self.term_frequencies = np.load(os.path.join(index_dir, "term_frequencies.npy"), mmap_mode="r")
+        self.idf = np.load(os.path.join(index_dir, "idf.npy"), mmap_mode="r")
+
+        # Length normalization of each document, k1 * (1 - b + b * dl / avgdl), computed once
+        doc_lengths = np.load(os.path.join(index_dir, "doc_lengths.npy"))
+        self.length_norms = (k1 * (1 - b + b * doc_lengths / max(self.metadata["avg_doc_length"], 1e-9))).astype(np.float32)
+
+        with open(os.path.join(index_dir, "terms.json"), "r", encoding="utf-8") as terms_file:
+            self.term_ids = {term: term_id for term_id, term in enumerate(json.load(terms_file))}
+
+        with open(os.path.join(index_dir, "chunks.jsonl"), "r", encoding="utf-8") as chunks_file:
+            self.chunks = [json.loads(line) for line in chunks_file if line.strip()]
+
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+    # Whether the index was rebuilt on disk after being loaded
+    def is_stale(self):
+        try:
+            return os.path.getmtime(os.path.join(self.index_dir, "meta.json")) != self.loaded_mtime
+        except OSError:
+            return False
+
+
+    # BM25 score of every document for a query. A term repeated in the query counts as many times as it appears.
+    def scores(self, query):
+
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term, query_frequency in Counter(tokenize(query)).items():
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids = self.doc_ids[start:end]
+            term_frequencies = self.term_frequencies[start:end]
+            # The doc ids of a term are unique, so the scores can be added without np.add.at
+            scores[doc_ids] += query_frequency * self.idf[term_id] * term_frequencies * (self.k1 + 1) / (term_frequencies + self.length_norms[doc_ids])
+
+        return scores
+
+
+    # Returns the top-k chunks as elasticsearch hits. Only the documents with some query term are returned.
+    def search(self, query, k=5):
+
+        scores = self.scores(query)
+        matches = np.flatnonzero(scores)
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        matches = matches[np.argsort(-scores[matches])]
+
+        return [{"_id": self.chunks[position].get("chunk_id") or str(position), "_score": float(scores[position]),
+                 "_source": self.chunks[position]} for position in matches]
+
+
+
+# Function for getting the directory of the local BM25 index of an elasticsearch index
+def get_bm25_index_dir(index_name, bm25_index_dir=BM25_INDEX_DIR):
+    return os.path.join(bm25_index_dir, index_name)
+
+
+
+# Function for getting the local BM25 index of an elasticsearch index. The index is loaded once per process,
+# and loaded again if it was rebuilt on disk.
+def get_bm25_index(index_name, bm25_index_dir=BM25_INDEX_DIR):
+
+    index_dir = get_bm25_index_dir(index_name, bm25_index_dir)
+
+    with bm25_indexes_lock:
+        bm25_index = bm25_indexes.get(index_dir)
+        if bm25_index is None or bm25_index.is_stale():
+            bm25_index = bm25_indexes[index_dir] = BM25Index(index_dir)
+
+    return bm25_index
+
+
+
+# Function to make a text search on the local BM25 index, without calling elasticsearch.
+# Same parameters of text_search, so it can be used in its place (es_client is not used).
+def local_text_search(user_query, es_client, index, size=5):
+    return get_bm25_index(index).search(user_query, k=size)
+
+
+
+# Function to make an hybrid search fused with RRF with the local BM25 index. The kNN search runs on the local
+# vector index (so no network service is needed), or on elasticsearch with local_knn=False.
+def bm25_hybrid_search_rrf(user_query, es_client, index, embeddings_model, size=5, rank_window_size=20, rank_constant=60, local_knn=True):
+
+    # Imported here so the local index can be used without loading the RAG clients
+    from rag import knn_search, rrf_fuse
+
+    knn_function = local_knn_search if local_knn else knn_search
+
+    text_results = local_text_search(user_query, es_client, index, size=rank_window_size)
+    knn_results = knn_function(user_query=user_query, es_client=es_client, index=index, embeddings_model=embeddings_model, size=rank_window_size)
+
+    return rrf_fuse([text_results, knn_results], size=size, k=rank_constant)
+
+
+
+# Function for benchmarking the latency of the text search on elasticsearch vs. the local BM25 index.
+# The overlap is the share of the elasticsearch top-k chunks also returned by the local index.
+def benchmark_text(questions, es_client, index_name, bm25_index, size=5):
+
+    # Imported here so the local index can be used without loading the RAG clients
+    from rag import text_search
+
+    latencies = {"elasticsearch": [], "local": []}
+    overlaps = []
+    for question in questions:
+        start_time = time.perf_counter()
+        es_hits = text_search(question, es_client, index_name, size=size)
+        latencies["elasticsearch"].append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        local_hits = bm25_index.search(question, k=size)
+        latencies["local"].append(time.perf_counter() - start_time)
+
+        es_chunk_ids = {hit["_source"]["chunk_id"] for hit in es_hits}
+        local_chunk_ids = {hit["_source"]["chunk_id"] for hit in local_hits}
+        overlaps.append(len(es_chunk_ids & local_chunk_ids) / len(es_chunk_ids) if es_chunk_ids else 1.0)
+
+    report = [{"backend": backend, "queries": len(values), "p50_ms": np.percentile(values, 50) * 1000,
+               "p99_ms": np.percentile(values, 99) * 1000, "mean_ms": np.mean(values) * 1000}
+              for backend, values in latencies.items()]
+
+    return pd.DataFrame(report), float(np.mean(overlaps))
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+# Build and benchmark of the local BM25 index.
+# Usage:
+#   python bm25.py build
+#   python bm25.py benchmark --ground-truth ../tests/wiki_Lionel_Messi-GroundTruth.csv --sample 500
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Local in-process BM25 index of the chunks")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--index", default="messixpert_cosine", help="Elasticsearch index with the chunks indexed by ingestion.py")
+    parser.add_argument("--bm25-index-dir", default=BM25_INDEX_DIR)
+    parser.add_argument("--ground-truth", default="../tests/wiki_Lionel_Messi-GroundTruth.csv")
+    parser.add_argument("--sample", type=int, default=500)
+    parser.add_argument("--size", type=int, default=5)
+    args = parser.parse_args()
+
+    es_client = Elasticsearch("http://localhost:9200")
+    index_dir = get_bm25_index_dir(args.index, args.bm25_index_dir)
+
+    if args.command == "build":
+        metadata = build_bm25_index(iter_indexed_chunks(es_client, args.index), index_dir)
+        print(f"Local BM25 index built in {index_dir}: {metadata}")
+
+    else:
+        ground_truth_df = pd.read_csv(args.ground_truth, sep=";")
+        questions = ground_truth_df.question.sample(n=min(args.sample, len(ground_truth_df)), random_state=1).tolist()
+
+        report_df, overlap = benchmark_text(questions, es_client, args.index, BM25Index(index_dir), size=args.size)
+
+        print(report_df.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+        print(f"Top-{args.size} overlap with elasticsearch: {overlap:.4f}")
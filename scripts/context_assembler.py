@@ -0,0 +1,280 @@
+import os
+import re
+import threading
+
+import tiktoken
+
+from token_counter import TokenCounter
+
+
+
+
+# Default configuration of the context assembly, overridable from the environment.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "600"))
+HISTORY_RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", "2"))
+CONTEXT_MIN_CHUNK_TOKENS = int(os.getenv("CONTEXT_MIN_CHUNK_TOKENS", "80"))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "single")
+
+PROMPT_LAYOUTS = ("single", "cache")
+
+# Static instructions of the assistant, shared by every prompt
+ASSISTANT_INSTRUCTIONS = """
+You are an expert biographer on the life and career of Lionel Messi, with deep knowledge of his entire history and statistics.
+Your task is to answer users questions based solely on the context provided to you.
+Answer respectfully and in a warm way, as if you are an assistant.
+Answer in the same language that you are asked, if you are asked in english then answer in english, but if you are asked in spanish then answer in spanish.
+Use only the data from the context to answer the question.
+If you cannot answer the question with the provided information, respond: “I’m sorry, but I don’t have enough information to answer that. Is there anything else I can help you with?”
+""".strip()
+
+# Volatile part of the prompt, after the instructions
+PROMPT_BODY_TEMPLATE = """
+Here is the conversation history so far:
+{conversation_history}
+
+CONTEXT: {context}
+
+QUESTION:
+{question}
+""".strip()
+
+# Messages of the "cache" layout after the instructions: the context, and then the history with the question, which change every turn
+CONTEXT_MESSAGE_TEMPLATE = """
+CONTEXT:
+{context}
+""".strip()
+
+QUESTION_MESSAGE_TEMPLATE = """
+Here is the conversation history so far:
+{conversation_history}
+
+QUESTION:
+{question}
+""".strip()
+
+# Tokens added by the chat format to each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Tokens of the lines of a summarized turn
+SUMMARY_QUESTION_TOKENS = 30
+SUMMARY_ANSWER_TOKENS = 40
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for getting the set of word 3-shingles of a text, for detecting overlapping chunks
+def get_shingles(text, size=3):
+
+    words = re.findall(r"\w+", text.lower())
+
+    return {tuple(words[start:start + size]) for start in range(max(len(words) - size + 1, 1))}
+
+
+
+# Function for ranking the hits by their fused score (RRF), deduplicated by chunk_id.
+# The search functions return one ranked list (e.g. hybrid_search_rrf) or several lists concatenated (hybrid_search).
+# The hits of concatenated lists are tagged with their list in "_search", and each list is ranked on its own, as their
+# scores are not comparable (BM25 vs cosine). A chunk found by several lists adds up their RRF scores.
+def rank_hits(hits, k=60):
+
+    rrf_scores = {}
+    ranked_hits = {}
+    ranks = {}
+
+    for hit in hits:
+        search = hit.get("_search")
+        ranks[search] = ranks.get(search, 0) + 1
+
+        doc_id = hit["_source"].get("chunk_id") or hit["_id"]
+        rrf_scores[doc_id] = rrf_scores.get(doc_id, 0) + 1 / (k + ranks[search])
+        ranked_hits.setdefault(doc_id, hit)
+
+    return [(ranked_hits[doc_id], rrf_scores[doc_id]) for doc_id in sorted(rrf_scores, key=rrf_scores.get, reverse=True)]
+
+
+
+# Assembler of the prompt within a token budget.
+#   - The static instructions are formatted and counted once.
+#   - The retrieved chunks are ranked by fused score, the chunks mostly contained in a better ranked one are dropped, and the
+#     rest are added while they fit in the budget left by the instructions, question and history (the last one truncated).
+#   - The last recent_turns turns of the conversation are kept verbatim, and the older ones are compacted into a rolling
+#     summary (question and first sentence of each answer), dropping the oldest lines when it exceeds the history budget.
+# The token breakdown of the last prompt assembled by each thread is kept, to be stored with the answer.
+# Layouts:
+#   - "single": a single user message with the instructions, history, context and question (as build_prompt).
+#   - "cache": a list of messages ordered from the most to the least stable: the instructions as system message, the context,
+#     and the history with the question. The prefix shared by the requests is as long as possible, so the automatic prompt
+#     caching of the provider applies to it.
+class ContextAssembler:
+
+    def __init__(self, token_budget=PROMPT_TOKEN_BUDGET, history_token_budget=HISTORY_TOKEN_BUDGET, recent_turns=HISTORY_RECENT_TURNS,
+                 min_chunk_tokens=CONTEXT_MIN_CHUNK_TOKENS, duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD, layout=PROMPT_LAYOUT, token_counter=None):
+        if layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout: {layout}")
+
+        self.layout = layout
+        self.token_budget = token_budget
+        self.history_token_budget = history_token_budget
+        self.recent_turns = recent_turns
+        self.min_chunk_tokens = min_chunk_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.token_counter = token_counter or TokenCounter(tiktoken.encoding_for_model("gpt-4o-mini"), mode="cached")
+        self.lock = threading.Lock()
+
+        # The instructions and the template never change, so their tokens are only counted once
+        self.instructions_tokens = self.count_tokens(ASSISTANT_INSTRUCTIONS)
+        if layout == "cache":
+            self.template_tokens = (self.count_tokens(CONTEXT_MESSAGE_TEMPLATE.format(context="")) + 3 * MESSAGE_OVERHEAD_TOKENS
+                                    + self.count_tokens(QUESTION_MESSAGE_TEMPLATE.format(conversation_history="", question="")))
+        else:
+            self.template_tokens = self.count_tokens(PROMPT_BODY_TEMPLATE.format(conversation_history="", context="", question="")) + MESSAGE_OVERHEAD_TOKENS
+
+        # Token breakdown of the last prompt assembled by each thread (each streamlit session runs in its own thread)
+        self.last_assembly = threading.local()
+
+
+    # The memoized token counter is shared by the threads
+    def count_tokens(self, text):
+        with self.lock:
+            return self.token_counter.count(text)
+
+
+    def truncate(self, text, max_tokens):
+        return self.token_counter.encoding.decode(self.token_counter.encoding.encode(text)[:max_tokens])
+
+
+    # Returns the ranked chunks without the ones mostly contained in a better ranked chunk, and the number of dropped duplicates
+    def deduplicate(self, hits):
+
+        kept_hits = []
+        kept_shingles = []
+        for hit, score in rank_hits(hits):
+            shingles = get_shingles(hit["_source"]["content"])
+            if any(len(shingles & other) / min(len(shingles), len(other)) >= self.duplicate_threshold for other in kept_shingles):
+                continue
+            kept_hits.append(hit)
+            kept_shingles.append(shingles)
+
+        return kept_hits, len(hits) - len(kept_hits)
+
+
+    # Returns the text of the conversation history and the number of summarized turns
+    def compact_history(self, memory):
+
+        messages = memory.chat_memory.messages if memory is not None else []
+        turns = []
+        for message in messages:
+            if message.type == "human" or not turns:
+                turns.append({"user": "", "assistant": ""})
+            turns[-1]["user" if message.type == "human" else "assistant"] = message.content
+
+        older_turns = turns[:-self.recent_turns] if self.recent_turns else turns
+        recent_turns = turns[len(older_turns):]
+
+        recent_lines = [f"User: {turn['user']}\nAssistant: {turn['assistant']}" for turn in recent_turns]
+
+        # If the recent turns do not fit by themselves, the oldest ones go to the summary and the last one is truncated
+        recent_text = "\n".join(recent_lines)
+        while recent_lines and self.count_tokens(recent_text) > self.history_token_budget:
+            if len(recent_lines) > 1:
+                recent_lines.pop(0)
+                older_turns.append(recent_turns.pop(0))
+                recent_text = "\n".join(recent_lines)
+            else:
+                recent_text = recent_lines[0] = self.truncate(recent_lines[0], self.history_token_budget)
+                break
+
+        summary_budget = self.history_token_budget - self.count_tokens(recent_text)
+        summary_lines = []
+        for turn in reversed(older_turns):
+            first_sentence = re.split(r"(?<=[.!?])\s", turn["assistant"].strip(), maxsplit=1)[0]
+            line = (f"- User asked: {self.truncate(turn['user'], SUMMARY_QUESTION_TOKENS)} / "
+                    f"Assistant: {self.truncate(first_sentence, SUMMARY_ANSWER_TOKENS)}")
+            line_tokens = self.count_tokens(line)
+            if line_tokens > summary_budget:
+                break
+            summary_budget -= line_tokens
+            summary_lines.insert(0, line)
+
+        history_parts = []
+        if summary_lines:
+            history_parts.append("Summary of the earlier conversation:\n" + "\n".join(summary_lines))
+        if recent_text:
+            history_parts.append(recent_text)
+
+        return "\n\n".join(history_parts), len(summary_lines)
+
+
+    # Assembles the prompt of a question. Returns the prompt (a text, or a list of messages with the "cache" layout) and its token breakdown.
+    def assemble(self, question, hits, memory):
+
+        question_tokens = self.count_tokens(question)
+        history_text, summarized_turns = self.compact_history(memory)
+        history_tokens = self.count_tokens(history_text)
+
+        context_budget = self.token_budget - self.instructions_tokens - self.template_tokens - question_tokens - history_tokens
+
+        ranked_hits, duplicate_chunks = self.deduplicate(hits)
+
+        context_parts = []
+        context_tokens = 0
+        truncated_chunks = 0
+        for hit in ranked_hits:
+            content = hit["_source"]["content"]
+            content_tokens = self.count_tokens(content)
+            remaining_tokens = context_budget - context_tokens
+            if content_tokens > remaining_tokens:
+                if remaining_tokens < self.min_chunk_tokens:
+                    break
+                content = self.truncate(content, remaining_tokens)
+                content_tokens = remaining_tokens
+                truncated_chunks += 1
+            context_parts.append(content)
+            context_tokens += content_tokens
+
+        context = "".join(f"{text}\n\n" for text in context_parts)
+        if self.layout == "cache":
+            prompt = [
+                {"role": "system", "content": ASSISTANT_INSTRUCTIONS},
+                {"role": "system", "content": CONTEXT_MESSAGE_TEMPLATE.format(context=context.strip())},
+                {"role": "user", "content": QUESTION_MESSAGE_TEMPLATE.format(conversation_history=history_text, question=question)},
+            ]
+        else:
+            prompt = (ASSISTANT_INSTRUCTIONS + "\n\n" + PROMPT_BODY_TEMPLATE.format(conversation_history=history_text, context=context,
+                                                                                    question=question)).strip()
+
+        budget = {
+            "budget_instructions_tokens": self.instructions_tokens + self.template_tokens,
+            "budget_question_tokens": question_tokens,
+            "budget_history_tokens": history_tokens,
+            "budget_context_tokens": context_tokens,
+            "context_chunks_used": len(context_parts),
+            "context_chunks_dropped": len(ranked_hits) - len(context_parts) + duplicate_chunks,
+            "context_chunks_truncated": truncated_chunks,
+            "history_turns_summarized": summarized_turns,
+        }
+        self.last_assembly.budget = budget
+
+        return prompt, budget
+
+
+    # Token breakdown of the last prompt assembled by the current thread, to be stored with the answer
+    def last_assembly_metrics(self):
+        return dict(getattr(self.last_assembly, "budget", {}))
+
+
+    def reset_last_assembly(self):
+        self.last_assembly.budget = {}
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
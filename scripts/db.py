@@ -1,6 +1,10 @@
 import os
+import time
+import threading
 import psycopg2
-from psycopg2.extras import DictCursor
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import DictCursor, execute_values
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
@@ -15,39 +19,280 @@ RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
 TZ_INFO = os.getenv("TZ", "America/Argentina/Buenos_Aires")
 tz = ZoneInfo(TZ_INFO)
 
+# Configuration of the connections pool, overridable from the environment.
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+POSTGRES_POOL_HEALTH_CHECK_SECONDS = float(os.getenv("POSTGRES_POOL_HEALTH_CHECK_SECONDS", "30"))
+POSTGRES_CONNECT_TIMEOUT = int(os.getenv("POSTGRES_CONNECT_TIMEOUT", "5"))
+
+# Configuration of the monitoring schema, overridable from the environment.
+# The answers table is partitioned by month, and the partitions are created PARTITIONS_MONTHS_AHEAD months in advance.
+# The rollups are recomputed for the buckets with rows inserted or updated since the last refresh, minus ROLLUP_LAG_SECONDS
+# (so rows of transactions still open during a refresh are picked up by the next one).
+PARTITIONS_MONTHS_AHEAD = int(os.getenv("PARTITIONS_MONTHS_AHEAD", "3"))
+ROLLUP_LAG_SECONDS = int(os.getenv("ROLLUP_LAG_SECONDS", "60"))
+ROLLUP_GRANULARITIES = ["minute", "hour"]
+
+# Pool shared by all the functions of the module. It is created on the first use.
+db_pool = None
+db_pool_lock = threading.Lock()
+
+
+
+# Optional columns of the answers table, with the value stored when the answer_data does not include them.
+ANSWER_OPTIONAL_COLUMNS = {
+    "embedding_time": 0.0,
+    "embedding_cache_hit": False,
+    "embedding_cold_start_time": 0.0,
+    "semantic_cache_hit": False,
+    "semantic_cache_similarity": 0.0,
+    "cost_saved": 0.0,
+    "time_to_first_token": 0.0,
+    "budget_instructions_tokens": 0,
+    "budget_question_tokens": 0,
+    "budget_history_tokens": 0,
+    "budget_context_tokens": 0,
+    "context_chunks_used": 0,
+    "context_chunks_dropped": 0,
+    "context_chunks_truncated": 0,
+    "history_turns_summarized": 0,
+    "cached_prompt_tokens": 0,
+    "cached_tokens_ratio": 0.0,
+    "prompt_cache_savings": 0.0,
+    "llm_backend": "",
+    "llm_latency": 0.0,
+    "route_reason": "",
+    "route_primary": "",
+    "route_hedged": False,
+    "route_fallback": False,
+    "route_primary_p95": 0.0,
+    "rerank_time": 0.0,
+    "rerank_candidates": 0,
+    "rerank_cache_hits": 0,
+}
+
+ANSWER_COLUMNS = [
+    "question", "answer", "model_used", "response_time", "relevance", "relevance_explanation",
+    "prompt_tokens", "completion_tokens", "total_tokens", "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens",
+    "openai_cost", *ANSWER_OPTIONAL_COLUMNS,
+]
+
+# Statements prepared on each pooled connection. They use the $1, $2... placeholders of PREPARE.
+INSERT_ANSWER_SQL = f"""
+    INSERT INTO answers
+    (id, {", ".join(ANSWER_COLUMNS)}, timestamp)
+    VALUES ({", ".join(f"${position}" for position in range(1, len(ANSWER_COLUMNS) + 3))})
+"""
+
+INSERT_FEEDBACK_SQL = """
+    INSERT INTO feedbacks (answer_id, feedback, timestamp, idempotency_key) VALUES ($1, $2, COALESCE($3, CURRENT_TIMESTAMP), $4)
+    ON CONFLICT (idempotency_key) DO NOTHING
+"""
+
+# Multi-row inserts of the telemetry batches. An answer or feedback replayed twice from the spill file is only stored once.
+INSERT_ANSWERS_BATCH_SQL = f"INSERT INTO answers (id, {', '.join(ANSWER_COLUMNS)}, timestamp) VALUES %s ON CONFLICT DO NOTHING"
+
+INSERT_FEEDBACKS_BATCH_SQL = "INSERT INTO feedbacks (answer_id, feedback, timestamp, idempotency_key) VALUES %s ON CONFLICT (idempotency_key) DO NOTHING"
+
+LAST_CONVERSATIONS_SQL = """
+    SELECT answers.*, feedbacks.feedback
+    FROM answers
+    LEFT JOIN feedbacks ON answers.id = feedbacks.answer_id
+    WHERE $1::text IS NULL OR answers.relevance = $1
+    ORDER BY answers.timestamp DESC LIMIT $2
+"""
+
+# The answers that already failed to be judged go after the new ones, so they do not block them
+UNEVALUATED_ANSWERS_SQL = """
+    SELECT id, question, answer, timestamp
+    FROM answers
+    WHERE relevance = 'UNKNOWN'
+    ORDER BY eval_attempts, timestamp LIMIT $1
+"""
+
+UPDATE_ANSWER_EVALUATION_SQL = """
+    UPDATE answers
+    SET relevance = $1, relevance_explanation = $2, eval_prompt_tokens = $3, eval_completion_tokens = $4, eval_total_tokens = $5,
+        updated_at = now()
+    WHERE id = $6 AND timestamp = $7
+"""
+
+# A failed evaluation counts an attempt. The answer is labeled ERROR, leaving the pending answers, when the error is permanent
+# or after the maximum attempts.
+FAILED_ANSWER_EVALUATION_SQL = """
+    UPDATE answers
+    SET eval_attempts = eval_attempts + 1,
+        relevance = CASE WHEN $1 OR eval_attempts + 1 >= $2 THEN 'ERROR' ELSE relevance END,
+        relevance_explanation = $3, updated_at = now()
+    WHERE id = $4 AND timestamp = $5
+"""
+
+FEEDBACK_STATS_SQL = """
+    SELECT 
+        SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END) as thumbs_up,
+        SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END) as thumbs_down
+    FROM feedbacks
+"""
+
+
+
+# Getting the connection parameters of the DB. Prepared for the docker-compose.
+def get_connection_params():
+    return {
+        "host": os.getenv("POSTGRES_HOST", "postgres"),
+        "database": os.getenv("POSTGRES_DB", "messiXpert_assistant"),
+        "user": os.getenv("POSTGRES_USER", "admin"),
+        "password": os.getenv("POSTGRES_PASSWORD", "admin"),
+        "connect_timeout": POSTGRES_CONNECT_TIMEOUT,
+    }
+
+
+
+# Creating a DB connection outside of the pool
+def get_db_connection():
+    return psycopg2.connect(**get_connection_params())
 
 
-# Creating the DB connection. Prepared for the docker-compose.
-def get_db_connection():
-    print("POSTGRES_HOST=",os.getenv("POSTGRES_HOST", "DEFAULT"))
-    print("POSTGRES_DB=",os.getenv("POSTGRES_DB", "DEFAULT"))
-    print("POSTGRES_USER=",os.getenv("POSTGRES_USER", "DEFAULT"))
-    print("POSTGRES_PASSWORD=",os.getenv("POSTGRES_PASSWORD", "DEFAULT"))
 
-    return psycopg2.connect(
-        host=os.getenv("POSTGRES_HOST", "postgres"),
-        database=os.getenv("POSTGRES_DB", "messiXpert_assistant"),
-        user=os.getenv("POSTGRES_USER", "admin"),
-        password=os.getenv("POSTGRES_PASSWORD", "admin"),
-    )
+# Thread-safe pool of DB connections.
+# A connection idle for more than health_check_seconds is checked with a SELECT 1 before being handed out, and replaced if it is broken.
+# The statements prepared on each connection are tracked, so each statement is prepared once per connection.
+class ConnectionPool:
+
+    def __init__(self, min_size=POSTGRES_POOL_MIN_SIZE, max_size=POSTGRES_POOL_MAX_SIZE, health_check_seconds=POSTGRES_POOL_HEALTH_CHECK_SECONDS,
+                 **connection_params):
+        self.pool = ThreadedConnectionPool(min_size, max_size, **connection_params)
+        self.health_check_seconds = health_check_seconds
+
+        # ThreadedConnectionPool raises an error when it is exhausted, so the callers wait on a semaphore instead
+        self.available = threading.BoundedSemaphore(max_size)
+
+        self.last_used_at = {}          # id(conn) -> time of the last use
+        self.prepared_statements = {}   # id(conn) -> names of the statements prepared on the connection
+
+
+    @staticmethod
+    def is_healthy(conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+    def discard(self, conn):
+        self.last_used_at.pop(id(conn), None)
+        self.prepared_statements.pop(id(conn), None)
+        self.pool.putconn(conn, close=True)
+
+
+    def getconn(self):
+        conn = self.pool.getconn()
+
+        idle_time = time.monotonic() - self.last_used_at.get(id(conn), time.monotonic())
+        if conn.closed or (idle_time > self.health_check_seconds and not self.is_healthy(conn)):
+            self.discard(conn)
+            conn = self.pool.getconn()
+
+        return conn
+
+
+    def putconn(self, conn):
+        if conn.closed:
+            self.discard(conn)
+            return
+
+        # Closing any transaction left open (e.g. by a SELECT) before returning the connection
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            self.discard(conn)
+            return
+
+        self.last_used_at[id(conn)] = time.monotonic()
+        self.pool.putconn(conn)
+
+
+    # Context manager that borrows a connection of the pool, and returns it when the block ends
+    @contextmanager
+    def connection(self):
+        self.available.acquire()
+        conn = None
+        try:
+            conn = self.getconn()
+            yield conn
+        finally:
+            if conn is not None:
+                self.putconn(conn)
+            self.available.release()
+
+
+    # Executes a prepared statement, preparing it first if it was not prepared on this connection yet
+    def execute_prepared(self, cur, name, sql, params=()):
+        prepared = self.prepared_statements.setdefault(id(cur.connection), set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {sql}")
+            prepared.add(name)
+
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+
+    def close(self):
+        self.pool.closeall()
+
+
+
+# Function for getting the pool of DB connections. It is created on the first call.
+def get_db_pool():
+    global db_pool
+
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = ConnectionPool(**get_connection_params())
+
+    return db_pool
+
+
+
+# Closing the pool of DB connections. A new pool is created on the next use.
+def close_db_pool():
+    global db_pool
+
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.close()
+            db_pool = None
 
 
 
 # Initaliazing the database. Creating the tables needed for monitoring.
 def init_db():
-    conn = get_db_connection()
-    try:
+    with get_db_pool().connection() as conn:
         with conn.cursor() as cur:
             cur.execute("DROP TABLE IF EXISTS feedbacks")
             cur.execute("DROP TABLE IF EXISTS answers")
+            for granularity in ROLLUP_GRANULARITIES:
+                cur.execute(f"DROP TABLE IF EXISTS answers_rollup_{granularity}")
+                cur.execute(f"DROP TABLE IF EXISTS feedbacks_rollup_{granularity}")
+            cur.execute("DROP TABLE IF EXISTS rollups_state")
 
+            # The primary key of a partitioned table must include the partition key, so feedbacks.answer_id can not be
+            # a foreign key anymore. It is indexed instead.
             cur.execute("""
                 CREATE TABLE answers (
-                    id TEXT PRIMARY KEY,
+                    id TEXT NOT NULL,
                     question TEXT NOT NULL,
                     answer TEXT NOT NULL,
                     model_used TEXT NOT NULL,
                     response_time FLOAT NOT NULL,
+                    time_to_first_token FLOAT NOT NULL DEFAULT 0,
                     relevance TEXT NOT NULL,
                     relevance_explanation TEXT NOT NULL,
                     prompt_tokens INTEGER NOT NULL,
@@ -56,21 +301,258 @@ def init_db():
                     eval_prompt_tokens INTEGER NOT NULL,
                     eval_completion_tokens INTEGER NOT NULL,
                     eval_total_tokens INTEGER NOT NULL,
+                    eval_attempts INTEGER NOT NULL DEFAULT 0,
                     openai_cost FLOAT NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                )
+                    embedding_time FLOAT NOT NULL DEFAULT 0,
+                    embedding_cache_hit BOOLEAN NOT NULL DEFAULT FALSE,
+                    embedding_cold_start_time FLOAT NOT NULL DEFAULT 0,
+                    semantic_cache_hit BOOLEAN NOT NULL DEFAULT FALSE,
+                    semantic_cache_similarity FLOAT NOT NULL DEFAULT 0,
+                    cost_saved FLOAT NOT NULL DEFAULT 0,
+                    budget_instructions_tokens INTEGER NOT NULL DEFAULT 0,
+                    budget_question_tokens INTEGER NOT NULL DEFAULT 0,
+                    budget_history_tokens INTEGER NOT NULL DEFAULT 0,
+                    budget_context_tokens INTEGER NOT NULL DEFAULT 0,
+                    context_chunks_used INTEGER NOT NULL DEFAULT 0,
+                    context_chunks_dropped INTEGER NOT NULL DEFAULT 0,
+                    context_chunks_truncated INTEGER NOT NULL DEFAULT 0,
+                    history_turns_summarized INTEGER NOT NULL DEFAULT 0,
+                    cached_prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    cached_tokens_ratio FLOAT NOT NULL DEFAULT 0,
+                    prompt_cache_savings FLOAT NOT NULL DEFAULT 0,
+                    llm_backend TEXT NOT NULL DEFAULT '',
+                    llm_latency FLOAT NOT NULL DEFAULT 0,
+                    route_reason TEXT NOT NULL DEFAULT '',
+                    route_primary TEXT NOT NULL DEFAULT '',
+                    route_hedged BOOLEAN NOT NULL DEFAULT FALSE,
+                    route_fallback BOOLEAN NOT NULL DEFAULT FALSE,
+                    route_primary_p95 FLOAT NOT NULL DEFAULT 0,
+                    rerank_time FLOAT NOT NULL DEFAULT 0,
+                    rerank_candidates INTEGER NOT NULL DEFAULT 0,
+                    rerank_cache_hits INTEGER NOT NULL DEFAULT 0,
+                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                    PRIMARY KEY (id, timestamp)
+                ) PARTITION BY RANGE (timestamp)
             """)
+            cur.execute("CREATE TABLE answers_default PARTITION OF answers DEFAULT")
+            create_answers_partitions(cur)
+
             cur.execute("""
                 CREATE TABLE feedbacks (
                     id SERIAL PRIMARY KEY,
-                    answer_id TEXT REFERENCES answers(id),
+                    answer_id TEXT NOT NULL,
                     feedback INTEGER NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                    idempotency_key TEXT UNIQUE,
+                    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+                )
+            """)
+
+            cur.execute("CREATE INDEX answers_timestamp_idx ON answers (timestamp)")
+            cur.execute("CREATE INDEX answers_updated_at_idx ON answers (updated_at)")
+            cur.execute("CREATE INDEX answers_unevaluated_idx ON answers (eval_attempts, timestamp) WHERE relevance = 'UNKNOWN'")
+            cur.execute("CREATE INDEX feedbacks_answer_id_idx ON feedbacks (answer_id)")
+            cur.execute("CREATE INDEX feedbacks_timestamp_idx ON feedbacks (timestamp)")
+            cur.execute("CREATE INDEX feedbacks_updated_at_idx ON feedbacks (updated_at)")
+
+            for granularity in ROLLUP_GRANULARITIES:
+                cur.execute(f"""
+                    CREATE TABLE answers_rollup_{granularity} (
+                        bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+                        model_used TEXT NOT NULL,
+                        answers_count INTEGER NOT NULL,
+                        openai_cost FLOAT NOT NULL,
+                        prompt_tokens BIGINT NOT NULL,
+                        completion_tokens BIGINT NOT NULL,
+                        total_tokens BIGINT NOT NULL,
+                        response_time_sum FLOAT NOT NULL,
+                        response_time_p50 FLOAT NOT NULL,
+                        response_time_p95 FLOAT NOT NULL,
+                        response_time_p99 FLOAT NOT NULL,
+                        time_to_first_token_sum FLOAT NOT NULL,
+                        time_to_first_token_p95 FLOAT NOT NULL,
+                        relevant_count INTEGER NOT NULL,
+                        partly_relevant_count INTEGER NOT NULL,
+                        non_relevant_count INTEGER NOT NULL,
+                        unknown_relevance_count INTEGER NOT NULL,
+                        semantic_cache_hits INTEGER NOT NULL,
+                        cost_saved FLOAT NOT NULL,
+                        cached_prompt_tokens BIGINT NOT NULL,
+                        prompt_cache_savings FLOAT NOT NULL,
+                        llm_latency_sum FLOAT NOT NULL,
+                        PRIMARY KEY (bucket, model_used)
+                    )
+                """)
+                cur.execute(f"""
+                    CREATE TABLE feedbacks_rollup_{granularity} (
+                        bucket TIMESTAMP WITH TIME ZONE PRIMARY KEY,
+                        thumbs_up INTEGER NOT NULL,
+                        thumbs_down INTEGER NOT NULL
+                    )
+                """)
+
+            cur.execute("""
+                CREATE TABLE rollups_state (
+                    rollup_name TEXT PRIMARY KEY,
+                    watermark TIMESTAMP WITH TIME ZONE NOT NULL
                 )
             """)
         conn.commit()
-    finally:
-        conn.close()
+
+    # The statements prepared on the pooled connections refer to the dropped tables
+    close_db_pool()
+
+
+
+# Creating the monthly partitions of the answers table, from the current month to months_ahead months later.
+# The rows outside of the partitions go to the default partition.
+def create_answers_partitions(cur, months_ahead=PARTITIONS_MONTHS_AHEAD):
+    cur.execute("""
+        SELECT date_trunc('month', now()) + make_interval(months => month), date_trunc('month', now()) + make_interval(months => month + 1)
+        FROM generate_series(0, %s) AS month
+    """, (months_ahead,))
+
+    for month_start, next_month_start in cur.fetchall():
+        partition_name = f"answers_{month_start:%Y_%m}"
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (partition_name,))
+        if cur.fetchone()[0]:
+            continue
+
+        # A failed partition is logged and retried on the next refresh, without aborting the refresh of the rollups
+        cur.execute("SAVEPOINT create_answers_partition")
+        try:
+            create_answers_partition(cur, partition_name, month_start, next_month_start)
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT create_answers_partition")
+            print(f"Error creating the partition {partition_name}: {e}")
+        cur.execute("RELEASE SAVEPOINT create_answers_partition")
+
+
+
+# Creating a monthly partition of the answers table. A partition can not be created while the default partition holds rows of
+# its range (e.g. answers stored before the partitions of the month were created), so the default partition is detached,
+# its rows of the month are moved to the new partition, and it is attached again.
+def create_answers_partition(cur, partition_name, month_start, next_month_start):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM answers_default WHERE timestamp >= %s AND timestamp < %s)", (month_start, next_month_start))
+    if not cur.fetchone()[0]:
+        cur.execute(f"CREATE TABLE {partition_name} PARTITION OF answers FOR VALUES FROM (%s) TO (%s)", (month_start, next_month_start))
+        return
+
+    cur.execute("ALTER TABLE answers DETACH PARTITION answers_default")
+    cur.execute(f"CREATE TABLE {partition_name} PARTITION OF answers FOR VALUES FROM (%s) TO (%s)", (month_start, next_month_start))
+    cur.execute("""
+        WITH moved AS (DELETE FROM answers_default WHERE timestamp >= %s AND timestamp < %s RETURNING *)
+        INSERT INTO answers SELECT * FROM moved
+    """, (month_start, next_month_start))
+    print(f"Moved {cur.rowcount} answers from the default partition to {partition_name}")
+    cur.execute("ALTER TABLE answers ATTACH PARTITION answers_default DEFAULT")
+
+
+
+# SQL for recomputing the answers rollup of a granularity, for the buckets in the array parameter
+def get_answers_rollup_sql(granularity):
+    return f"""
+        INSERT INTO answers_rollup_{granularity}
+        SELECT
+            buckets.bucket,
+            model_used,
+            COUNT(*),
+            SUM(openai_cost),
+            SUM(prompt_tokens),
+            SUM(completion_tokens),
+            SUM(total_tokens),
+            SUM(response_time),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY response_time),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY response_time),
+            percentile_cont(0.99) WITHIN GROUP (ORDER BY response_time),
+            SUM(time_to_first_token),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY time_to_first_token),
+            COUNT(*) FILTER (WHERE relevance = 'RELEVANT'),
+            COUNT(*) FILTER (WHERE relevance = 'PARTLY_RELEVANT'),
+            COUNT(*) FILTER (WHERE relevance = 'NON_RELEVANT'),
+            COUNT(*) FILTER (WHERE relevance NOT IN ('RELEVANT', 'PARTLY_RELEVANT', 'NON_RELEVANT')),
+            COUNT(*) FILTER (WHERE semantic_cache_hit),
+            SUM(cost_saved),
+            SUM(cached_prompt_tokens),
+            SUM(prompt_cache_savings),
+            SUM(llm_latency)
+        FROM unnest(%s::timestamptz[]) AS buckets (bucket)
+        JOIN answers ON answers.timestamp >= buckets.bucket AND answers.timestamp < buckets.bucket + interval '1 {granularity}'
+        GROUP BY buckets.bucket, model_used
+    """
+
+
+
+# SQL for recomputing the feedbacks rollup of a granularity, for the buckets in the array parameter
+def get_feedbacks_rollup_sql(granularity):
+    return f"""
+        INSERT INTO feedbacks_rollup_{granularity}
+        SELECT
+            buckets.bucket,
+            COUNT(*) FILTER (WHERE feedback > 0),
+            COUNT(*) FILTER (WHERE feedback < 0)
+        FROM unnest(%s::timestamptz[]) AS buckets (bucket)
+        JOIN feedbacks ON feedbacks.timestamp >= buckets.bucket AND feedbacks.timestamp < buckets.bucket + interval '1 {granularity}'
+        GROUP BY buckets.bucket
+    """
+
+
+
+# Incremental refresh of a rollup. Only the buckets with rows inserted or updated after the watermark of the rollup are recomputed,
+# so late rows (e.g. replayed from the telemetry spill file) and late evaluations update their old buckets too.
+def refresh_rollup(cur, rollup_table, source_table, granularity, rollup_sql, new_watermark):
+    cur.execute("SELECT watermark FROM rollups_state WHERE rollup_name = %s", (rollup_table,))
+    row = cur.fetchone()
+    watermark = row[0] if row else datetime.min.replace(tzinfo=timezone.utc)
+
+    cur.execute(f"SELECT array_agg(DISTINCT date_trunc('{granularity}', timestamp)) FROM {source_table} WHERE updated_at > %s", (watermark,))
+    buckets = cur.fetchone()[0] or []
+
+    if buckets:
+        cur.execute(f"DELETE FROM {rollup_table} WHERE bucket = ANY(%s)", (buckets,))
+        cur.execute(rollup_sql, (buckets,))
+
+    cur.execute("""
+        INSERT INTO rollups_state (rollup_name, watermark) VALUES (%s, %s)
+        ON CONFLICT (rollup_name) DO UPDATE SET watermark = EXCLUDED.watermark
+    """, (rollup_table, new_watermark))
+
+    return len(buckets)
+
+
+
+# Refreshing all the rollups used by the Grafana dashboard, and creating the next partitions of the answers table.
+# Concurrent refreshes (e.g. from several app processes) are skipped with an advisory lock.
+def refresh_rollups(lag_seconds=ROLLUP_LAG_SECONDS):
+    refreshed_buckets = {}
+
+    with get_db_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('refresh_rollups'))")
+            if not cur.fetchone()[0]:
+                return refreshed_buckets
+
+            create_answers_partitions(cur)
+
+            cur.execute("SELECT now() - make_interval(secs => %s)", (lag_seconds,))
+            new_watermark = cur.fetchone()[0]
+
+            for granularity in ROLLUP_GRANULARITIES:
+                refreshed_buckets[f"answers_rollup_{granularity}"] = refresh_rollup(
+                    cur, f"answers_rollup_{granularity}", "answers", granularity, get_answers_rollup_sql(granularity), new_watermark)
+                refreshed_buckets[f"feedbacks_rollup_{granularity}"] = refresh_rollup(
+                    cur, f"feedbacks_rollup_{granularity}", "feedbacks", granularity, get_feedbacks_rollup_sql(granularity), new_watermark)
+        conn.commit()
+
+    return refreshed_buckets
+
+
+
+# Getting the values of the answer columns in order. The optional columns fall back to their default values.
+def get_answer_values(answer_data):
+    return [answer_data[column] if column not in ANSWER_OPTIONAL_COLUMNS else answer_data.get(column, ANSWER_OPTIONAL_COLUMNS[column])
+            for column in ANSWER_COLUMNS]
 
 
 
@@ -79,148 +561,154 @@ def save_answer(conversation_id, answer_data, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
-        print("SAVING ANSWER DB")
+    pool = get_db_pool()
+    with pool.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO answers 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    conversation_id,
-                    answer_data["question"],
-                    answer_data["answer"],
-                    answer_data["model_used"],
-                    answer_data["response_time"],
-                    answer_data["relevance"],
-                    answer_data["relevance_explanation"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
-                    answer_data["eval_prompt_tokens"],
-                    answer_data["eval_completion_tokens"],
-                    answer_data["eval_total_tokens"],
-                    answer_data["openai_cost"],
-                    timestamp
-                ),
-            )
+            pool.execute_prepared(cur, "insert_answer", INSERT_ANSWER_SQL, (conversation_id, *get_answer_values(answer_data), timestamp))
         conn.commit()
-        print("SAVED ANSWER DB")
-    finally:
-        conn.close()
-        print("SAVED AND CLOSED ANSWER DB")
 
 
 
-# Saving user feedback to the database
-def save_feedback(conversation_id, feedback, timestamp=None):
+# Saving user feedback to the database. A feedback saved again with the same idempotency key is only stored once.
+def save_feedback(conversation_id, feedback, timestamp=None, idempotency_key=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
+    pool = get_db_pool()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            pool.execute_prepared(cur, "insert_feedback", INSERT_FEEDBACK_SQL, (conversation_id, feedback, timestamp, idempotency_key))
+        conn.commit()
+
+
+
+# Adding a batch of answers and feedbacks in a single transaction, with multi-row inserts.
+# answers is a list of (conversation_id, answer_data, timestamp) and feedbacks a list of (conversation_id, feedback, timestamp, idempotency_key).
+# The answers are inserted first, so the feedbacks of the batch can refer to them.
+def save_batch(answers, feedbacks):
+    with get_db_pool().connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO feedbacks (answer_id, feedback, timestamp) VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP))",
-                (conversation_id, feedback, timestamp),
-            )
+            if answers:
+                execute_values(cur, INSERT_ANSWERS_BATCH_SQL,
+                               [(conversation_id, *get_answer_values(answer_data), timestamp) for conversation_id, answer_data, timestamp in answers],
+                               page_size=len(answers))
+            if feedbacks:
+                execute_values(cur, INSERT_FEEDBACKS_BATCH_SQL, feedbacks, page_size=len(feedbacks))
+        conn.commit()
+
+
+
+# Get the answers not evaluated yet (relevance UNKNOWN), the oldest first
+def get_unevaluated_answers(limit=20):
+    pool = get_db_pool()
+    with pool.connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            pool.execute_prepared(cur, "unevaluated_answers", UNEVALUATED_ANSWERS_SQL, (limit,))
+            return cur.fetchall()
+
+
+
+# Storing the LLM-as-a-judge evaluation of an answer. updated_at is set so the rollups recompute the bucket of the answer.
+def save_answer_evaluation(answer_id, timestamp, evaluation):
+    pool = get_db_pool()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            pool.execute_prepared(cur, "update_answer_evaluation", UPDATE_ANSWER_EVALUATION_SQL, (
+                evaluation["relevance"],
+                evaluation["relevance_explanation"],
+                evaluation["eval_prompt_tokens"],
+                evaluation["eval_completion_tokens"],
+                evaluation["eval_total_tokens"],
+                answer_id,
+                timestamp,
+            ))
+        conn.commit()
+
+
+
+# Storing a failed LLM-as-a-judge evaluation of an answer. Permanent errors (e.g. a rejected request) label it ERROR at once,
+# and the rest after max_attempts.
+def save_answer_evaluation_error(answer_id, timestamp, error, permanent=False, max_attempts=3):
+    pool = get_db_pool()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            pool.execute_prepared(cur, "failed_answer_evaluation", FAILED_ANSWER_EVALUATION_SQL, (
+                permanent,
+                max_attempts,
+                error,
+                answer_id,
+                timestamp,
+            ))
         conn.commit()
-    finally:
-        conn.close()
 
 
 
 # Get the last conversations with the wanted limit and filtered by relevance if wanted
 def get_last_conversations(limit=5, relevance=None):
-    conn = get_db_connection()
-    try:
+    pool = get_db_pool()
+    with pool.connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            query = """
-                SELECT answers.*, feedbacks.feedback
-                FROM answers
-                LEFT JOIN feedbacks ON answers.id = feedbacks.answers_id
-            """
-            if relevance:
-                query += f" WHERE answers.relevance = '{relevance}'"
-            query += " ORDER BY answers.timestamp DESC LIMIT %s"
-
-            cur.execute(query, (limit,))
+            pool.execute_prepared(cur, "last_conversations", LAST_CONVERSATIONS_SQL, (relevance or None, limit))
             return cur.fetchall()
-    finally:
-        conn.close()
 
 
 
 # Get total feedback stats
 def get_feedback_stats():
-    conn = get_db_connection()
-    try:
+    pool = get_db_pool()
+    with pool.connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT 
-                    SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END) as thumbs_up,
-                    SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END) as thumbs_down
-                FROM feedbacks
-            """)
+            pool.execute_prepared(cur, "feedback_stats", FEEDBACK_STATS_SQL)
             return cur.fetchone()
-    finally:
-        conn.close()
 
 
 
 # Check the configured timezone
 def check_timezone():
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SHOW timezone;")
-            db_timezone = cur.fetchone()[0]
-            print(f"Database timezone: {db_timezone}")
-
-            cur.execute("SELECT current_timestamp;")
-            db_time_utc = cur.fetchone()[0]
-            print(f"Database current time (UTC): {db_time_utc}")
-
-            db_time_local = db_time_utc.astimezone(tz)
-            print(f"Database current time ({TZ_INFO}): {db_time_local}")
-
-            py_time = datetime.now(tz)
-            print(f"Python current time: {py_time}")
-
-            # Use py_time instead of tz for insertion
-            cur.execute("""
-                INSERT INTO answers 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING timestamp;
-            """, 
-            ('test', 'test question', 'test answer', 'test model', 0.0, 0.0, 
-             'test explanation', 0, 0, 0, 0, 0, 0, 0.0, py_time))
-
-            inserted_time = cur.fetchone()[0]
-            print(f"Inserted time (UTC): {inserted_time}")
-            print(f"Inserted time ({TZ_INFO}): {inserted_time.astimezone(tz)}")
-
-            cur.execute("SELECT timestamp FROM answers WHERE id = 'test';")
-            selected_time = cur.fetchone()[0]
-            print(f"Selected time (UTC): {selected_time}")
-            print(f"Selected time ({TZ_INFO}): {selected_time.astimezone(tz)}")
-
-            # Clean up the test entry
-            cur.execute("DELETE FROM answers WHERE id = 'test';")
-            conn.commit()
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    with get_db_pool().connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SHOW timezone;")
+                db_timezone = cur.fetchone()[0]
+                print(f"Database timezone: {db_timezone}")
+
+                cur.execute("SELECT current_timestamp;")
+                db_time_utc = cur.fetchone()[0]
+                print(f"Database current time (UTC): {db_time_utc}")
+
+                db_time_local = db_time_utc.astimezone(tz)
+                print(f"Database current time ({TZ_INFO}): {db_time_local}")
+
+                py_time = datetime.now(tz)
+                print(f"Python current time: {py_time}")
+
+                # Use py_time instead of tz for insertion
+                cur.execute("""
+                    INSERT INTO answers 
+                    (id, question, answer, model_used, response_time, relevance, 
+                    relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
+                    eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING timestamp;
+                """, 
+                ('test', 'test question', 'test answer', 'test model', 0.0, 0.0, 
+                 'test explanation', 0, 0, 0, 0, 0, 0, 0.0, py_time))
+
+                inserted_time = cur.fetchone()[0]
+                print(f"Inserted time (UTC): {inserted_time}")
+                print(f"Inserted time ({TZ_INFO}): {inserted_time.astimezone(tz)}")
+
+                cur.execute("SELECT timestamp FROM answers WHERE id = 'test';")
+                selected_time = cur.fetchone()[0]
+                print(f"Selected time (UTC): {selected_time}")
+                print(f"Selected time ({TZ_INFO}): {selected_time.astimezone(tz)}")
+
+                # Clean up the test entry
+                cur.execute("DELETE FROM answers WHERE id = 'test';")
+                conn.commit()
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            conn.rollback()
 
 
 
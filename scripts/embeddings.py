@@ -0,0 +1,311 @@
+import os
+import re
+import asyncio
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from itertools import islice
+
+import numpy as np
+
+from tqdm.auto import tqdm
+
+
+
+
+# Default embeddings model and cache location, overridable from the environment.
+EMBEDDINGS_MODEL_NAME = os.getenv("EMBEDDINGS_MODEL_NAME", "all-MiniLM-L6-v2")
+EMBEDDINGS_CACHE_PATH = os.getenv("EMBEDDINGS_CACHE_PATH", "../data/cache/embeddings.sqlite")
+EMBEDDINGS_BATCH_SIZE = int(os.getenv("EMBEDDINGS_BATCH_SIZE", "32"))
+EMBEDDINGS_NUM_WORKERS = int(os.getenv("EMBEDDINGS_NUM_WORKERS", "1"))
+QUERY_EMBEDDINGS_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDINGS_CACHE_SIZE", "2048"))
+
+# Embedding services already loaded in this process, by model name
+embedding_services = {}
+embedding_services_lock = threading.Lock()
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for hashing a chunk content. The hash is used as the key of the embeddings cache.
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+
+# Persistent embeddings cache stored in a sqlite file.
+# Each vector is keyed by the content hash and the model name, so a model change never returns stale vectors.
+class EmbeddingCache:
+
+    def __init__(self, cache_path=EMBEDDINGS_CACHE_PATH, model_name=EMBEDDINGS_MODEL_NAME):
+        self.cache_path = cache_path
+        self.model_name = model_name
+
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.conn = sqlite3.connect(cache_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                content_hash TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (content_hash, model_name)
+            )
+        """)
+        self.conn.commit()
+
+
+    # Returns a dict {content_hash: vector} with the hashes found in the cache
+    def get_many(self, hashes):
+        found = {}
+        hashes = list(hashes)
+
+        # sqlite limits the number of bound parameters, so the lookup is done in slices
+        for start in range(0, len(hashes), 500):
+            hashes_slice = hashes[start:start + 500]
+            placeholders = ", ".join("?" for _ in hashes_slice)
+            rows = self.conn.execute(
+                f"SELECT content_hash, vector FROM embeddings WHERE model_name = ? AND content_hash IN ({placeholders})",
+                [self.model_name, *hashes_slice],
+            )
+            for row_hash, vector in rows:
+                found[row_hash] = np.frombuffer(vector, dtype=np.float32)
+
+        return found
+
+
+    # Stores a dict {content_hash: vector} in the cache
+    def set_many(self, vectors):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (content_hash, model_name, vector) VALUES (?, ?, ?)",
+            [(row_hash, self.model_name, np.asarray(vector, dtype=np.float32).tobytes()) for row_hash, vector in vectors.items()],
+        )
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+
+# Function for encoding a list of texts in batches.
+# With more than one worker, the sentence-transformers multi-process pool is used to spread the batches across CPU processes.
+def encode_texts(texts, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, pool=None):
+
+    if not texts:
+        return np.empty((0, embeddings_model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    if pool is not None:
+        vectors = embeddings_model.encode_multi_process(texts, pool, batch_size=batch_size)
+    else:
+        vectors = embeddings_model.encode(texts, batch_size=batch_size, show_progress_bar=False)
+
+    return np.asarray(vectors, dtype=np.float32)
+
+
+
+# Generator that adds the 'content_embeddings' field to each chunk, encoding them in batches.
+# The chunks are consumed from any iterable in buffers, so the stage can be placed in a streaming pipeline.
+# Chunks whose content is already in the cache are never re-embedded.
+def iter_embedded_chunks(chunks, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, num_workers=EMBEDDINGS_NUM_WORKERS, cache=None, buffer_size=None):
+
+    # Every worker should receive some full batches from each buffer
+    if buffer_size is None:
+        buffer_size = batch_size * max(num_workers, 1) * 4
+
+    pool = None
+    if num_workers > 1:
+        pool = embeddings_model.start_multi_process_pool(target_devices=["cpu"] * num_workers)
+
+    try:
+        chunks = iter(chunks)
+        while True:
+            buffer = list(islice(chunks, buffer_size))
+            if not buffer:
+                break
+
+            hashes = [content_hash(chunk["content"]) for chunk in buffer]
+            cached_vectors = cache.get_many(set(hashes)) if cache is not None else {}
+
+            # Encoding only the contents that are not cached. Duplicated contents are encoded once.
+            missing_hashes = list(dict.fromkeys(row_hash for row_hash in hashes if row_hash not in cached_vectors))
+            missing_texts = {row_hash: chunk["content"] for row_hash, chunk in zip(hashes, buffer) if row_hash in missing_hashes}
+
+            new_vectors = encode_texts([missing_texts[row_hash] for row_hash in missing_hashes], embeddings_model, batch_size=batch_size, pool=pool)
+            new_vectors = dict(zip(missing_hashes, new_vectors))
+
+            if cache is not None and new_vectors:
+                cache.set_many(new_vectors)
+
+            cached_vectors.update(new_vectors)
+
+            for row_hash, chunk in zip(hashes, buffer):
+                chunk["content_embeddings"] = cached_vectors[row_hash].tolist()
+                yield chunk
+
+    finally:
+        if pool is not None:
+            embeddings_model.stop_multi_process_pool(pool)
+
+
+
+# Function for embedding a list of chunks. Wrapper of iter_embedded_chunks with a progress bar.
+def embed_chunks(chunks, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, num_workers=EMBEDDINGS_NUM_WORKERS, cache=None):
+
+    return list(tqdm(iter_embedded_chunks(chunks, embeddings_model, batch_size=batch_size, num_workers=num_workers, cache=cache),
+                     total=len(chunks)))
+
+
+
+# Function for normalizing a user query before encoding it, so trivial variants share the same cache entry.
+# Case, surrounding punctuation (¿? ¡! .) and repeated whitespaces are ignored.
+def normalize_query(query):
+
+    normalized_query = unicodedata.normalize("NFC", query).lower()
+    normalized_query = re.sub(r'\s+', ' ', normalized_query)
+    normalized_query = normalized_query.strip(" ¿?¡!.,;:")
+
+    return normalized_query
+
+
+
+# Embedding service shared by the RAG and the UI. It loads the model once per process and keeps a bounded LRU cache
+# of query -> vector, with hit/miss counters.
+# It can be used as a drop-in replacement of the SentenceTransformer model in the search functions:
+# encode() of a single query goes through the cache, any other input is delegated to the model.
+class EmbeddingService:
+
+    def __init__(self, model_name=EMBEDDINGS_MODEL_NAME, cache_size=QUERY_EMBEDDINGS_CACHE_SIZE):
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.total_encode_time = 0.0
+        self.model_load_time = None
+        self._model = None
+
+        # Metrics of the last query encoded by each thread (each streamlit session runs in its own thread)
+        self.last_query = threading.local()
+
+
+    @property
+    def model(self):
+        with self.lock:
+            if self._model is None:
+                # Imported here so the module can be used without loading torch until a model is needed
+                from sentence_transformers import SentenceTransformer
+                start_time = time.perf_counter()
+                self._model = SentenceTransformer(self.model_name)
+                self.model_load_time = time.perf_counter() - start_time
+        return self._model
+
+
+    # Returns the vector of a query with the encoding time and whether it was cached
+    def lookup_or_encode_query(self, query):
+
+        start_time = time.perf_counter()
+        normalized_query = normalize_query(query)
+
+        with self.lock:
+            vector = self.cache.get(normalized_query)
+            if vector is not None:
+                self.cache.move_to_end(normalized_query)
+                self.hits += 1
+
+        cache_hit = vector is not None
+        if not cache_hit:
+            vector = np.asarray(self.model.encode(normalized_query), dtype=np.float32)
+            with self.lock:
+                self.misses += 1
+                self.cache[normalized_query] = vector
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        encode_time = time.perf_counter() - start_time
+        with self.lock:
+            self.total_encode_time += encode_time
+
+        return vector, encode_time, cache_hit
+
+
+    def encode_query(self, query):
+
+        vector, encode_time, cache_hit = self.lookup_or_encode_query(query)
+
+        self.last_query.encode_time = encode_time
+        self.last_query.cache_hit = cache_hit
+
+        return vector
+
+
+    # Async version of encode_query. The model runs in a worker thread, and the metrics are kept for the thread running the event loop.
+    async def aencode_query(self, query):
+
+        vector, encode_time, cache_hit = await asyncio.to_thread(self.lookup_or_encode_query, query)
+
+        self.last_query.encode_time = encode_time
+        self.last_query.cache_hit = cache_hit
+
+        return vector
+
+
+    def encode(self, sentences, **kwargs):
+        if isinstance(sentences, str) and not kwargs:
+            return self.encode_query(sentences)
+        return self.model.encode(sentences, **kwargs)
+
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+
+    # Metrics of the last query encoded by the current thread, to be stored with the answer
+    def last_query_metrics(self):
+        return {
+            "embedding_time": getattr(self.last_query, "encode_time", 0.0),
+            "embedding_cache_hit": getattr(self.last_query, "cache_hit", False),
+            "embedding_cold_start_time": self.model_load_time or 0.0,
+        }
+
+
+    def metrics(self):
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                "model_name": self.model_name,
+                "model_load_time": self.model_load_time,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests_count if requests_count else 0.0,
+                "avg_encode_time": self.total_encode_time / requests_count if requests_count else 0.0,
+                "cache_entries": len(self.cache),
+            }
+
+
+
+# Function for getting the embedding service of a model. The service (and its model) is created once per process.
+def get_embedding_service(model_name=EMBEDDINGS_MODEL_NAME):
+
+    with embedding_services_lock:
+        if model_name not in embedding_services:
+            embedding_services[model_name] = EmbeddingService(model_name)
+
+    return embedding_services[model_name]
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
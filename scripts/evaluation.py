@@ -0,0 +1,317 @@
+import os
+import re
+import glob
+import json
+import math
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from tqdm.auto import tqdm
+
+from dotenv import load_dotenv
+
+from elasticsearch import Elasticsearch
+
+from embeddings import encode_texts, get_embedding_service
+from rag import build_text_query, rrf_fuse, text_search, knn_search, hybrid_search, hybrid_search_rrf
+from vector_index import local_knn_search, local_hybrid_search_rrf
+from bm25 import local_text_search, bm25_hybrid_search_rrf
+
+
+
+
+# Default configuration of the retrieval evaluation, overridable from the environment.
+EVALUATION_CHECKPOINT_DIR = os.getenv("EVALUATION_CHECKPOINT_DIR", "../data/evaluation/")
+EVALUATION_BATCH_SIZE = int(os.getenv("EVALUATION_BATCH_SIZE", "50"))
+EVALUATION_NUM_WORKERS = int(os.getenv("EVALUATION_NUM_WORKERS", "4"))
+
+# Search functions of rag.py, used by the thread pool mode
+SEARCH_FUNCTIONS = {
+    "text": text_search,
+    "knn": knn_search,
+    "hybrid": hybrid_search,
+    "rrf": hybrid_search_rrf,
+    "local_knn": local_knn_search,
+    "local_rrf": local_hybrid_search_rrf,
+    "local_text": local_text_search,
+    "local_bm25_rrf": bm25_hybrid_search_rrf,
+}
+
+# Searches on the local vector and BM25 indexes, always run with the search functions since they can not be sent in a _msearch
+LOCAL_SEARCHES = {"local_knn", "local_rrf", "local_text", "local_bm25_rrf"}
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for loading the ground truth csv files (chunk_id;question). Each record keeps the name of its file.
+def load_ground_truth(paths):
+
+    ground_truth = {}
+    for path in paths:
+        name = os.path.basename(path).replace(".csv", "")
+        ground_truth[name] = pd.read_csv(path, sep=";").to_dict(orient="records")
+
+    return ground_truth
+
+
+
+# Custom function to calculate the hit-rate of a search
+def hit_rate(relevance_total):
+    return sum(True in line for line in relevance_total) / len(relevance_total)
+
+
+
+# Custom function to calculate the MRR (Mean Reciprocal Rank) of a search
+def mrr(relevance_total):
+
+    total_score = 0.0
+    for line in relevance_total:
+        for rank, relevant in enumerate(line):
+            if relevant:
+                total_score += 1 / (rank + 1)
+                break
+
+    return total_score / len(relevance_total)
+
+
+
+# Function for calculating the recall@k. Each question of the ground truth has a single relevant chunk.
+def recall_at_k(relevance_total, k):
+    return sum(True in line[:k] for line in relevance_total) / len(relevance_total)
+
+
+
+# Function for calculating the nDCG@k with binary relevance. With a single relevant chunk the ideal DCG is 1.
+def ndcg_at_k(relevance_total, k):
+
+    total_score = 0.0
+    for line in relevance_total:
+        total_score += sum(1 / math.log2(rank + 2) for rank, relevant in enumerate(line[:k]) if relevant)
+
+    return total_score / len(relevance_total)
+
+
+
+# Function for getting the retrieved chunk ids of a list of hits, without duplicates (the hybrid search can return a chunk twice)
+def get_retrieved_chunk_ids(hits):
+    return list(dict.fromkeys(hit["_source"]["chunk_id"] for hit in hits))
+
+
+
+# Function for building the _msearch bodies of a question. The knn searches use the question vector encoded beforehand.
+# Returns the bodies and a function that combines their hits into the results of the search.
+def build_msearch_bodies(search_name, question, query_vector, size, rank_window_size=20, rank_constant=60):
+
+    def knn_body(k):
+        return {"size": k, "knn": {"field": "content_embeddings", "query_vector": query_vector, "k": k}}
+
+    if search_name == "text":
+        return [build_text_query(question, size)], lambda hits_lists: hits_lists[0]
+
+    if query_vector is None:
+        raise ValueError(f"The {search_name} search needs the query vectors")
+
+    if search_name == "knn":
+        return [knn_body(size)], lambda hits_lists: hits_lists[0]
+
+    if search_name == "hybrid":
+        return [build_text_query(question, size), knn_body(size)], lambda hits_lists: hits_lists[0] + hits_lists[1]
+
+    if search_name == "rrf":
+        return ([build_text_query(question, rank_window_size), knn_body(rank_window_size)],
+                lambda hits_lists: rrf_fuse(hits_lists, size=size, k=rank_constant))
+
+    raise ValueError(f"Unknown search function: {search_name}")
+
+
+
+# Function for searching a batch of questions with a single _msearch request.
+# The text search does not use the query vectors, which are None when no vector search is evaluated.
+# Returns the retrieved chunk ids of each question.
+def msearch_batch(es_client, index_name, search_name, questions, query_vectors, size):
+
+    searches = []
+    combiners = []
+    bodies_per_question = []
+    for question, query_vector in zip(questions, query_vectors):
+        bodies, combine_hits = build_msearch_bodies(search_name, question, query_vector.tolist() if query_vector is not None else None, size)
+        for body in bodies:
+            searches.extend([{"index": index_name}, body])
+        combiners.append(combine_hits)
+        bodies_per_question.append(len(bodies))
+
+    responses = iter(es_client.msearch(searches=searches)["responses"])
+
+    retrieved_chunk_ids = []
+    for combine_hits, bodies_count in zip(combiners, bodies_per_question):
+        hits_lists = []
+        for _ in range(bodies_count):
+            response = next(responses)
+            if "error" in response:
+                raise RuntimeError(f"_msearch error: {response['error']}")
+            hits_lists.append(response["hits"]["hits"])
+        retrieved_chunk_ids.append(get_retrieved_chunk_ids(combine_hits(hits_lists)))
+
+    return retrieved_chunk_ids
+
+
+
+# Function for searching a batch of questions calling the search function of rag.py for each one.
+# hybrid_search has no size parameter, so it always retrieves 5 chunks from each search as in the RAG.
+def search_batch(es_client, index_name, search_name, questions, embeddings_model, size):
+
+    search_function = SEARCH_FUNCTIONS[search_name]
+    size_kwargs = {} if search_name == "hybrid" else {"size": size}
+
+    return [get_retrieved_chunk_ids(search_function(user_query=question, es_client=es_client, index=index_name, embeddings_model=embeddings_model,
+                                                    **size_kwargs))
+            for question in questions]
+
+
+
+# Checkpoint of an evaluation run. The retrieved chunk ids of each question are appended to a jsonl file as the batches
+# finish, so an interrupted run resumes from the questions not searched yet.
+class EvaluationCheckpoint:
+
+    def __init__(self, checkpoint_path, resume=True):
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+        self.results = {}
+
+        checkpoint_dir = os.path.dirname(checkpoint_path)
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        if not resume and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as checkpoint_file:
+                for line in checkpoint_file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.results[record["question_index"]] = record["retrieved_chunk_ids"]
+
+
+    def add(self, question_indexes, retrieved_chunk_ids):
+        with self.lock:
+            with open(self.checkpoint_path, "a", encoding="utf-8") as checkpoint_file:
+                for question_index, chunk_ids in zip(question_indexes, retrieved_chunk_ids):
+                    checkpoint_file.write(json.dumps({"question_index": question_index, "retrieved_chunk_ids": chunk_ids}) + "\n")
+                    self.results[question_index] = chunk_ids
+
+
+
+# Function for evaluating a search function on a ground truth.
+# The questions are encoded all at once and searched by batches in a thread pool, with a _msearch request per batch
+# (mode "msearch") or with the search functions of rag.py (mode "threads").
+def evaluate(ground_truth, search_name, es_client, index_name, embeddings_model, checkpoint, mode="msearch", size=10,
+             batch_size=EVALUATION_BATCH_SIZE, num_workers=EVALUATION_NUM_WORKERS, query_vectors=None):
+
+    if query_vectors is None:
+        query_vectors = [None] * len(ground_truth)
+
+    pending_indexes = [question_index for question_index in range(len(ground_truth)) if question_index not in checkpoint.results]
+    batches = [pending_indexes[start:start + batch_size] for start in range(0, len(pending_indexes), batch_size)]
+
+    def run_batch(question_indexes):
+        questions = [ground_truth[question_index]["question"] for question_index in question_indexes]
+        if mode == "msearch" and search_name not in LOCAL_SEARCHES:
+            retrieved_chunk_ids = msearch_batch(es_client, index_name, search_name, questions,
+                                                [query_vectors[question_index] for question_index in question_indexes], size)
+        else:
+            retrieved_chunk_ids = search_batch(es_client, index_name, search_name, questions, embeddings_model, size)
+        checkpoint.add(question_indexes, retrieved_chunk_ids)
+        return len(question_indexes)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        with tqdm(total=len(ground_truth), initial=len(ground_truth) - len(pending_indexes), desc=search_name) as progress_bar:
+            for future in as_completed([executor.submit(run_batch, batch) for batch in batches]):
+                progress_bar.update(future.result())
+
+    relevance_total = [[chunk_id == record["chunk_id"] for chunk_id in checkpoint.results[question_index]]
+                       for question_index, record in enumerate(ground_truth)]
+
+    return relevance_total
+
+
+
+# Function for calculating all the metrics of a relevance matrix
+def compute_metrics(relevance_total, cutoffs):
+
+    metrics = {"hit_rate": hit_rate(relevance_total), "mrr": mrr(relevance_total)}
+    for k in cutoffs:
+        metrics[f"recall@{k}"] = recall_at_k(relevance_total, k)
+    for k in cutoffs:
+        metrics[f"ndcg@{k}"] = ndcg_at_k(relevance_total, k)
+
+    return metrics
+
+
+
+# Function for getting the path of the checkpoint of a run
+def get_checkpoint_path(checkpoint_dir, ground_truth_name, index_name, search_name, mode, size):
+    run_name = re.sub(r"[^\w.-]", "_", f"{ground_truth_name}__{index_name}__{search_name}__{mode}__size{size}")
+    return os.path.join(checkpoint_dir, f"{run_name}.jsonl")
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+# Offline evaluation of the retrieval on the ground truth csv files.
+# Usage: python evaluation.py --search text knn hybrid rrf [--mode msearch|threads] [--no-resume] [--output ../tests/retrieval_evaluation.csv]
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Retrieval evaluation on the ground truth (hit rate, MRR, recall@k, nDCG@k)")
+    parser.add_argument("--ground-truth", nargs="+", default=sorted(glob.glob("../tests/*GroundTruth.csv")))
+    parser.add_argument("--index", default="messixpert_cosine")
+    parser.add_argument("--search", nargs="+", default=[name for name in SEARCH_FUNCTIONS if name not in LOCAL_SEARCHES], choices=list(SEARCH_FUNCTIONS))
+    parser.add_argument("--mode", default="msearch", choices=["msearch", "threads"])
+    parser.add_argument("--size", type=int, default=10, help="Number of chunks retrieved by each search")
+    parser.add_argument("--cutoffs", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--batch-size", type=int, default=EVALUATION_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=EVALUATION_NUM_WORKERS)
+    parser.add_argument("--checkpoint-dir", default=EVALUATION_CHECKPOINT_DIR)
+    parser.add_argument("--no-resume", action="store_true", help="Ignore the checkpoints of previous runs")
+    parser.add_argument("--output", default=None, help="Csv file where the metrics are saved")
+    args = parser.parse_args()
+
+    es_client = Elasticsearch("http://localhost:9200")
+    embeddings_model = get_embedding_service()
+
+    report = []
+    for ground_truth_name, ground_truth in load_ground_truth(args.ground_truth).items():
+
+        # All the questions are encoded at once, in batches. Without vector searches no vector is needed.
+        query_vectors = [None] * len(ground_truth)
+        if args.mode == "msearch" and set(args.search) & {"knn", "hybrid", "rrf"}:
+            query_vectors = encode_texts([record["question"] for record in ground_truth], embeddings_model)
+
+        for search_name in args.search:
+            checkpoint = EvaluationCheckpoint(get_checkpoint_path(args.checkpoint_dir, ground_truth_name, args.index, search_name, args.mode, args.size),
+                                              resume=not args.no_resume)
+            relevance_total = evaluate(ground_truth, search_name, es_client, args.index, embeddings_model, checkpoint, mode=args.mode,
+                                       size=args.size, batch_size=args.batch_size, num_workers=args.workers, query_vectors=query_vectors)
+            report.append({"ground_truth": ground_truth_name, "search": search_name, "questions": len(ground_truth),
+                           **compute_metrics(relevance_total, args.cutoffs)})
+
+    report_df = pd.DataFrame(report)
+    print(report_df.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+
+    if args.output:
+        report_df.to_csv(args.output, sep=";", index=False)
@@ -0,0 +1,192 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch.helpers import scan, streaming_bulk
+
+
+
+
+# Default configuration of the bulk indexing, overridable from the environment.
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_NUM_WORKERS = int(os.getenv("BULK_NUM_WORKERS", "2"))
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "5"))
+BULK_DEAD_LETTER_PATH = os.getenv("BULK_DEAD_LETTER_PATH", "../data/dead_letter/bulk_failures.jsonl")
+
+# Index type of the content_embeddings field (hnsw, int8_hnsw, int4_hnsw, flat, int8_flat or int4_flat).
+# Empty for the elasticsearch default, int8_hnsw for float vectors since 8.14.
+ES_VECTOR_INDEX_TYPE = os.getenv("ES_VECTOR_INDEX_TYPE", "")
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for getting the index settings for the vectorDB.
+# With a quantized vector_index_type (int8/int4) the HNSW graph is built on the quantized vectors, which are the ones kept
+# in memory, while the float vectors stay on disk for rescoring.
+def get_index_settings(vector_index_type=ES_VECTOR_INDEX_TYPE):
+
+    index_settings_cosine = {
+        "settings": {
+            "number_of_shards": 1,
+            "number_of_replicas": 0
+        },
+        "mappings": {
+            "properties": {
+                "content": {"type": "text"},
+                "headers_concat": {"type": "text"},
+                "chunk_size": {"type": "integer"},
+                "source_url": {"type": "text", "fields": {"keyword": {"type": "keyword"}}} ,
+                "content_type": {"type": "text"} ,
+                "ingestion_date": {"type": "date"} ,
+                "chunk_id": {"type": "keyword"} ,
+                "content_hash": {"type": "keyword"} ,
+                "page_number": {"type": "integer"} ,
+                "content_embeddings": {"type": "dense_vector", "dims": 384, "index": True, "similarity": "cosine"},
+            }
+        }
+    }
+
+    if vector_index_type:
+        index_settings_cosine["mappings"]["properties"]["content_embeddings"]["index_options"] = {"type": vector_index_type}
+
+    return index_settings_cosine
+
+
+
+# Function for building the bulk actions from the chunks.
+# The chunk_id is used as document id, so a failed document can be traced from the dead-letter file.
+def generate_bulk_actions(chunks, index_name):
+    for chunk in chunks:
+        action = {"_op_type": "index", "_index": index_name, "_source": chunk}
+        if chunk.get("chunk_id"):
+            action["_id"] = chunk["chunk_id"]
+        yield action
+
+
+
+# Function for building the bulk delete actions of a list of chunk ids.
+def generate_delete_actions(chunk_ids, index_name):
+    for chunk_id in chunk_ids:
+        yield {"_op_type": "delete", "_index": index_name, "_id": chunk_id}
+
+
+
+# Function for checking if a text field has a keyword subfield in every concrete index of an index name (or alias).
+def has_keyword_subfield(es_client, index_name, field):
+
+    mappings = es_client.indices.get_mapping(index=index_name)
+
+    return all("keyword" in mappings[name]["mappings"].get("properties", {}).get(field, {}).get("fields", {}) for name in mappings)
+
+
+
+# Function for getting the ids of the chunks already indexed for a source url.
+# The indexes created before source_url had a keyword subfield are searched with a phrase on the text field instead,
+# keeping only the hits with the exact url.
+def get_indexed_chunk_ids(es_client, index_name, source_url):
+
+    if not es_client.indices.exists(index=index_name):
+        return set()
+
+    if has_keyword_subfield(es_client, index_name, "source_url"):
+        query = {"query": {"term": {"source_url.keyword": source_url}}}
+        return {hit["_id"] for hit in scan(es_client, index=index_name, query=query, _source=False)}
+
+    query = {"query": {"match_phrase": {"source_url": source_url}}}
+
+    return {hit["_id"] for hit in scan(es_client, index=index_name, query=query, _source=["source_url"])
+            if hit["_source"].get("source_url") == source_url}
+
+
+
+# Context manager that disables the refresh of the index during a bulk load, and restores the previous value afterwards.
+# The index name can be an alias: the settings are returned by concrete index, and each one gets back its own value.
+class RefreshDisabled:
+
+    def __init__(self, es_client, index_name):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.previous_refresh_intervals = {}
+
+    def __enter__(self):
+        settings = self.es_client.indices.get_settings(index=self.index_name)
+        self.previous_refresh_intervals = {name: settings[name]["settings"]["index"].get("refresh_interval") for name in settings}
+        self.es_client.indices.put_settings(index=self.index_name, settings={"index": {"refresh_interval": "-1"}})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # None resets the setting to the elasticsearch default
+        for name, refresh_interval in self.previous_refresh_intervals.items():
+            self.es_client.indices.put_settings(index=name, settings={"index": {"refresh_interval": refresh_interval}})
+        self.es_client.indices.refresh(index=self.index_name)
+        return False
+
+
+
+# Function for indexing documents with the _bulk API.
+# Several workers consume the same stream of actions, each one sending bulk requests of chunk_size documents.
+# Since the actions are pulled lazily, no more than chunk_size documents per worker are held in memory (back-pressure).
+# Rejections with status 429 are retried with exponential backoff, and the rest of failures are written to the dead-letter file.
+def bulk_index(es_client, actions, chunk_size=BULK_CHUNK_SIZE, num_workers=BULK_NUM_WORKERS, max_retries=BULK_MAX_RETRIES,
+               initial_backoff=2, max_backoff=60, dead_letter_path=BULK_DEAD_LETTER_PATH):
+
+    actions = iter(actions)
+    actions_lock = threading.Lock()
+    results_lock = threading.Lock()
+    results = {"indexed": 0, "failed": 0}
+
+    dead_letter_dir = os.path.dirname(dead_letter_path)
+    if dead_letter_dir:
+        os.makedirs(dead_letter_dir, exist_ok=True)
+
+    # Thread-safe generator over the shared actions stream
+    def next_actions():
+        while True:
+            with actions_lock:
+                action = next(actions, None)
+            if action is None:
+                return
+            yield action
+
+    def worker(dead_letter_file):
+        for ok, item in streaming_bulk(es_client, next_actions(), chunk_size=chunk_size, max_retries=max_retries,
+                                       initial_backoff=initial_backoff, max_backoff=max_backoff,
+                                       raise_on_error=False, raise_on_exception=False, yield_ok=True):
+            with results_lock:
+                if ok:
+                    results["indexed"] += 1
+                else:
+                    results["failed"] += 1
+                    dead_letter_file.write(json.dumps(item, default=str, ensure_ascii=False) + "\n")
+
+    with open(dead_letter_path, "a", encoding="utf-8") as dead_letter_file:
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+            futures = [executor.submit(worker, dead_letter_file) for _ in range(max(num_workers, 1))]
+            for future in futures:
+                future.result()
+
+    return results
+
+
+
+# Function for bulk indexing the chunks in an index, with the refresh disabled during the load.
+def bulk_index_chunks(es_client, index_name, chunks, chunk_size=BULK_CHUNK_SIZE, num_workers=BULK_NUM_WORKERS, max_retries=BULK_MAX_RETRIES,
+                      dead_letter_path=BULK_DEAD_LETTER_PATH):
+
+    with RefreshDisabled(es_client, index_name):
+        results = bulk_index(es_client, generate_bulk_actions(chunks, index_name), chunk_size=chunk_size, num_workers=num_workers,
+                             max_retries=max_retries, dead_letter_path=dead_letter_path)
+
+    return results
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
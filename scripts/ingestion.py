@@ -1,23 +1,37 @@
 import os
 import re
+import json
 import time
+import hashlib
+import argparse
 from io import StringIO
+from pathlib import Path
+from html import escape
+from html.parser import HTMLParser
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor
 
 from dotenv import load_dotenv
 
 import pandas as pd
 
-from tqdm.auto import tqdm
-
 import requests
 from bs4 import BeautifulSoup
 
+from PyPDF2 import PdfReader
+
 from sentence_transformers import SentenceTransformer
 
 import tiktoken
 
 from elasticsearch import Elasticsearch
 
+from embeddings import EMBEDDINGS_MODEL_NAME, EMBEDDINGS_BATCH_SIZE, EMBEDDINGS_NUM_WORKERS, EmbeddingCache, content_hash, embed_chunks, iter_embedded_chunks
+from token_counter import TokenCounter
+from vector_index import build_vector_index, get_vector_index_dir
+from bm25 import build_bm25_index, get_bm25_index_dir
+from indexing import (BULK_CHUNK_SIZE, BULK_NUM_WORKERS, BULK_DEAD_LETTER_PATH, RefreshDisabled, get_index_settings, generate_bulk_actions,
+                      generate_delete_actions, get_indexed_chunk_ids, bulk_index, bulk_index_chunks)
 
 
 
@@ -30,20 +44,60 @@ from elasticsearch import Elasticsearch
 
 
 
+# Function for getting the raw html filepath of a wikipedia page.
+# The host is part of the filename, so the same page of two languages (es/en wiki/Lionel_Messi) gets different files.
+def get_raw_file_path(url, raw_data_filepath='../data/raw/'):
+
+    raw_data_filename = re.search(r'//([^/]+)/(wiki/.*)', url).expand(r'\1_\2').replace('/', '_')
+
+    return f'{raw_data_filepath}{raw_data_filename}.html'
+
+
+
 # Function for scrapping any wikipedia page and save the raw html data
 def scrape_wikipedia_page(url,raw_data_filepath='../data/raw/'):
 
-    response = requests.get(url)
+    html_content, _ = scrape_wikipedia_page_if_changed(url, raw_data_filepath=raw_data_filepath, use_cache=False)
+
+    return html_content
+
+
+
+# Function for scrapping a wikipedia page only if it changed since the last scrapping.
+# The ETag and Last-Modified headers of the last response are stored next to the raw html, and sent back as a conditional request.
+# If the server answers 304 (Not Modified), the cached raw html is returned and the page is flagged as unchanged.
+# A pooled requests.Session can be passed for reusing the connections between pages.
+def scrape_wikipedia_page_if_changed(url, raw_data_filepath='../data/raw/', use_cache=True, session=None):
 
-    raw_data_filename = re.search(r'wiki/(.*)', url).group().replace('/', '_')
-    raw_file_path = f'{raw_data_filepath}{raw_data_filename}.html'
+    raw_file_path = get_raw_file_path(url, raw_data_filepath)
+    metadata_file_path = f'{raw_file_path}.meta.json'
 
-    os.makedirs('data/raw', exist_ok=True)
+    request_headers = {}
+    if use_cache and os.path.exists(raw_file_path) and os.path.exists(metadata_file_path):
+        with open(metadata_file_path, 'r', encoding='utf-8') as file:
+            metadata = json.load(file)
+        if metadata.get('etag'):
+            request_headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            request_headers['If-Modified-Since'] = metadata['last_modified']
+
+    response = (session or requests).get(url, headers=request_headers)
+
+    if response.status_code == 304:
+        with open(raw_file_path, 'r', encoding='utf-8') as file:
+            return file.read(), False
+
+    response.raise_for_status()
+
+    os.makedirs(raw_data_filepath, exist_ok=True)
     with open(raw_file_path, 'w', encoding='utf-8') as file:
         file.write(response.text)
 
+    with open(metadata_file_path, 'w', encoding='utf-8') as file:
+        json.dump({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, file)
+
 
-    return response.text
+    return response.text, True
 
 
 
@@ -61,6 +115,167 @@ def scrape_wikipedia_html(html_content):
 
 
 
+# Element extracted by the streaming parser. It exposes the same interface used by the chunker on the BeautifulSoup tags:
+# the tag name, the text, and the raw html when converted to string (only kept for the tables).
+class StreamedElement:
+
+    def __init__(self, name, text, html=""):
+        self.name = name
+        self.text = text
+        self.html = html
+
+    def __str__(self):
+        return self.html
+
+
+
+# SAX-style parser over the 'mw-parser-output' div of a wikipedia page.
+# It is fed with blocks of html and only keeps the elements that are still open, so the memory does not depend on the page size.
+# The elements are emitted in the same document order as content.find_all(['p', 'h1', ..., 'table']), nested ones included.
+class WikipediaContentParser(HTMLParser):
+
+    captured_tags = ('p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table')
+
+    # Tags that implicitly close an open paragraph
+    paragraph_closing_tags = ('p', 'div', 'table', 'ul', 'ol', 'dl', 'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.content_depth = 0          # div depth inside the mw-parser-output div (0 = outside)
+        self.content_done = False       # Only the first mw-parser-output div is processed, as soup.find does
+        self.ignored_depth = 0          # Inside <style> or <script>, which are not part of the text
+        self.open_elements = []         # Stack of [start_index, name, text_parts, html_parts]
+        self.pending_elements = []      # Closed elements waiting for their enclosing elements to be closed
+        self.ready_elements = []        # Elements ready to be yielded, in document order
+        self.start_counter = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.content_done:
+            return
+
+        if self.content_depth == 0:
+            if tag == 'div' and 'mw-parser-output' in (dict(attrs).get('class') or '').split():
+                self.content_depth = 1
+            return
+
+        if tag in self.paragraph_closing_tags and self.open_elements and self.open_elements[-1][1] == 'p':
+            self.close_element('p')
+
+        if tag == 'div':
+            self.content_depth += 1
+        if tag in ('style', 'script'):
+            self.ignored_depth += 1
+
+        # The raw html is only needed for the tables, which are parsed with pandas
+        for element in self.open_elements:
+            if element[1] == 'table':
+                element[3].append(self.get_starttag_text())
+
+        if tag in self.captured_tags:
+            html_parts = [self.get_starttag_text()] if tag == 'table' else None
+            self.open_elements.append([self.start_counter, tag, [], html_parts])
+            self.start_counter += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if self.content_depth == 0 or self.content_done:
+            return
+        for element in self.open_elements:
+            if element[1] == 'table':
+                element[3].append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if self.content_depth == 0 or self.content_done:
+            return
+
+        for element in self.open_elements:
+            if element[1] == 'table':
+                element[3].append(f'</{tag}>')
+
+        if tag in ('style', 'script') and self.ignored_depth:
+            self.ignored_depth -= 1
+
+        if tag in self.captured_tags and any(element[1] == tag for element in self.open_elements):
+            self.close_element(tag)
+
+        elif tag == 'div':
+            self.content_depth -= 1
+            if self.content_depth == 0:
+                # End of the content: closing whatever was left open
+                while self.open_elements:
+                    self.close_element(self.open_elements[-1][1])
+                self.content_done = True
+
+    def handle_data(self, data):
+        if self.content_depth == 0 or self.content_done:
+            return
+        for element in self.open_elements:
+            if self.ignored_depth == 0:
+                element[2].append(data)
+            if element[1] == 'table':
+                element[3].append(escape(data, quote=False))
+
+    # Closing the innermost open element with the given tag (and any element left open inside it)
+    def close_element(self, tag):
+        while self.open_elements:
+            start_index, name, text_parts, html_parts = self.open_elements.pop()
+            self.pending_elements.append((start_index, StreamedElement(name, ''.join(text_parts), ''.join(html_parts or []))))
+            if name == tag:
+                break
+
+        # When no element is open anymore, the pending ones can be emitted in document order
+        if not self.open_elements:
+            self.pending_elements.sort(key=lambda pending: pending[0])
+            self.ready_elements.extend(element for _, element in self.pending_elements)
+            self.pending_elements = []
+
+    def pop_ready_elements(self):
+        ready_elements = self.ready_elements
+        self.ready_elements = []
+        return ready_elements
+
+
+
+# Generator of the wikipedia content elements (headers, paragraphs and tables) from an iterable of html text blocks.
+# Streaming alternative to scrape_wikipedia_html: the full tree is never built.
+def iter_wikipedia_elements(html_blocks):
+
+    parser = WikipediaContentParser()
+
+    for html_block in html_blocks:
+        parser.feed(html_block)
+        yield from parser.pop_ready_elements()
+
+    parser.close()
+    yield from parser.pop_ready_elements()
+
+
+
+# Generator of the text blocks of a raw html file
+def iter_html_file_blocks(raw_file_path, block_size=64 * 1024):
+
+    with open(raw_file_path, 'r', encoding='utf-8') as file:
+        while html_block := file.read(block_size):
+            yield html_block
+
+
+
+# Generator of the text blocks of a wikipedia page, downloaded as a stream.
+# The raw html is saved to data/raw while it is downloaded, as scrape_wikipedia_page does.
+def iter_wikipedia_page_blocks(url, raw_data_filepath='../data/raw/', block_size=64 * 1024):
+
+    os.makedirs(raw_data_filepath, exist_ok=True)
+
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.encoding = response.encoding or 'utf-8'
+
+        with open(get_raw_file_path(url, raw_data_filepath), 'w', encoding='utf-8') as file:
+            for html_block in response.iter_content(chunk_size=block_size, decode_unicode=True):
+                file.write(html_block)
+                yield html_block
+
+
+
 # Function for standard text cleaning. Cleaning special characters and normalizing the text.
 def clean_text(text):
 
@@ -73,12 +288,27 @@ def clean_text(text):
 
 
 # Function for counting tokens in a text
+# The encoding can be a tiktoken encoding or a TokenCounter (cached or estimated counts).
 def count_tokens(text, encoding):
     """Función para contar el número de tokens en un texto."""
+    if isinstance(encoding, TokenCounter):
+        return encoding.count(text)
     return len(encoding.encode(text))
 
 
 
+# Function for confirming with the exact encoder the token counts that are close to the max_chunk_size boundary.
+# It only has effect with a TokenCounter in "estimate" mode, where the estimation could change the chunking decision.
+def refine_token_counts(current_chunk, current_token_count, chunk_text, tokens_in_chunk, max_chunk_size, encoding):
+
+    if isinstance(encoding, TokenCounter) and encoding.is_near_boundary(current_token_count + tokens_in_chunk, max_chunk_size):
+        current_token_count = encoding.count_exact(current_chunk.strip()) if current_chunk else 0
+        tokens_in_chunk = encoding.count_exact(chunk_text)
+
+    return current_token_count, tokens_in_chunk
+
+
+
 # Aux function for processing the headers when chunking an HTML.
 # The headers will be used as an important feature to store with the chunk content for improving the RAG accuracy-
 def chunking_processing_HTML_headers(elem, current_headers):
@@ -104,6 +334,7 @@ def chunking_processing_HTML_paragraphs(paragraph, current_headers, current_chun
     chunk_text = paragraph
 
     tokens_in_chunk = count_tokens(chunk_text, encoding)
+    current_token_count, tokens_in_chunk = refine_token_counts(current_chunk, current_token_count, chunk_text, tokens_in_chunk, max_chunk_size, encoding)
     
     if current_token_count + tokens_in_chunk <= max_chunk_size:
         current_chunk += chunk_text + " "
@@ -139,6 +370,7 @@ def chunking_processing_HTML_tables(table_html, current_headers, current_chunk,
         chunk_text = table_text
 
         tokens_in_chunk = count_tokens(chunk_text, encoding)
+        current_token_count, tokens_in_chunk = refine_token_counts(current_chunk, current_token_count, chunk_text, tokens_in_chunk, max_chunk_size, encoding)
 
         # Handling the chunk with the objective of mantaining the table in a single chunk.
         if current_chunk and current_token_count + tokens_in_chunk > max_chunk_size:
@@ -173,22 +405,38 @@ def chunking_processing_HTML_tables(table_html, current_headers, current_chunk,
         current_chunk = ""  # Reset the chunk after adding the table
         current_token_count = 0
 
-    except ValueError:
+    except ValueError as e:
+        # A table that can not be parsed is skipped, instead of indexing a chunk without its content
         headers_concat = " > ".join([current_headers[f'h{i}'] for i in range(1, 7) if current_headers[f'h{i}']])
-        chunks.append({'content': 'Error processing the table', 'headers_concat': headers_concat})
+        print(f"Skipping a table that could not be processed under '{headers_concat}': {e}")
 
     return current_chunk, current_token_count, chunks, headers_concat, chunk_incremental_counter
     
 
 
-    # Function for processing an html and generating chunks in an strategic way based on the best practices.
+# Function for processing an html and generating chunks in an strategic way based on the best practices.
 # It could recieve the max_chunk_size parameter. If a chunk is going to be larger than it, then the chunk will be splitted.
+# With stable_chunk_ids=True the chunk_id is derived from the source url, the headers and the content hash (see assign_stable_chunk_ids)
+# With prefetch_token_counts=True and a TokenCounter as encoding, all the paragraphs are batch-encoded up front.
+def create_chunks_with_headers(elements, source_url, encoding, max_chunk_size=500, stable_chunk_ids=False, prefetch_token_counts=False):
+
+    if prefetch_token_counts and isinstance(encoding, TokenCounter):
+        elements = list(elements)
+        encoding.prefetch([clean_text(elem.text) for elem in elements if elem.name == 'p'])
+
+    return list(iter_chunks_with_headers(elements, source_url, encoding, max_chunk_size=max_chunk_size, stable_chunk_ids=stable_chunk_ids))
+
+
 
-def create_chunks_with_headers(elements, source_url, encoding, max_chunk_size=500):
+# Generator version of create_chunks_with_headers.
+# Each chunk is yielded as soon as it is closed, so it can consume a stream of elements (see iter_wikipedia_elements)
+# and feed the embeddings and indexing stages while the page is still being parsed.
+def iter_chunks_with_headers(elements, source_url, encoding, max_chunk_size=500, stable_chunk_ids=False):
 
     # Generating the variables used to store with the chunk content.
     ingestion_timestamp = time.strftime("%Y%m%d%H%M%S")
     chunk_incremental_counter = 0
+    seen_chunk_ids = {}
 
 
     ################################################
@@ -221,14 +469,263 @@ def create_chunks_with_headers(elements, source_url, encoding, max_chunk_size=50
                                                                                                                                     ingestion_timestamp, chunk_incremental_counter,
                                                                                                                                     source_url, encoding)
 
+        # Yielding the chunks closed by this element
+        for chunk in chunks:
+            if stable_chunk_ids:
+                assign_stable_chunk_id(chunk, source_url, seen_chunk_ids)
+            yield chunk
+        chunks = []
+
     # Adding the last chunk
     if current_chunk:
-        chunks.append({'content': current_chunk.strip(), 'headers_concat': headers_concat})
+        chunks.append({
+            "content": current_chunk.strip(),
+            "headers_concat": headers_concat,
+            "chunk_size": current_token_count,
+            "source_url": source_url,
+            "content_type": "paragraph",
+            "ingestion_date": ingestion_timestamp,
+            "chunk_id": f"{ingestion_timestamp}_{chunk_incremental_counter:06d}"
+            })
+
+    for chunk in chunks:
+        if stable_chunk_ids:
+            assign_stable_chunk_id(chunk, source_url, seen_chunk_ids)
+        yield chunk
+
+
+
+# Function for replacing the timestamp chunk id of a chunk with an id derived from the source url, the headers and the content hash.
+# The same content under the same headers of the same page always gets the same id, so re-ingestions can be diffed.
+# Repeated contents in the same page get an occurrence suffix (tracked in seen_ids) for keeping the ids unique.
+def assign_stable_chunk_id(chunk, source_url, seen_ids):
+
+    chunk_content_hash = content_hash(chunk["content"])
+    identity = f"{source_url}\n{chunk.get('headers_concat', '')}\n{chunk_content_hash}"
+    chunk_id = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:24]
+
+    occurrence = seen_ids.get(chunk_id, 0)
+    seen_ids[chunk_id] = occurrence + 1
+
+    chunk["chunk_id"] = chunk_id if occurrence == 0 else f"{chunk_id}_{occurrence}"
+    chunk["content_hash"] = chunk_content_hash
+    chunk.setdefault("source_url", source_url)
+
+    return chunk
+
+
+
+# Function for assigning stable chunk ids to a list of chunks of the same page.
+def assign_stable_chunk_ids(chunks, source_url):
+
+    seen_ids = {}
+
+    for chunk in chunks:
+        assign_stable_chunk_id(chunk, source_url, seen_ids)
 
     return chunks
 
 
 
+# Function for comparing the new chunks of a source with the chunk ids already indexed for it.
+# Returns the chunks that should be upserted and the ids that should be deleted.
+def diff_chunks(chunks, indexed_chunk_ids):
+
+    new_chunk_ids = {chunk["chunk_id"] for chunk in chunks}
+
+    chunks_to_upsert = [chunk for chunk in chunks if chunk["chunk_id"] not in indexed_chunk_ids]
+    chunk_ids_to_delete = sorted(set(indexed_chunk_ids) - new_chunk_ids)
+
+    return chunks_to_upsert, chunk_ids_to_delete
+
+
+
+# Function for the incremental ingestion of a wikipedia page.
+# Unchanged pages (HTTP 304) are skipped entirely. Otherwise only the new or modified chunks are embedded and upserted,
+# and the chunks that disappeared from the page are deleted from the index.
+def ingest_incremental(url, es_client, index_name, embeddings_model, encoding, embeddings_cache=None, max_chunk_size=500,
+                       raw_data_filepath='../data/raw/', force=False):
+
+    html_content, changed = scrape_wikipedia_page_if_changed(url, raw_data_filepath=raw_data_filepath)
+
+    if not changed and not force:
+        return {"source_url": url, "skipped": True, "upserted": 0, "deleted": 0, "failed": 0}
+
+    chunks = create_chunks_with_headers(scrape_wikipedia_html(html_content), source_url=url, encoding=encoding,
+                                        max_chunk_size=max_chunk_size, stable_chunk_ids=True)
+
+    indexed_chunk_ids = get_indexed_chunk_ids(es_client, index_name, url)
+    chunks_to_upsert, chunk_ids_to_delete = diff_chunks(chunks, indexed_chunk_ids)
+
+    chunks_to_upsert = embed_chunks(chunks_to_upsert, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE,
+                                    num_workers=EMBEDDINGS_NUM_WORKERS, cache=embeddings_cache)
+
+    actions = chain(generate_bulk_actions(chunks_to_upsert, index_name), generate_delete_actions(chunk_ids_to_delete, index_name))
+
+    with RefreshDisabled(es_client, index_name):
+        bulk_results = bulk_index(es_client, actions)
+
+    return {"source_url": url, "skipped": False, "upserted": len(chunks_to_upsert), "deleted": len(chunk_ids_to_delete),
+            "failed": bulk_results["failed"]}
+
+
+
+# Function for normalizing a pdf line when looking for repeated headers/footers.
+# Digits are masked, so lines like "14/9/24, 15:51 ... 3/80" match across pages.
+def normalize_pdf_line(line):
+    return re.sub(r'\d+', '#', clean_text(line))
+
+
+
+# Function for getting the prefixes and suffixes of a normalized pdf line, of at least min_length characters
+def get_pdf_line_affixes(normalized_line, min_length=12):
+    return {(kind, affix) for length in range(min_length, len(normalized_line) + 1)
+            for kind, affix in (("prefix", normalized_line[:length]), ("suffix", normalized_line[-length:]))}
+
+
+
+# Function for building the regex of a normalized header/footer, matching any digits where it has "#" and any whitespace
+def get_pdf_affix_pattern(affix):
+    return ''.join(r'\d+' if char == '#' else r'\s+' if char == ' ' else re.escape(char) for char in affix)
+
+
+
+# Function for removing the repeated header/footer from a pdf line. PyPDF2 often glues the header to the previous text line
+# (e.g. "2008-09: Triplete histórico14/9/24, 15:51 Lionel Messi - Wikipedia..."), so the repeated prefixes and suffixes of the
+# line are removed, not only the whole line. The most repeated affix is removed, and the longest one between the equally repeated.
+def strip_pdf_line_affixes(line, repeated_affixes):
+
+    line = clean_text(line)
+
+    for kind in ("suffix", "prefix"):
+        normalized_line = normalize_pdf_line(line)
+        matches = [(repeated_affixes[key], len(key[1]), key[1]) for key in get_pdf_line_affixes(normalized_line, min_length=1)
+                   if key[0] == kind and key in repeated_affixes]
+        if not matches:
+            continue
+        pattern = get_pdf_affix_pattern(max(matches)[2])
+        line = re.sub(f'{pattern}$', '', line).strip() if kind == "suffix" else re.sub(f'^{pattern}', '', line).strip()
+
+    return line
+
+
+
+# Function for removing the repeated headers/footers at the edges of a pdf page
+def strip_pdf_page_lines(page_text, repeated_affixes, edge_lines=3):
+
+    lines = [line for line in page_text.splitlines() if line.strip()]
+
+    for position in sorted(set(range(min(edge_lines, len(lines)))) | set(range(max(len(lines) - edge_lines, 0), len(lines)))):
+        lines[position] = strip_pdf_line_affixes(lines[position], repeated_affixes)
+
+    return clean_text(' '.join(lines))
+
+
+
+# Function executed in the process pool: extraction of the text of some pages of a pdf.
+# Each task opens its own reader, so only the requested pages are loaded in the worker.
+def extract_pdf_pages(pdf_path, page_indexes, repeated_affixes=None, edge_lines=3, strip=True):
+
+    reader = PdfReader(pdf_path)
+
+    pages = []
+    for page_index in page_indexes:
+        page_text = reader.pages[page_index].extract_text() or ''
+        pages.append((page_index, strip_pdf_page_lines(page_text, repeated_affixes or {}, edge_lines) if strip else page_text))
+
+    return pages
+
+
+
+# Function for detecting the headers/footers of a pdf, as the prefixes and suffixes of the edge lines (whole lines included)
+# repeated in most of the pages. Returns the ratio of pages of each repeated ("prefix" or "suffix", normalized text).
+# Only a sample of pages spread along the document is extracted for the detection.
+def detect_repeated_pdf_lines(pdf_path, executor, sample_size=30, edge_lines=3, min_ratio=0.6, min_affix_length=12):
+
+    num_pages = len(PdfReader(pdf_path).pages)
+    sample_indexes = sorted({int(i * num_pages / min(sample_size, num_pages)) for i in range(min(sample_size, num_pages))})
+
+    sample_pages = executor.submit(extract_pdf_pages, pdf_path, sample_indexes, strip=False).result()
+
+    # With a single page nothing can be considered repeated
+    if len(sample_pages) < 2:
+        return {}
+
+    affix_counts = {}
+    for _, page_text in sample_pages:
+        lines = [line for line in page_text.splitlines() if line.strip()]
+        page_affixes = set()
+        for line in lines[:edge_lines] + lines[-edge_lines:]:
+            page_affixes |= get_pdf_line_affixes(normalize_pdf_line(line), min_affix_length)
+        for affix in page_affixes:
+            affix_counts[affix] = affix_counts.get(affix, 0) + 1
+
+    return {affix: count / len(sample_pages) for affix, count in affix_counts.items() if count / len(sample_pages) >= min_ratio}
+
+
+
+# Generator of page-chunks of a pdf, with the same schema as the html chunks.
+# The pages are extracted in parallel by a process pool, in batches of pages_per_task pages. Only a window of batches
+# is in flight at the same time, so the whole document is never held in memory, and the page-chunks are yielded in order.
+# The chunk ids follow the "<prefix>_Page-<n>" format of the page-chunk ground truth (tests/LionelMessiRAGSource-PageChunk-*.csv).
+def iter_pdf_page_chunks(pdf_path, source_url, encoding, chunk_id_prefix=None, num_workers=os.cpu_count(), pages_per_task=8, edge_lines=3):
+
+    ingestion_timestamp = time.strftime("%Y%m%d%H%M%S")
+    document_title = os.path.splitext(os.path.basename(pdf_path))[0]
+    chunk_id_prefix = chunk_id_prefix or re.sub(r'\W+', '_', document_title).strip('_')
+
+    num_pages = len(PdfReader(pdf_path).pages)
+    page_batches = [range(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        repeated_affixes = detect_repeated_pdf_lines(pdf_path, executor, edge_lines=edge_lines)
+
+        pending_batches = []
+        page_batches = iter(page_batches)
+
+        # Keeping twice as many batches as workers in flight
+        for page_batch in islice(page_batches, num_workers * 2):
+            pending_batches.append(executor.submit(extract_pdf_pages, pdf_path, list(page_batch), repeated_affixes, edge_lines))
+
+        while pending_batches:
+            pages = pending_batches.pop(0).result()
+
+            next_batch = next(page_batches, None)
+            if next_batch is not None:
+                pending_batches.append(executor.submit(extract_pdf_pages, pdf_path, list(next_batch), repeated_affixes, edge_lines))
+
+            for page_index, page_text in pages:
+                if not page_text:
+                    continue
+                yield {
+                    "content": page_text,
+                    "headers_concat": f"{document_title} > Page {page_index + 1}",
+                    "chunk_size": count_tokens(page_text, encoding),
+                    "source_url": source_url,
+                    "content_type": "page",
+                    "ingestion_date": ingestion_timestamp,
+                    "chunk_id": f"{chunk_id_prefix}_Page-{page_index + 1}",
+                    "page_number": page_index + 1,
+                    }
+
+
+
+# Function for the streaming ingestion of a wikipedia page.
+# Parsing, chunking, embedding and bulk indexing are chained generators: the chunks are indexed in small bulks
+# while the rest of the page is still being parsed, and the memory stays flat whatever the page size.
+def ingest_streaming(html_blocks, source_url, es_client, index_name, embeddings_model, encoding, embeddings_cache=None, max_chunk_size=500,
+                     stable_chunk_ids=False, bulk_chunk_size=100):
+
+    elements = iter_wikipedia_elements(html_blocks)
+    chunks = iter_chunks_with_headers(elements, source_url, encoding, max_chunk_size=max_chunk_size, stable_chunk_ids=stable_chunk_ids)
+    embedded_chunks = iter_embedded_chunks(chunks, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, num_workers=EMBEDDINGS_NUM_WORKERS,
+                                           cache=embeddings_cache, buffer_size=EMBEDDINGS_BATCH_SIZE)
+
+    return bulk_index_chunks(es_client, index_name, embedded_chunks, chunk_size=bulk_chunk_size, num_workers=BULK_NUM_WORKERS)
+
+
+
 #############################################################################################
 ###################################### End of Functions #####################################
 #############################################################################################
@@ -242,12 +739,84 @@ if __name__ == "__main__":
     # Loading the environment variables
     load_dotenv()
 
-    # standard encoding for the tiktoken tokens count
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+    # standard encoding for the tiktoken tokens count, wrapped in a memoized counter ("exact", "cached" or "estimate")
+    encoding = TokenCounter(tiktoken.encoding_for_model("gpt-4o-mini"), mode=os.getenv("TOKEN_COUNTING_MODE", "cached"))
 
     # url to be processed for the ingestion
     url = "https://es.wikipedia.org/wiki/Lionel_Messi"
 
+    # ElasticSearch Index name
+    index_name_cosine = "messixpert_cosine"
+
+    parser = argparse.ArgumentParser(description="MessiXpert ingestion")
+    parser.add_argument("--incremental", action="store_true", help="Only upsert/delete the chunks that changed since the last ingestion")
+    parser.add_argument("--force", action="store_true", help="Re-chunk the page in incremental mode even if it was not modified")
+    parser.add_argument("--streaming", action="store_true", help="Parse, chunk, embed and index the page as a streaming pipeline")
+    parser.add_argument("--pdf", help="Ingest a pdf file as page-chunks instead of the wikipedia page")
+    parser.add_argument("--pdf-chunk-id-prefix", default="Lionel_Messi_Wikipedia")
+    parser.add_argument("--pdf-source-url", default=None, help="Source url of the pdf chunks (the file uri of the pdf by default)")
+    parser.add_argument("--local-vector-index", action="store_true", help="Also build the local vector index of the chunks (see vector_index.py)")
+    parser.add_argument("--local-bm25-index", action="store_true", help="Also build the local BM25 index of the chunks (see bm25.py)")
+    args = parser.parse_args()
+
+
+    if args.pdf:
+
+        embeddings_model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+        embeddings_cache = EmbeddingCache(model_name=EMBEDDINGS_MODEL_NAME)
+        es_client = Elasticsearch("http://localhost:9200")
+
+        if not es_client.indices.exists(index=index_name_cosine):
+            es_client.indices.create(index=index_name_cosine, body=get_index_settings())
+
+        # The pdf chunks get their own source url, so they are not mixed with the chunks of the html page
+        pdf_source_url = args.pdf_source_url or Path(args.pdf).resolve().as_uri()
+        page_chunks = iter_pdf_page_chunks(args.pdf, source_url=pdf_source_url, encoding=encoding, chunk_id_prefix=args.pdf_chunk_id_prefix)
+        embedded_chunks = iter_embedded_chunks(page_chunks, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, num_workers=EMBEDDINGS_NUM_WORKERS,
+                                               cache=embeddings_cache)
+        bulk_results = bulk_index_chunks(es_client, index_name_cosine, embedded_chunks, chunk_size=BULK_CHUNK_SIZE, num_workers=BULK_NUM_WORKERS)
+        embeddings_cache.close()
+
+        print(f"INDEXED: {bulk_results['indexed']}   FAILED: {bulk_results['failed']}")
+        print("PDF INGESTION SUCCEEDED.")
+        raise SystemExit(0)
+
+
+    if args.streaming:
+
+        embeddings_model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+        embeddings_cache = EmbeddingCache(model_name=EMBEDDINGS_MODEL_NAME)
+        es_client = Elasticsearch("http://localhost:9200")
+
+        es_client.indices.create(index=index_name_cosine, body=get_index_settings())
+
+        bulk_results = ingest_streaming(iter_wikipedia_page_blocks(url), url, es_client, index_name_cosine, embeddings_model, encoding,
+                                        embeddings_cache=embeddings_cache)
+        embeddings_cache.close()
+
+        print(f"INDEXED: {bulk_results['indexed']}   FAILED: {bulk_results['failed']}")
+        print("STREAMING INGESTION SUCCEEDED.")
+        raise SystemExit(0)
+
+
+    if args.incremental:
+
+        embeddings_model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+        embeddings_cache = EmbeddingCache(model_name=EMBEDDINGS_MODEL_NAME)
+        es_client = Elasticsearch("http://localhost:9200")
+
+        # The index is only created the first time
+        if not es_client.indices.exists(index=index_name_cosine):
+            es_client.indices.create(index=index_name_cosine, body=get_index_settings())
+
+        ingestion_results = ingest_incremental(url, es_client, index_name_cosine, embeddings_model, encoding,
+                                               embeddings_cache=embeddings_cache, force=args.force)
+        embeddings_cache.close()
+
+        print(ingestion_results)
+        print("INCREMENTAL INGESTION SUCCEEDED.")
+        raise SystemExit(0)
+
 
 
     # Starting the processing of the knowledge source
@@ -255,20 +824,19 @@ if __name__ == "__main__":
     processed_html_content = scrape_wikipedia_html(html_content)
 
     # Chunk the wiki page
-    chunks = create_chunks_with_headers(processed_html_content, source_url=url, encoding=encoding, max_chunk_size=500)
+    chunks = create_chunks_with_headers(processed_html_content, source_url=url, encoding=encoding, max_chunk_size=500, prefetch_token_counts=True)
 
     # Initialize the embeddings model
-    embeddings_model = SentenceTransformer('all-MiniLM-L6-v2')
+    embeddings_model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
 
+    # Persistent cache, so unchanged chunks are not re-embedded when the page is re-ingested
+    embeddings_cache = EmbeddingCache(model_name=EMBEDDINGS_MODEL_NAME)
 
-    # Adding the embedding for each chunk content
-    for chunk in tqdm(chunks):
 
-        # Generating the embeddings
-        embedding = embeddings_model.encode(chunk['content']).tolist()
-        
-        # Adding the embeddings to the original dict
-        chunk['content_embeddings'] = embedding
+    # Adding the embedding for each chunk content, encoding the chunks in batches
+    chunks = embed_chunks(chunks, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, num_workers=EMBEDDINGS_NUM_WORKERS, cache=embeddings_cache)
+
+    embeddings_cache.close()
 
 
 
@@ -277,38 +845,26 @@ if __name__ == "__main__":
     es_client = Elasticsearch("http://localhost:9200")
 
 
-    # Creating the index settings for the vectorDB.
-    index_settings_cosine = {
-        "settings": {
-            "number_of_shards": 1,
-            "number_of_replicas": 0
-        },
-        "mappings": {
-            "properties": {
-                "content": {"type": "text"},
-                "headers_concat": {"type": "text"},
-                "chunk_size": {"type": "integer"},
-                "source_url": {"type": "text"} ,
-                "content_type": {"type": "text"} ,
-                "ingestion_date": {"type": "date"} ,
-                "content_embeddings": {"type": "dense_vector", "dims": 384, "index": True, "similarity": "cosine"},
-            }
-        }
-    }
+    # Creating the index in ElasticSearch
+    es_client.indices.create(index=index_name_cosine, body=get_index_settings())
 
 
+    # Indexing the chunks with the _bulk API. Failed documents are written to the dead-letter file.
+    bulk_results = bulk_index_chunks(es_client, index_name_cosine, chunks, chunk_size=BULK_CHUNK_SIZE, num_workers=BULK_NUM_WORKERS)
 
-    # Creating the index in ElasticSearch
-    index_name_cosine = "messixpert_cosine"
+    print(f"INDEXED: {bulk_results['indexed']}   FAILED: {bulk_results['failed']}")
+    if bulk_results["failed"]:
+        print(f"Failed documents were written to {BULK_DEAD_LETTER_PATH}")
 
-    es_client.indices.create(index=index_name_cosine, body=index_settings_cosine)
 
+    # Building the local vector and BM25 indexes from the same chunks, as an alternative to the elasticsearch searches
+    if args.local_vector_index:
+        vector_index_metadata = build_vector_index(chunks, get_vector_index_dir(index_name_cosine))
+        print(f"LOCAL VECTOR INDEX: {vector_index_metadata['count']} chunks ({vector_index_metadata['dtype']})")
 
-    for chunk in tqdm(chunks):
-        try:
-            es_client.index(index=index_name_cosine, document=chunk)
-        except Exception as e:
-            print(e)
+    if args.local_bm25_index:
+        bm25_index_metadata = build_bm25_index(chunks, get_bm25_index_dir(index_name_cosine))
+        print(f"LOCAL BM25 INDEX: {bm25_index_metadata['count']} chunks ({bm25_index_metadata['terms']} terms)")
     
 
     print("INGESTION SUCCEEDED.")
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from dotenv import load_dotenv
+
+from tqdm.auto import tqdm
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from sentence_transformers import SentenceTransformer
+
+import tiktoken
+
+from elasticsearch import Elasticsearch
+
+from ingestion import get_raw_file_path, scrape_wikipedia_page_if_changed, scrape_wikipedia_html, create_chunks_with_headers, diff_chunks
+from token_counter import TokenCounter
+from embeddings import EMBEDDINGS_MODEL_NAME, EMBEDDINGS_BATCH_SIZE, EMBEDDINGS_NUM_WORKERS, EmbeddingCache, iter_embedded_chunks
+from indexing import (BULK_CHUNK_SIZE, BULK_NUM_WORKERS, RefreshDisabled, get_index_settings, generate_bulk_actions, generate_delete_actions,
+                      get_indexed_chunk_ids, bulk_index)
+
+
+
+
+# Default configuration of the orchestrator, overridable from the environment.
+ORCHESTRATOR_FETCH_WORKERS = int(os.getenv("ORCHESTRATOR_FETCH_WORKERS", "4"))
+ORCHESTRATOR_CHUNK_WORKERS = int(os.getenv("ORCHESTRATOR_CHUNK_WORKERS", str(os.cpu_count() or 1)))
+ORCHESTRATOR_REQUESTS_PER_SECOND = float(os.getenv("ORCHESTRATOR_REQUESTS_PER_SECOND", "2"))
+ORCHESTRATOR_USER_AGENT = os.getenv("ORCHESTRATOR_USER_AGENT", "MessiXpert-Assistant ingestion (https://github.com/gfgrillo3/MessiXpert-Assistant)")
+
+# tiktoken encoding of each chunking process, loaded once by the process pool initializer
+worker_encoding = None
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for loading the sources manifest.
+# The manifest is a json list of sources: {"url": "https://es.wikipedia.org/wiki/...", "path": optional saved html file}
+def load_manifest(manifest_path):
+
+    with open(manifest_path, "r", encoding="utf-8") as file:
+        sources = json.load(file)
+
+    return [source if isinstance(source, dict) else {"url": source} for source in sources]
+
+
+
+# Thread-safe rate limiter, spacing the requests of all the fetching threads.
+class RateLimiter:
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_request_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = max(self.next_request_time - now, 0)
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+        if wait_time:
+            time.sleep(wait_time)
+
+
+
+# Function for creating an HTTP session with a connection pool sized for the fetching threads.
+def create_http_session(pool_size=ORCHESTRATOR_FETCH_WORKERS):
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = ORCHESTRATOR_USER_AGENT
+
+    return session
+
+
+
+# Function for getting the html of a source. Offline, the html is read from the saved file instead of being fetched.
+def fetch_source(source, session, rate_limiter, offline=False, raw_data_filepath='../data/raw/'):
+
+    start_time = time.perf_counter()
+
+    if offline:
+        raw_file_path = source.get("path") or get_raw_file_path(source["url"], raw_data_filepath)
+        with open(raw_file_path, "r", encoding="utf-8") as file:
+            html_content = file.read()
+        changed = True
+    else:
+        rate_limiter.wait()
+        html_content, changed = scrape_wikipedia_page_if_changed(source["url"], raw_data_filepath=raw_data_filepath, session=session)
+
+    return html_content, changed, time.perf_counter() - start_time
+
+
+
+# Initializer of the chunking processes
+def init_chunking_worker(encoding_model_name):
+    global worker_encoding
+    worker_encoding = TokenCounter(tiktoken.encoding_for_model(encoding_model_name), mode=os.getenv("TOKEN_COUNTING_MODE", "cached"))
+
+
+
+# Function executed in the process pool: parsing and chunking of a page.
+# Stable chunk ids are mandatory here, since the timestamp ids of different sources would collide in the index.
+def chunk_source(html_content, source_url, max_chunk_size=500):
+
+    start_time = time.perf_counter()
+    chunks = create_chunks_with_headers(scrape_wikipedia_html(html_content), source_url=source_url, encoding=worker_encoding,
+                                        max_chunk_size=max_chunk_size, stable_chunk_ids=True, prefetch_token_counts=True)
+
+    return chunks, time.perf_counter() - start_time
+
+
+
+# Generator of the chunks of all the sources of the manifest.
+# The pages are fetched concurrently by a pool of threads sharing a pooled session and a rate limiter, and each fetched page
+# is parsed and chunked in a process pool. The chunks of a source are yielded as soon as it is chunked, so the embeddings and
+# indexing stages start with the first source. Per-source timings and errors are recorded in stats.
+# With incremental=True only the chunks not already indexed are yielded, and the stale chunk ids are added to chunk_ids_to_delete.
+def iter_manifest_chunks(sources, stats, es_client=None, index_name=None, incremental=False, chunk_ids_to_delete=None, offline=False,
+                         raw_data_filepath='../data/raw/', max_chunk_size=500, fetch_workers=ORCHESTRATOR_FETCH_WORKERS,
+                         chunk_workers=ORCHESTRATOR_CHUNK_WORKERS, requests_per_second=ORCHESTRATOR_REQUESTS_PER_SECOND):
+
+    session = create_http_session(pool_size=fetch_workers)
+    rate_limiter = RateLimiter(requests_per_second)
+    progress_bar = tqdm(total=len(sources), desc="Sources")
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor, \
+         ProcessPoolExecutor(max_workers=chunk_workers, initializer=init_chunking_worker, initargs=("gpt-4o-mini",)) as chunk_executor:
+
+        pending_futures = {}
+        for source in sources:
+            stats[source["url"]] = {"status": "pending", "fetch_time": 0.0, "chunk_time": 0.0, "chunks": 0}
+            future = fetch_executor.submit(fetch_source, source, session, rate_limiter, offline, raw_data_filepath)
+            pending_futures[future] = ("fetch", source)
+
+        while pending_futures:
+            done, _ = wait(pending_futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, source = pending_futures.pop(future)
+                source_stats = stats[source["url"]]
+
+                try:
+                    if stage == "fetch":
+                        html_content, changed, source_stats["fetch_time"] = future.result()
+                        if not changed:
+                            source_stats["status"] = "unchanged"
+                            progress_bar.update(1)
+                            continue
+                        chunk_future = chunk_executor.submit(chunk_source, html_content, source["url"], max_chunk_size)
+                        pending_futures[chunk_future] = ("chunk", source)
+                        continue
+
+                    chunks, source_stats["chunk_time"] = future.result()
+
+                    if incremental:
+                        chunks, stale_chunk_ids = diff_chunks(chunks, get_indexed_chunk_ids(es_client, index_name, source["url"]))
+                        chunk_ids_to_delete.extend(stale_chunk_ids)
+                        source_stats["deleted"] = len(stale_chunk_ids)
+
+                except Exception as e:
+                    source_stats["status"] = f"error: {e}"
+                    progress_bar.update(1)
+                    continue
+
+                source_stats["status"] = "chunked"
+                source_stats["chunks"] = len(chunks)
+                progress_bar.update(1)
+                progress_bar.write(f"{source['url']}: {len(chunks)} chunks "
+                                   f"(fetch {source_stats['fetch_time']:.2f}s, chunking {source_stats['chunk_time']:.2f}s)")
+
+                yield from chunks
+
+    progress_bar.close()
+    session.close()
+
+
+
+# Function for ingesting all the sources of a manifest into an index.
+# Fetching and chunking feed the shared embeddings and bulk indexing stages as a single stream of chunks.
+def ingest_manifest(sources, es_client, index_name, embeddings_model, embeddings_cache=None, incremental=False, offline=False,
+                    raw_data_filepath='../data/raw/', max_chunk_size=500, fetch_workers=ORCHESTRATOR_FETCH_WORKERS,
+                    chunk_workers=ORCHESTRATOR_CHUNK_WORKERS, requests_per_second=ORCHESTRATOR_REQUESTS_PER_SECOND):
+
+    stats = {}
+    chunk_ids_to_delete = []
+
+    chunks = iter_manifest_chunks(sources, stats, es_client=es_client, index_name=index_name, incremental=incremental,
+                                  chunk_ids_to_delete=chunk_ids_to_delete, offline=offline, raw_data_filepath=raw_data_filepath,
+                                  max_chunk_size=max_chunk_size, fetch_workers=fetch_workers, chunk_workers=chunk_workers,
+                                  requests_per_second=requests_per_second)
+    embedded_chunks = iter_embedded_chunks(chunks, embeddings_model, batch_size=EMBEDDINGS_BATCH_SIZE, num_workers=EMBEDDINGS_NUM_WORKERS,
+                                           cache=embeddings_cache)
+
+    start_time = time.perf_counter()
+    with RefreshDisabled(es_client, index_name):
+        bulk_results = bulk_index(es_client, generate_bulk_actions(embedded_chunks, index_name), chunk_size=BULK_CHUNK_SIZE,
+                                  num_workers=BULK_NUM_WORKERS)
+        if chunk_ids_to_delete:
+            delete_results = bulk_index(es_client, generate_delete_actions(chunk_ids_to_delete, index_name), chunk_size=BULK_CHUNK_SIZE,
+                                        num_workers=BULK_NUM_WORKERS)
+            bulk_results["deleted"] = delete_results["indexed"]
+            bulk_results["failed"] += delete_results["failed"]
+    bulk_results["total_time"] = time.perf_counter() - start_time
+
+    return stats, bulk_results
+
+
+
+# Function for printing the per-source report of an ingestion
+def print_ingestion_report(stats, bulk_results):
+
+    print(f"{'status':<12} {'chunks':>7} {'fetch (s)':>10} {'chunk (s)':>10}  source")
+    for source_url, source_stats in stats.items():
+        print(f"{source_stats['status'][:12]:<12} {source_stats['chunks']:>7} {source_stats['fetch_time']:>10.2f} "
+              f"{source_stats['chunk_time']:>10.2f}  {source_url}")
+
+    print(f"INDEXED: {bulk_results['indexed']}   DELETED: {bulk_results.get('deleted', 0)}   FAILED: {bulk_results['failed']}   "
+          f"TOTAL TIME: {bulk_results['total_time']:.2f}s")
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+if __name__ == "__main__":
+
+    # Loading the environment variables
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="MessiXpert multi-source ingestion")
+    parser.add_argument("--manifest", default="../data/sources.json")
+    parser.add_argument("--index-name", default="messixpert_cosine")
+    parser.add_argument("--offline", action="store_true", help="Read the saved html files of data/raw instead of fetching the pages")
+    parser.add_argument("--raw-data-filepath", default="../data/raw/")
+    parser.add_argument("--incremental", action="store_true", help="Only upsert/delete the chunks that changed since the last ingestion")
+    parser.add_argument("--fetch-workers", type=int, default=ORCHESTRATOR_FETCH_WORKERS)
+    parser.add_argument("--chunk-workers", type=int, default=ORCHESTRATOR_CHUNK_WORKERS)
+    parser.add_argument("--requests-per-second", type=float, default=ORCHESTRATOR_REQUESTS_PER_SECOND)
+    args = parser.parse_args()
+
+    sources = load_manifest(args.manifest)
+
+    embeddings_model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+    embeddings_cache = EmbeddingCache(model_name=EMBEDDINGS_MODEL_NAME)
+    es_client = Elasticsearch("http://localhost:9200")
+
+    if not es_client.indices.exists(index=args.index_name):
+        es_client.indices.create(index=args.index_name, body=get_index_settings())
+
+    stats, bulk_results = ingest_manifest(sources, es_client, args.index_name, embeddings_model, embeddings_cache=embeddings_cache,
+                                          incremental=args.incremental, offline=args.offline, raw_data_filepath=args.raw_data_filepath,
+                                          fetch_workers=args.fetch_workers, chunk_workers=args.chunk_workers,
+                                          requests_per_second=args.requests_per_second)
+    embeddings_cache.close()
+
+    print_ingestion_report(stats, bulk_results)
@@ -4,6 +4,10 @@ import requests
 
 from dotenv import load_dotenv
 
+os.environ['RUN_TIMEZONE_CHECK'] = '0'
+
+from db import refresh_rollups
+
 
 load_dotenv()
 
@@ -189,6 +193,13 @@ def main():
         print("Datasource creation failed")
         return
 
+    # The panels query the monitoring rollups, so they are brought up to date before creating the dashboard
+    try:
+        refreshed_buckets = refresh_rollups()
+        print(f"Monitoring rollups refreshed: {refreshed_buckets}")
+    except Exception as e:
+        print(f"Error refreshing the monitoring rollups: {e}")
+
     create_dashboard(api_key, datasource_uid)
 
 
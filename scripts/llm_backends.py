@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from openai import OpenAI
+
+
+
+
+# Default configuration of the LLM backends, overridable from the environment.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "phi3")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1/")
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "300"))
+FAKE_LLM_TOKEN_MS = float(os.getenv("FAKE_LLM_TOKEN_MS", "10"))
+FAKE_LLM_ANSWER_TOKENS = int(os.getenv("FAKE_LLM_ANSWER_TOKENS", "60"))
+
+# Prices per 1k tokens of each model: input, cached input and output. The models of the local providers are free.
+LOCAL_LLM_PROVIDERS = ("ollama", "fake")
+MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.00015, "cached_input": 0.000075, "output": 0.0006},
+    "gpt-4o": {"input": 0.0025, "cached_input": 0.00125, "output": 0.01},
+    "gpt-4-turbo": {"input": 0.01, "cached_input": 0.01, "output": 0.03},
+    "gpt-3.5-turbo": {"input": 0.0005, "cached_input": 0.0005, "output": 0.0015},
+}
+FREE_MODEL_PRICES = {"input": 0.0, "cached_input": 0.0, "output": 0.0}
+
+# LLM backends already created in this process, by name. The lock is reentrant, as the router gets its backends while it is created
+llm_backends = {}
+llm_backends_lock = threading.RLock()
+
+# Fake LLM server started in this process for the "fake" backend
+fake_llm_server = None
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for getting the prices of a model of a provider. Dated snapshots (e.g. gpt-4o-mini-2024-07-18) use the prices of
+# their model, and the models of the local providers are free. A model of a paid provider missing from the table raises,
+# instead of recording its calls at no cost.
+def get_model_prices(model, provider="openai"):
+
+    if provider in LOCAL_LLM_PROVIDERS:
+        return FREE_MODEL_PRICES
+
+    for model_name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model == model_name or model.startswith(f"{model_name}-"):
+            return MODEL_PRICES[model_name]
+
+    raise ValueError(f"No prices for the {provider} model {model}, add them to MODEL_PRICES")
+
+
+
+# Function for getting the input tokens read from the prompt cache of the provider.
+# Older versions of the openai package keep the unknown prompt_tokens_details field as a dict.
+def get_cached_tokens(usage):
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+
+# Function for calculate the cost of the interaction with the llm, with the prices of the model (or the given prices).
+# The input tokens read from the prompt cache are priced at the discounted rate.
+def calculate_cost(response, model=OPENAI_MODEL, prices=None):
+
+    prices = prices or get_model_prices(model)
+
+    input_tokens = response.usage.prompt_tokens
+    output_tokens = response.usage.completion_tokens
+    cached_tokens = get_cached_tokens(response.usage)
+
+    input_tokens_cost = prices["input"] * ((input_tokens - cached_tokens) / 1000) + prices["cached_input"] * (cached_tokens / 1000)
+    output_tokens_cost = prices["output"] * (output_tokens / 1000)
+    total_cost = input_tokens_cost + output_tokens_cost
+    prompt_cache_savings = (prices["input"] - prices["cached_input"]) * (cached_tokens / 1000)
+
+    costs = {"input_tokens_cost": input_tokens_cost,
+             "output_tokens_cost": output_tokens_cost,
+             "total_cost": total_cost,
+             "prompt_cache_savings": prompt_cache_savings}
+
+    tokens = {"input_tokens": input_tokens,
+              "output_tokens": output_tokens,
+              "total_tokens": input_tokens + output_tokens,
+              "cached_tokens": cached_tokens}
+
+    return costs, tokens
+
+
+
+# Function for getting the messages of a prompt. A text is sent as a single user message.
+def build_messages(prompt):
+
+    if isinstance(prompt, str):
+        return [{"role": "user", "content": prompt}]
+
+    return prompt
+
+
+
+# LLM backend on an OpenAI compatible API (OpenAI, or a local server such as ollama).
+# The client is created once, so its HTTP connections are reused by every request. A sync client is used even by agenerate,
+# as an async client is bound to the event loop where it was first used and generate_answer runs a new loop per call.
+# The model and latency of the last call of each thread are kept, to be stored with the answer, besides the totals of the backend.
+# The prices of the model are looked up when the backend is created, so an unpriced model fails before any call.
+class OpenAIBackend:
+
+    def __init__(self, name="openai", model=OPENAI_MODEL, base_url=None, api_key=None, timeout=LLM_TIMEOUT_SECONDS, max_retries=2,
+                 provider="openai"):
+        self.name = name
+        self.model = model
+        self.provider = provider
+        self.prices = get_model_prices(model, provider)
+        self.client = OpenAI(base_url=base_url, api_key=api_key, timeout=timeout, max_retries=max_retries)
+        self.lock = threading.Lock()
+
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.total_cost = 0.0
+
+        # Last call of each thread (each streamlit session runs in its own thread)
+        self.last_call = threading.local()
+
+
+    def record_call(self, latency, costs=None, error=False):
+        with self.lock:
+            self.calls += 1
+            self.errors += int(error)
+            self.total_latency += latency
+            self.total_cost += costs["total_cost"] if costs else 0.0
+
+        self.last_call.latency = latency
+        self.last_call.model = self.model
+
+
+    # Sends a prompt to the model. Returns the answer, costs and tokens, as llm_generate_answer.
+    # The question is only used by the router (see llm_router.py), which has the same methods.
+    def generate(self, prompt, question=None):
+
+        start_time = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(model=self.model, messages=build_messages(prompt))
+        except Exception:
+            self.record_call(time.perf_counter() - start_time, error=True)
+            raise
+
+        costs, tokens = calculate_cost(response, self.model, self.prices)
+        self.record_call(time.perf_counter() - start_time, costs)
+
+        return response.choices[0].message.content, costs, tokens
+
+
+    # Async version of generate. The request runs in a worker thread, and the metrics are kept for the thread running the event loop.
+    async def agenerate(self, prompt, question=None):
+
+        start_time = time.perf_counter()
+        try:
+            response = await asyncio.to_thread(self.client.chat.completions.create, model=self.model, messages=build_messages(prompt))
+        except Exception:
+            self.record_call(time.perf_counter() - start_time, error=True)
+            raise
+
+        costs, tokens = calculate_cost(response, self.model, self.prices)
+        self.record_call(time.perf_counter() - start_time, costs)
+
+        return response.choices[0].message.content, costs, tokens
+
+
+    # Streams the answer of a prompt: the text deltas, and last the costs and tokens of the usage sent at the end of the stream,
+    # priced by the backend. The call is recorded even when the consumer stops reading the stream before its end.
+    def stream(self, prompt, question=None):
+
+        start_time = time.perf_counter()
+        costs = None
+        error = False
+        try:
+            stream = self.client.chat.completions.create(model=self.model, messages=build_messages(prompt), stream=True,
+                                                         stream_options={"include_usage": True})
+            for event in stream:
+                if event.choices and event.choices[0].delta.content:
+                    yield event.choices[0].delta.content
+                if event.usage is not None:
+                    costs, tokens = calculate_cost(event, self.model, self.prices)
+                    yield costs, tokens
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record_call(time.perf_counter() - start_time, costs, error=error)
+
+
+    # Model and latency of the last call of the current thread, to be stored with the answer.
+    # The model is empty when the answer did not call the LLM (e.g. a semantic cache hit).
+    def last_call_metrics(self):
+        return {
+            "model_used": getattr(self.last_call, "model", ""),
+            "llm_backend": self.name,
+            "llm_latency": getattr(self.last_call, "latency", 0.0),
+        }
+
+
+    def reset_last_call(self):
+        self.last_call.model = ""
+        self.last_call.latency = 0.0
+
+
+    def metrics(self):
+        with self.lock:
+            return {"backend": self.name, "model": self.model, "calls": self.calls, "errors": self.errors,
+                    "avg_latency": self.total_latency / self.calls if self.calls else 0.0, "total_cost": self.total_cost}
+
+
+
+# Function for building the deterministic answer of the fake LLM. The words are drawn from the prompt with a seed
+# taken from its hash, so the same prompt always gets the same answer.
+def build_fake_answer(messages, answer_tokens=FAKE_LLM_ANSWER_TOKENS):
+
+    prompt = "\n".join(message["content"] for message in messages if isinstance(message.get("content"), str))
+    words = prompt.split() or ["messi"]
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+
+    return " ".join(rng.choice(words) for _ in range(answer_tokens)), prompt
+
+
+
+# Request handler of the fake LLM server, an OpenAI compatible /v1/chat/completions endpoint with deterministic answers.
+# The latency is latency_ms before the first token and token_ms per token, streamed as server-sent events when requested.
+class FakeLLMHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    latency_ms = FAKE_LLM_LATENCY_MS
+    token_ms = FAKE_LLM_TOKEN_MS
+    answer_tokens = FAKE_LLM_ANSWER_TOKENS
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def send_event(self, body):
+        data = f"data: {body if isinstance(body, str) else json.dumps(body)}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("utf-8") + data + b"\r\n")
+        self.wfile.flush()
+
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = request.get("model", "fake")
+        answer, prompt = build_fake_answer(request.get("messages", []), self.answer_tokens)
+        answer_words = answer.split(" ")
+
+        # Same estimate of the token counter, about 4 characters per token
+        usage = {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": len(answer_words),
+                 "total_tokens": len(prompt) // 4 + 1 + len(answer_words), "prompt_tokens_details": {"cached_tokens": 0}}
+        response_id = f"chatcmpl-fake-{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}"
+        created = int(time.time())
+
+        time.sleep(self.latency_ms / 1000)
+
+        if not request.get("stream"):
+            time.sleep(self.token_ms * len(answer_words) / 1000)
+            self.send_json(200, {"id": response_id, "object": "chat.completion", "created": created, "model": model,
+                                 "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                                 "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk = {"id": response_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        for position, word in enumerate(answer_words):
+            self.send_event({**chunk, "choices": [{"index": 0, "delta": {"content": word if position == 0 else f" {word}"}, "finish_reason": None}]})
+            time.sleep(self.token_ms / 1000)
+        self.send_event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if request.get("stream_options", {}).get("include_usage"):
+            self.send_event({**chunk, "choices": [], "usage": usage})
+        self.send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+
+# Function for starting the fake LLM server in a background thread. Returns the server, listening on server.server_address.
+def start_fake_llm_server(host="127.0.0.1", port=0, latency_ms=FAKE_LLM_LATENCY_MS, token_ms=FAKE_LLM_TOKEN_MS):
+
+    handler = type("ConfiguredFakeLLMHandler", (FakeLLMHandler,), {"latency_ms": latency_ms, "token_ms": token_ms})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake_llm_server", daemon=True).start()
+
+    return server
+
+
+
+# Function for creating an LLM backend by name:
+#   - "openai": the OpenAI API, with OPENAI_MODEL.
+#   - "ollama": a local ollama server (OLLAMA_BASE_URL), with OLLAMA_MODEL.
+#   - "fake": the deterministic fake LLM server, started in this process. No network or API key is needed.
+#   - "router": the adaptive router over several backends (see llm_router.py).
+# Another model of a provider is selected with "provider:model" (e.g. "openai:gpt-4o").
+def create_llm_backend(name):
+
+    global fake_llm_server
+
+    provider, _, model = name.partition(":")
+
+    if provider == "openai":
+        return OpenAIBackend(name=name, model=model or OPENAI_MODEL)
+
+    if provider == "ollama":
+        return OpenAIBackend(name=name, model=model or OLLAMA_MODEL, base_url=OLLAMA_BASE_URL, api_key="ollama", provider=provider)
+
+    if provider == "fake":
+        if fake_llm_server is None:
+            fake_llm_server = start_fake_llm_server()
+        host, port = fake_llm_server.server_address[:2]
+        return OpenAIBackend(name=name, model=model or "fake-llm", base_url=f"http://{host}:{port}/v1/", api_key="fake", max_retries=0,
+                             provider=provider)
+
+    if provider == "router":
+        # Imported here, as the router creates its backends with this module
+        from llm_router import LLMRouter
+        return LLMRouter()
+
+    raise ValueError(f"Unknown LLM backend: {name}")
+
+
+
+# Function for getting an LLM backend by name. The backend (and its clients) is created once per process.
+def get_llm_backend(name=LLM_BACKEND):
+
+    with llm_backends_lock:
+        if name not in llm_backends:
+            llm_backends[name] = create_llm_backend(name)
+
+    return llm_backends[name]
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+# Fake LLM server, to run the app or the benchmarks offline against an OpenAI compatible endpoint.
+# Usage: python llm_backends.py --port 8089 --latency-ms 300 --token-ms 10
+#        (then OPENAI_BASE_URL=http://localhost:8089/v1/ or LLM_BACKEND=fake in the same process)
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Deterministic fake LLM server with an OpenAI compatible API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=FAKE_LLM_LATENCY_MS)
+    parser.add_argument("--token-ms", type=float, default=FAKE_LLM_TOKEN_MS)
+    args = parser.parse_args()
+
+    server = start_fake_llm_server(args.host, args.port, args.latency_ms, args.token_ms)
+    print(f"Fake LLM server listening on http://{args.host}:{args.port}/v1/")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,462 @@
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+from openai import OpenAI
+
+import pandas as pd
+
+import tiktoken
+
+from tqdm.auto import tqdm
+
+from dotenv import load_dotenv
+
+from langchain.memory import ConversationBufferMemory
+
+from token_counter import TokenCounter
+
+
+
+
+# Default configuration of the LLM evaluation, overridable from the environment.
+JUDGE_MODEL = os.getenv("JUDGE_MODEL", "gpt-4o-mini")
+GENERATION_MODEL = os.getenv("GENERATION_MODEL", "gpt-4o-mini")
+EVALUATION_CONCURRENCY = int(os.getenv("EVALUATION_CONCURRENCY", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "6"))
+JUDGE_CACHE_PATH = os.getenv("JUDGE_CACHE_PATH", "../data/cache/judge.sqlite")
+LIVE_JUDGE_INTERVAL_SECONDS = float(os.getenv("LIVE_JUDGE_INTERVAL_SECONDS", "30"))
+LIVE_JUDGE_MAX_ATTEMPTS = int(os.getenv("LIVE_JUDGE_MAX_ATTEMPTS", "3"))
+
+# Output tokens reserved in the tokens/min budget for each request, until the real usage is known
+EXPECTED_OUTPUT_TOKENS = 300
+
+# Errors of the OpenAI API that are retried with exponential backoff
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+RELEVANCE_LABELS = ("NON_RELEVANT", "PARTLY_RELEVANT", "RELEVANT")
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for building the prompt of the LLM-as-a-judge
+def build_llm_as_a_judge_prompt(question, llm_answer):
+
+    prompt_template = """
+        You are an expert evaluator for a RAG system.
+        Your task is to analyze the relevance of the LLM generated answer to the users given question.
+        The goal is to have 3 classification levels as if the relevance scores were 0, 0.5, or 1.
+        Based on the relevance of the generated answer, you will classify it
+        as "NON_RELEVANT", "PARTLY_RELEVANT", or "RELEVANT".
+
+        Here is the data for evaluation:
+
+        Question: {question}
+        Generated Answer: {llm_answer}
+
+        Please analyze the content and context of the generated answer in relation to the question
+        and provide your evaluation in parsable JSON without using code blocks:
+
+        {{
+        "Relevance": "NON_RELEVANT" | "PARTLY_RELEVANT" | "RELEVANT",
+        "Explanation": "[Provide a brief explanation for your evaluation in spanish]"
+        }}
+    """.strip()
+
+    prompt = prompt_template.format(question=question, llm_answer=llm_answer).strip()
+    return prompt
+
+
+
+# Function for parsing the evaluation of the judge. Small models sometimes wrap the JSON in text or code blocks.
+# Returns None if no valid evaluation is found.
+def parse_judge_evaluation(evaluation_text):
+
+    match = re.search(r"\{.*\}", evaluation_text, re.DOTALL)
+    if match is None:
+        return None
+
+    try:
+        evaluation = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+
+    if evaluation.get("Relevance") not in RELEVANCE_LABELS:
+        return None
+
+    return {"relevance": evaluation["Relevance"], "relevance_explanation": evaluation.get("Explanation", "")}
+
+
+
+# Token bucket limiter of the requests/min and tokens/min of an LLM API, shared by all the threads.
+# Each request takes one request and its estimated tokens from the buckets, waiting until they are refilled if needed.
+# Once the real usage is known, the difference with the estimate is settled with settle().
+class TokenBucketLimiter:
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.updated_at) / 60
+        self.updated_at = now
+        self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed_minutes * self.requests_per_minute)
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed_minutes * self.tokens_per_minute)
+
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait_time = max((1 - self.available_requests) * 60 / self.requests_per_minute,
+                                (tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+            time.sleep(max(wait_time, 0.01))
+
+
+    def settle(self, estimated_tokens, used_tokens):
+        with self.lock:
+            self.available_tokens -= used_tokens - estimated_tokens
+
+
+
+# Function for calling the LLM API with exponential backoff (and jitter) on rate limits, timeouts and server errors.
+# The retry-after header of a 429 is respected when it is sent.
+def call_with_backoff(function, max_retries=LLM_MAX_RETRIES, initial_backoff=1, max_backoff=60):
+
+    for attempt in range(max_retries + 1):
+        try:
+            return function()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+
+            backoff = min(max_backoff, initial_backoff * 2 ** attempt) * random.uniform(0.5, 1)
+            response = getattr(e, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            if retry_after:
+                try:
+                    backoff = max(backoff, float(retry_after))
+                except ValueError:
+                    pass
+
+            print(f"LLM request failed ({type(e).__name__}), retrying in {backoff:.1f} seconds")
+            time.sleep(backoff)
+
+
+
+# Persistent cache of the judge evaluations stored in a sqlite file, keyed by (question, answer, judge model).
+class JudgeCache:
+
+    def __init__(self, cache_path=JUDGE_CACHE_PATH):
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                evaluation_key TEXT PRIMARY KEY,
+                judge_model TEXT NOT NULL,
+                evaluation TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+
+    @staticmethod
+    def evaluation_key(question, answer, judge_model):
+        return hashlib.sha256(json.dumps([question, answer, judge_model], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+    def get(self, question, answer, judge_model):
+        with self.lock:
+            row = self.conn.execute("SELECT evaluation FROM evaluations WHERE evaluation_key = ?",
+                                    (self.evaluation_key(question, answer, judge_model),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+    def set(self, question, answer, judge_model, evaluation):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO evaluations (evaluation_key, judge_model, evaluation) VALUES (?, ?, ?)",
+                              (self.evaluation_key(question, answer, judge_model), judge_model, json.dumps(evaluation, ensure_ascii=False)))
+            self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+
+# Evaluation engine of the RAG: generation of the answers and LLM-as-a-judge evaluations, with every LLM request
+# going through the shared token bucket limiter and the backoff. The judge evaluations are cached.
+class LLMEvaluator:
+
+    def __init__(self, open_ai_client=None, judge_client=None, judge_model=JUDGE_MODEL, generation_model=GENERATION_MODEL, limiter=None, cache=None):
+        self.open_ai_client = open_ai_client or OpenAI()
+        self.judge_client = judge_client or self.open_ai_client
+        self.judge_model = judge_model
+        self.generation_model = generation_model
+        self.limiter = limiter or TokenBucketLimiter()
+        self.cache = cache if cache is not None else JudgeCache()
+        self.token_counter = TokenCounter(tiktoken.encoding_for_model("gpt-4o-mini"), mode="estimate")
+
+        self.lock = threading.Lock()
+        self.cache_hits = 0
+        self.llm_requests = 0
+
+
+    # Sends a prompt to the LLM. Returns the answer and the token usage.
+    def chat(self, prompt, model, client):
+
+        estimated_tokens = self.token_counter.count(prompt) + EXPECTED_OUTPUT_TOKENS
+        self.limiter.acquire(estimated_tokens)
+
+        response = call_with_backoff(lambda: client.chat.completions.create(model=model, messages=[{"role": "user", "content": prompt}]))
+        self.limiter.settle(estimated_tokens, response.usage.total_tokens)
+
+        with self.lock:
+            self.llm_requests += 1
+
+        tokens = {"input_tokens": response.usage.prompt_tokens, "output_tokens": response.usage.completion_tokens,
+                  "total_tokens": response.usage.total_tokens}
+
+        return response.choices[0].message.content, tokens
+
+
+    # Evaluates an answer with the LLM-as-a-judge. Answers that the judge does not classify are labeled JUDGE_ERROR and not cached.
+    def judge(self, question, answer):
+
+        evaluation = self.cache.get(question, answer, self.judge_model)
+        if evaluation is not None:
+            with self.lock:
+                self.cache_hits += 1
+            return {**evaluation, "eval_prompt_tokens": 0, "eval_completion_tokens": 0, "eval_total_tokens": 0}
+
+        evaluation_text, tokens = self.chat(build_llm_as_a_judge_prompt(question, answer), self.judge_model, self.judge_client)
+        tokens = {"eval_prompt_tokens": tokens["input_tokens"], "eval_completion_tokens": tokens["output_tokens"],
+                  "eval_total_tokens": tokens["total_tokens"]}
+
+        evaluation = parse_judge_evaluation(evaluation_text)
+        if evaluation is None:
+            return {"relevance": "JUDGE_ERROR", "relevance_explanation": evaluation_text, **tokens}
+
+        self.cache.set(question, answer, self.judge_model, evaluation)
+
+        return {**evaluation, **tokens}
+
+
+    # Generates the answer of a question with the RAG retrieval and prompt, without conversation history
+    def generate(self, question, es_client, index_name, search_function, embeddings_model):
+
+        # Imported here so the judge can be used without loading the RAG (and its embeddings model)
+        from rag import build_prompt, get_answers_content
+
+        top_k_chunks = search_function(user_query=question, es_client=es_client, index=index_name, embeddings_model=embeddings_model)
+        prompt = build_prompt(query=question, search_results_text_list=get_answers_content(top_k_chunks),
+                              conversation_history=ConversationBufferMemory(memory_key="chat_history", return_messages=True))
+
+        answer, _ = self.chat(prompt, self.generation_model, self.open_ai_client)
+
+        return answer
+
+
+    # Generates (unless the record has an answer already) and judges the answer of each record, concurrently
+    def evaluate_records(self, records, es_client=None, index_name=None, search_function=None, embeddings_model=None,
+                         concurrency=EVALUATION_CONCURRENCY):
+
+        def evaluate_record(record):
+            answer = record.get("answer")
+            if not isinstance(answer, str):
+                answer = self.generate(record["question"], es_client, index_name, search_function, embeddings_model)
+            evaluation = self.judge(record["question"], answer)
+            return {"chunk_id": record.get("chunk_id"), "question": record["question"], "answer": answer,
+                    "relevance": evaluation["relevance"], "explanation": evaluation["relevance_explanation"]}
+
+        evaluations = [None] * len(records)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(evaluate_record, record): position for position, record in enumerate(records)}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                evaluations[futures[future]] = future.result()
+
+        return evaluations
+
+
+    def metrics(self):
+        with self.lock:
+            return {"judge_model": self.judge_model, "llm_requests": self.llm_requests, "judge_cache_hits": self.cache_hits}
+
+
+
+# Background judge of the live answers. Every interval_seconds it evaluates the answers stored with relevance UNKNOWN,
+# and fills their relevance and eval_*_tokens columns. An answer whose evaluation fails is labeled ERROR (at once for the
+# errors that are not retried, after max_attempts for the rest), so it does not come back on every batch.
+class LiveAnswersJudge:
+
+    def __init__(self, evaluator, interval_seconds=LIVE_JUDGE_INTERVAL_SECONDS, batch_size=20, concurrency=EVALUATION_CONCURRENCY,
+                 max_attempts=LIVE_JUDGE_MAX_ATTEMPTS):
+        self.evaluator = evaluator
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.stop_event = threading.Event()
+        self.evaluated_answers = 0
+        self.failed_answers = 0
+        self.thread = threading.Thread(target=self.run, name="live_answers_judge", daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+    # Evaluates one batch of answers. Returns the number of answers processed, evaluated or failed.
+    # The judge runs apart from the app's telemetry writer, so it refreshes the rollups itself once evaluations are saved.
+    def evaluate_pending(self):
+
+        from db import get_unevaluated_answers, refresh_rollups, save_answer_evaluation, save_answer_evaluation_error
+
+        answers = get_unevaluated_answers(limit=self.batch_size)
+
+        def evaluate_answer(row):
+            try:
+                evaluation = self.evaluator.judge(row["question"], row["answer"])
+            except Exception as e:
+                save_answer_evaluation_error(row["id"], row["timestamp"], f"{type(e).__name__}: {e}",
+                                             permanent=not isinstance(e, RETRYABLE_ERRORS), max_attempts=self.max_attempts)
+                raise
+            save_answer_evaluation(row["id"], row["timestamp"], evaluation)
+
+        failures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in as_completed([executor.submit(evaluate_answer, row) for row in answers]):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append(e)
+
+        if failures:
+            errors = sorted({f"{type(e).__name__}: {e}" for e in failures})
+            print(f"Error evaluating {len(failures)} of {len(answers)} live answers: {'; '.join(errors[:5])}")
+
+        self.evaluated_answers += len(answers) - len(failures)
+        self.failed_answers += len(failures)
+
+        if len(answers) > len(failures):
+            try:
+                refresh_rollups()
+            except Exception as e:
+                print(f"Error refreshing the monitoring rollups: {e}")
+
+        return len(answers)
+
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                # A full batch means there may be more answers waiting, so the next one is not delayed
+                if self.evaluate_pending() == self.batch_size:
+                    continue
+            except Exception as e:
+                print(f"Error evaluating the live answers: {e}")
+            self.stop_event.wait(self.interval_seconds)
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+# RAG evaluation with the LLM-as-a-judge.
+# Usage:
+#   python llm_evaluation.py --ground-truth ../tests/wiki_Lionel_Messi-GroundTruth.csv --sample 200 --output ../tests/wiki_Lionel_Messi-rag_evaluation_gpt-4o-mini.csv
+#   python llm_evaluation.py --answers ../tests/wiki_Lionel_Messi-rag_evaluation_gpt-4o-mini.csv --judge-model phi3 --judge-base-url http://localhost:11434/v1/ --output ...
+#   python llm_evaluation.py --live
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="RAG evaluation with the LLM-as-a-judge")
+    parser.add_argument("--ground-truth", default="../tests/wiki_Lionel_Messi-GroundTruth.csv", help="Questions to answer with the RAG and judge")
+    parser.add_argument("--answers", default=None, help="Evaluation csv with answers already generated, only judged again")
+    parser.add_argument("--live", action="store_true", help="Evaluate the answers stored in the database in the background")
+    parser.add_argument("--sample", type=int, default=None)
+    parser.add_argument("--index", default="messixpert_cosine")
+    parser.add_argument("--judge-model", default=JUDGE_MODEL)
+    parser.add_argument("--judge-base-url", default=None, help="OpenAI compatible API of the judge (e.g. ollama)")
+    parser.add_argument("--concurrency", type=int, default=EVALUATION_CONCURRENCY)
+    parser.add_argument("--requests-per-minute", type=float, default=LLM_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tokens-per-minute", type=float, default=LLM_TOKENS_PER_MINUTE)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    open_ai_client = OpenAI()
+    judge_client = OpenAI(base_url=args.judge_base_url, api_key="ollama") if args.judge_base_url else open_ai_client
+    evaluator = LLMEvaluator(open_ai_client=open_ai_client, judge_client=judge_client, judge_model=args.judge_model,
+                             limiter=TokenBucketLimiter(args.requests_per_minute, args.tokens_per_minute))
+
+    if args.live:
+        os.environ.setdefault('RUN_TIMEZONE_CHECK', '0')
+        live_judge = LiveAnswersJudge(evaluator, concurrency=args.concurrency).start()
+        try:
+            while True:
+                time.sleep(60)
+                print(f"Evaluated answers: {live_judge.evaluated_answers} {evaluator.metrics()}")
+        except KeyboardInterrupt:
+            live_judge.stop()
+
+    else:
+        records_df = pd.read_csv(args.answers or args.ground_truth, sep=";")
+        if args.sample:
+            records_df = records_df.sample(n=args.sample, random_state=1)
+        records = records_df.to_dict(orient="records")
+
+        es_client = search_function = embeddings_model = None
+        if args.answers is None:
+            from elasticsearch import Elasticsearch
+            from rag import hybrid_search_rrf, embeddings_model
+            es_client = Elasticsearch("http://localhost:9200")
+            search_function = hybrid_search_rrf
+
+        evaluations_df = pd.DataFrame(evaluator.evaluate_records(records, es_client, args.index, search_function, embeddings_model,
+                                                                 concurrency=args.concurrency))
+
+        print(evaluations_df.relevance.value_counts(normalize=True))
+        print(evaluator.metrics())
+
+        if args.output:
+            evaluations_df.to_csv(args.output, sep=";", index=False)
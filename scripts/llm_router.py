@@ -0,0 +1,510 @@
+import os
+import re
+import time
+import queue
+import asyncio
+import argparse
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from llm_backends import OpenAIBackend, get_llm_backend, start_fake_llm_server
+
+
+
+
+# Default configuration of the router, overridable from the environment.
+LLM_ROUTER_BACKENDS = os.getenv("LLM_ROUTER_BACKENDS", "openai,ollama")
+LLM_ROUTER_SMALL_BACKEND = os.getenv("LLM_ROUTER_SMALL_BACKEND", "")
+LLM_LATENCY_SLO_MS = float(os.getenv("LLM_LATENCY_SLO_MS", "4000"))
+LLM_HEDGE_DEADLINE_MS = float(os.getenv("LLM_HEDGE_DEADLINE_MS", "2500"))
+LLM_MAX_ERROR_RATE = float(os.getenv("LLM_MAX_ERROR_RATE", "0.2"))
+LLM_ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "100"))
+LLM_ROUTER_WINDOW_SECONDS = float(os.getenv("LLM_ROUTER_WINDOW_SECONDS", "300"))
+LLM_ROUTER_MIN_SAMPLES = int(os.getenv("LLM_ROUTER_MIN_SAMPLES", "5"))
+LLM_ROUTER_MAX_ABANDONED_CALLS = int(os.getenv("LLM_ROUTER_MAX_ABANDONED_CALLS", "8"))
+SHORT_QUESTION_MAX_WORDS = int(os.getenv("SHORT_QUESTION_MAX_WORDS", "12"))
+
+# First words of the factual questions (accents folded), and words of the questions asking for an explanation
+FACTUAL_QUESTION_WORDS = {"cuantos", "cuantas", "cuanto", "cuando", "donde", "quien", "quienes", "cual", "cuales", "que", "en",
+                          "how", "when", "where", "who", "which", "what", "in"}
+EXPLANATION_WORDS = {"porque", "como", "explica", "explicame", "compara", "describe", "cuenta", "opinas",
+                     "why", "explain", "compare", "tell", "think"}
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for checking if a question is short and factual ("¿Cuántos goles hizo Messi en 2012?"), so a smaller model can answer it.
+# Questions asking for an explanation, a comparison or an opinion are not.
+def is_short_factual_question(question):
+
+    if not question:
+        return False
+
+    folded = "".join(char for char in unicodedata.normalize("NFD", question.lower()) if unicodedata.category(char) != "Mn")
+    words = re.findall(r"\w+", folded)
+    if not words or len(words) > SHORT_QUESTION_MAX_WORDS:
+        return False
+
+    return (words[0] in FACTUAL_QUESTION_WORDS and not any(word in EXPLANATION_WORDS for word in words)
+            and "por que" not in " ".join(words))
+
+
+
+# Function for getting the price of a backend, to break the ties between backends with the same SLO rank. The output tokens weigh as much as the input ones.
+def get_backend_price(backend):
+    prices = backend.prices
+    return prices["input"] + prices["output"]
+
+
+
+# Rolling latencies and errors of the calls of a backend, within the last window_seconds and the last window calls.
+# The old samples expire, so a backend excluded by its latency or errors is tried again once they are forgotten.
+# The calls cancelled before their end (a hedged stream that lost the race) only give a lower bound of their latency, so they are
+# kept as censored samples, counted apart and left out of the p95 and error rate.
+class RollingStats:
+
+    def __init__(self, window=LLM_ROUTER_WINDOW, window_seconds=LLM_ROUTER_WINDOW_SECONDS):
+        self.samples = deque(maxlen=window)
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+
+
+    def add(self, latency, error=False, censored=False):
+        with self.lock:
+            self.samples.append((time.monotonic(), latency, error, censored))
+
+
+    def snapshot(self):
+        with self.lock:
+            while self.samples and time.monotonic() - self.samples[0][0] > self.window_seconds:
+                self.samples.popleft()
+            samples = [(latency, error) for _, latency, error, censored in self.samples if not censored]
+            censored_samples = len(self.samples) - len(samples)
+
+        latencies = sorted(latency for latency, _ in samples)
+        p95 = latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)] if latencies else 0.0
+        error_rate = sum(error for _, error in samples) / len(samples) if samples else 0.0
+
+        return {"samples": len(samples), "censored_samples": censored_samples, "p95": p95, "error_rate": error_rate}
+
+
+
+# Router of the LLM calls over several backends, with the same methods of a backend (see llm_backends.py), so it can be
+# passed as the llm_backend of generate_answer.
+#   - The p95 latency and error rate of each backend are tracked over a rolling window of its calls.
+#   - The backends are ranked by the latency SLO first (p95 <= slo_ms and error rate <= max_error_rate): the ones that meet it over
+#     at least min_samples calls, then the ones with fewer calls (not measured yet), then the ones outside it. The price breaks the
+#     ties, so each request goes to the cheapest backend measured within the SLO. When none can meet it, the lowest p95 goes first.
+#   - Short factual questions go first to the small_backend, if there is one, within its SLO rank.
+#   - If the answer (or its first token, when streaming) has not arrived after hedge_deadline_ms, the same request is sent to the
+#     next backend and the first answer is used. If the backends running fail, the request falls back to the next backend not
+#     tried yet, until one answers or all of them have failed.
+# Each call runs in its own thread, so the hedges and fallbacks never wait behind the calls stuck on a slow backend, and the hedge
+# deadline counts from the moment the call is sent. The calls left running after the request is answered (the slower side of a
+# hedge) are abandoned: they still finish, and their costs count in the metrics of their backend, not in the answer. A backend with
+# max_abandoned_calls abandoned calls in flight goes last in the routing and gets no hedges, so a slowdown can not pile up threads on it.
+# The routing decision of the last call of each thread is kept, to be stored with the answer.
+class LLMRouter:
+
+    def __init__(self, backends=None, small_backend=None, slo_ms=LLM_LATENCY_SLO_MS, hedge_deadline_ms=LLM_HEDGE_DEADLINE_MS,
+                 max_error_rate=LLM_MAX_ERROR_RATE, min_samples=LLM_ROUTER_MIN_SAMPLES, max_abandoned_calls=LLM_ROUTER_MAX_ABANDONED_CALLS):
+        if backends is None:
+            backends = [get_llm_backend(name.strip()) for name in LLM_ROUTER_BACKENDS.split(",") if name.strip()]
+        if small_backend is None and LLM_ROUTER_SMALL_BACKEND:
+            small_backend = get_llm_backend(LLM_ROUTER_SMALL_BACKEND)
+
+        self.name = "router"
+        self.backends = sorted(backends, key=get_backend_price)
+        self.small_backend = small_backend
+        self.model = self.backends[0].model
+        self.slo = slo_ms / 1000
+        self.hedge_deadline = hedge_deadline_ms / 1000
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.max_abandoned_calls = max_abandoned_calls
+
+        self.stats = {backend.name: RollingStats() for backend in [*self.backends, small_backend] if backend is not None}
+        self.lock = threading.Lock()
+
+        # Calls in flight (backend name and whether they were abandoned), and abandoned calls in flight by backend
+        self.running_calls = {}
+        self.abandoned_calls = {name: 0 for name in self.stats}
+        self.counters = {"requests": 0, "hedged": 0, "fallbacks": 0, "short_questions": 0}
+
+        # Routing decision of the last call of each thread (each streamlit session runs in its own thread)
+        self.last_call = threading.local()
+
+
+    def meets_slo(self, backend):
+        return self.slo_rank(backend) < 2
+
+
+    # Rank of a backend by the latency SLO: 0 when it meets it over min_samples calls, 1 when it has fewer calls, 2 when it is outside it
+    def slo_rank(self, backend):
+        stats = self.stats[backend.name].snapshot()
+        if stats["samples"] < self.min_samples:
+            return 1
+        return 0 if stats["p95"] <= self.slo and stats["error_rate"] <= self.max_error_rate else 2
+
+
+    # Returns the backends to try in order, and the reason of the first one
+    def route(self, question=None):
+
+        # The backends are sorted by price, so the stable sort by SLO rank leaves the price as the tie-breaker
+        candidates = list(self.backends)
+        reason = "cheapest_within_slo"
+        if self.small_backend is not None and is_short_factual_question(question):
+            candidates = [self.small_backend, *[backend for backend in candidates if backend is not self.small_backend]]
+            reason = "short_question"
+
+        ranks = {backend.name: self.slo_rank(backend) for backend in candidates}
+        if all(rank == 2 for rank in ranks.values()):
+            return sorted(candidates, key=lambda backend: self.stats[backend.name].snapshot()["p95"]), "fastest_outside_slo"
+
+        # The saturated backends go last, whatever their rank
+        ordered_backends = sorted(candidates, key=lambda backend: (self.saturated(backend), ranks[backend.name]))
+        if ordered_backends[0] is not candidates[0]:
+            reason = "cheapest_within_slo"
+
+        return ordered_backends, reason
+
+
+    # Checks if a backend has too many abandoned calls in flight to get more calls
+    def saturated(self, backend):
+        with self.lock:
+            return self.abandoned_calls[backend.name] >= self.max_abandoned_calls
+
+
+    # Returns (and removes) the first backend not saturated of the remaining ones, or None
+    def pop_next_backend(self, remaining):
+        for position, backend in enumerate(remaining):
+            if not self.saturated(backend):
+                return remaining.pop(position)
+        return None
+
+
+    # Runs function(backend, *args) in a new thread. Returns a future with its result.
+    def start_call(self, function, backend, *args):
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def run():
+            try:
+                result = function(backend, *args)
+            except BaseException as error:
+                self.finish_call(future)
+                future.set_exception(error)
+                return
+            self.finish_call(future)
+            future.set_result(result)
+
+        with self.lock:
+            self.running_calls[future] = [backend.name, False]
+        threading.Thread(target=run, name=f"llm_router_{backend.name}", daemon=True).start()
+
+        return future
+
+
+    def finish_call(self, future):
+        with self.lock:
+            name, abandoned = self.running_calls.pop(future)
+            self.abandoned_calls[name] -= int(abandoned)
+
+
+    # Marks the calls still in flight whose result is not wanted anymore
+    def abandon_calls(self, futures):
+        with self.lock:
+            for future in futures:
+                call = self.running_calls.get(future)
+                if call is not None and not call[1]:
+                    call[1] = True
+                    self.abandoned_calls[call[0]] += 1
+
+
+    # Calls a backend, recording its latency in the stats of the backend
+    def attempt(self, backend, prompt):
+
+        start_time = time.perf_counter()
+        try:
+            result = backend.generate(prompt)
+        except Exception:
+            self.stats[backend.name].add(time.perf_counter() - start_time, error=True)
+            raise
+        self.stats[backend.name].add(time.perf_counter() - start_time)
+
+        return result
+
+
+    # Sends the request to the first backend, hedging with the next one or falling back to the remaining ones in order.
+    # Returns the answer, costs, tokens and the decision.
+    def route_and_generate(self, prompt, question=None):
+
+        ordered_backends, reason = self.route(question)
+        primary = ordered_backends[0]
+        remaining = list(ordered_backends[1:])
+        decision = {"route_reason": reason, "route_primary": primary.name, "route_hedged": False, "route_fallback": False,
+                    "route_primary_p95": self.stats[primary.name].snapshot()["p95"]}
+
+        start_time = time.perf_counter()
+        futures = {self.start_call(self.attempt, primary, prompt): primary}
+        hedge_checked = False
+        last_error = None
+        try:
+            while futures:
+                # The request is hedged once, while the first backend has not answered nor failed
+                waiting_hedge = bool(remaining) and not (hedge_checked or decision["route_fallback"])
+                timeout = max(self.hedge_deadline - (time.perf_counter() - start_time), 0) if waiting_hedge else None
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                if not done:
+                    hedge_checked = True
+                    backend = self.pop_next_backend(remaining)
+                    if backend is not None:
+                        decision["route_hedged"] = True
+                        futures[self.start_call(self.attempt, backend, prompt)] = backend
+                    continue
+
+                for future in done:
+                    backend = futures.pop(future)
+                    try:
+                        answer, costs, tokens = future.result()
+                    except Exception as error:
+                        last_error = error
+                        # Once no other request is running, the next backend not tried yet takes the request
+                        if remaining and not futures:
+                            decision["route_fallback"] = True
+                            backend = remaining.pop(0)
+                            futures[self.start_call(self.attempt, backend, prompt)] = backend
+                        continue
+                    # The latency of the answer includes the wait for the hedge or fallback
+                    self.count(decision)
+                    return answer, costs, tokens, {**decision, "model_used": backend.model, "llm_backend": backend.name,
+                                                   "llm_latency": time.perf_counter() - start_time}
+
+            self.count(decision)
+            raise last_error
+        finally:
+            self.abandon_calls(futures)
+
+
+    def count(self, decision):
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["hedged"] += decision["route_hedged"]
+            self.counters["fallbacks"] += decision["route_fallback"]
+            self.counters["short_questions"] += decision["route_reason"] == "short_question"
+
+
+    def generate(self, prompt, question=None):
+        answer, costs, tokens, self.last_call.decision = self.route_and_generate(prompt, question)
+        return answer, costs, tokens
+
+
+    # Async version of generate. The routing runs in a worker thread, and the decision is kept for the thread running the event loop.
+    async def agenerate(self, prompt, question=None):
+        answer, costs, tokens, self.last_call.decision = await asyncio.to_thread(self.route_and_generate, prompt, question)
+        return answer, costs, tokens
+
+
+    # Runs the stream of a backend in its own thread, putting its events in the shared queue until it ends or is cancelled
+    def run_stream(self, backend, prompt, events, cancelled):
+
+        start_time = time.perf_counter()
+        stream = backend.stream(prompt)
+        try:
+            for event in stream:
+                if cancelled.is_set():
+                    stream.close()
+                    # Cancelled for being slower than the other backend, its latency so far is only a lower bound
+                    self.stats[backend.name].add(time.perf_counter() - start_time, censored=True)
+                    return
+                events.put((backend, "event", event))
+        except Exception as error:
+            self.stats[backend.name].add(time.perf_counter() - start_time, error=True)
+            events.put((backend, "error", error))
+            return
+
+        self.stats[backend.name].add(time.perf_counter() - start_time)
+        events.put((backend, "done", None))
+
+
+    # Streaming version of generate. The hedge deadline applies to the first token, and once a backend has sent it the others are cancelled.
+    def stream(self, prompt, question=None):
+
+        ordered_backends, reason = self.route(question)
+        primary = ordered_backends[0]
+        remaining = list(ordered_backends[1:])
+        decision = {"route_reason": reason, "route_primary": primary.name, "route_hedged": False, "route_fallback": False,
+                    "route_primary_p95": self.stats[primary.name].snapshot()["p95"]}
+
+        events = queue.Queue()
+        cancelled = {}
+        futures = {}
+
+        def start(backend):
+            cancelled[backend.name] = threading.Event()
+            futures[backend.name] = self.start_call(self.run_stream, backend, prompt, events, cancelled[backend.name])
+
+        start(primary)
+
+        start_time = time.perf_counter()
+        winner = None
+        finished = False
+        hedge_checked = False
+        running = 1
+        try:
+            while True:
+                # The request is hedged once, while the first backend has not sent a token nor failed
+                waiting_hedge = winner is None and bool(remaining) and not (hedge_checked or decision["route_fallback"])
+                timeout = max(self.hedge_deadline - (time.perf_counter() - start_time), 0) if waiting_hedge else None
+                try:
+                    backend, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_checked = True
+                    backend = self.pop_next_backend(remaining)
+                    if backend is not None:
+                        decision["route_hedged"] = True
+                        start(backend)
+                        running += 1
+                    continue
+
+                if winner is not None and backend is not winner:
+                    continue
+
+                if kind == "error":
+                    running -= 1
+                    if winner is not None or (running == 0 and not remaining):
+                        raise value
+                    # Once no other stream is running, the next backend not tried yet takes the request
+                    if running == 0:
+                        decision["route_fallback"] = True
+                        start(remaining.pop(0))
+                        running += 1
+                    continue
+
+                if winner is None:
+                    winner = backend
+                    for name, event in cancelled.items():
+                        if name != winner.name:
+                            event.set()
+
+                if kind == "done":
+                    finished = True
+                    self.last_call.decision = {**decision, "model_used": winner.model, "llm_backend": winner.name,
+                                               "llm_latency": time.perf_counter() - start_time}
+                    return
+                yield value
+        finally:
+            # The stream of the winner is also cancelled if the caller stops reading it
+            self.count(decision)
+            for event in cancelled.values():
+                event.set()
+            self.abandon_calls([future for name, future in futures.items() if not (finished and name == winner.name)])
+
+
+    # Model, backend, latency and routing decision of the last call of the current thread, to be stored with the answer.
+    # The model is empty when the answer did not call the LLM (e.g. a semantic cache hit).
+    def last_call_metrics(self):
+        return dict(getattr(self.last_call, "decision", None) or self.empty_decision())
+
+
+    def empty_decision(self):
+        return {"model_used": "", "llm_backend": self.name, "llm_latency": 0.0, "route_reason": "", "route_primary": "",
+                "route_hedged": False, "route_fallback": False, "route_primary_p95": 0.0}
+
+
+    def reset_last_call(self):
+        self.last_call.decision = self.empty_decision()
+
+
+    # Counters of the router and rolling stats of each backend
+    def metrics(self):
+        with self.lock:
+            counters = dict(self.counters)
+        backends = {backend.name: backend for backend in [*self.backends, self.small_backend] if backend is not None}
+        return {**counters, "backends": {name: {**self.stats[name].snapshot(), "within_slo": self.meets_slo(backend),
+                                                "abandoned_calls": self.abandoned_calls[name]}
+                                         for name, backend in backends.items()}}
+
+
+
+# Function for checking the hedging under load with two fake LLM servers: a slow one, first in the routing, and a fast one.
+# concurrency requests are sent at the same time, and each one should be answered by the fast backend shortly after the hedge
+# deadline. Returns the backend and latency of each request, and the metrics of the router.
+def check_hedging_under_load(concurrency=16, slow_latency_ms=4000, fast_latency_ms=50, hedge_deadline_ms=200):
+
+    backends = []
+    for name, latency_ms in [("fake:slow", slow_latency_ms), ("fake:fast", fast_latency_ms)]:
+        host, port = start_fake_llm_server(latency_ms=latency_ms, token_ms=0).server_address[:2]
+        backends.append(OpenAIBackend(name=name, model=name, base_url=f"http://{host}:{port}/v1/", api_key="fake", max_retries=0, provider="fake"))
+
+    router = LLMRouter(backends=backends, hedge_deadline_ms=hedge_deadline_ms)
+
+    def send(position):
+        router.generate(f"Question {position} about Messi")
+        return router.last_call_metrics()
+
+    threads_results = [None] * concurrency
+    threads = [threading.Thread(target=lambda position=position: threads_results.__setitem__(position, send(position)))
+               for position in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return [(result["llm_backend"], result["llm_latency"]) for result in threads_results], router.metrics()
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+# Routing of the questions of a ground truth with the fake backends, for checking the hedging and fallback offline.
+# With --hedge-check, the concurrent requests are sent to a slow and a fast fake server (see check_hedging_under_load).
+# Usage: python llm_router.py --backends fake:big fake:small --small-backend fake:small --questions 20
+#        python llm_router.py --hedge-check --concurrency 16 --slow-latency-ms 4000 --fast-latency-ms 50 --hedge-deadline-ms 200
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Routes some questions and prints the decisions and the stats of the backends")
+    parser.add_argument("--backends", nargs="+", default=["fake"])
+    parser.add_argument("--small-backend", default=None)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--hedge-check", action="store_true", help="Checks the hedging of concurrent requests with a slow and a fast backend")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--slow-latency-ms", type=float, default=4000)
+    parser.add_argument("--fast-latency-ms", type=float, default=50)
+    parser.add_argument("--hedge-deadline-ms", type=float, default=200)
+    args = parser.parse_args()
+
+    if args.hedge_check:
+        results, metrics = check_hedging_under_load(args.concurrency, args.slow_latency_ms, args.fast_latency_ms, args.hedge_deadline_ms)
+        for backend_name, latency in results:
+            print(f"{backend_name}: {latency * 1000:.0f}ms")
+        answered_fast = sum(backend_name == "fake:fast" for backend_name, _ in results)
+        print(f"Answered by the fast backend: {answered_fast}/{len(results)}, max latency {max(latency for _, latency in results) * 1000:.0f}ms")
+        print(metrics)
+        raise SystemExit(0 if answered_fast == len(results) else 1)
+
+    router = LLMRouter(backends=[get_llm_backend(name) for name in args.backends],
+                       small_backend=get_llm_backend(args.small_backend) if args.small_backend else None)
+
+    sample_questions = ["¿Cuántos goles hizo Messi en 2012?", "¿Por qué Messi se fue del Barcelona en 2021?",
+                        "Who won the 2022 World Cup?", "Explain how Messi adapted his playing style over his career"]
+    for position in range(args.questions):
+        question = sample_questions[position % len(sample_questions)]
+        router.generate(question, question=question)
+        print(question, router.last_call_metrics())
+
+    print(router.metrics())
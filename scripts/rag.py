@@ -1,11 +1,20 @@
+import time
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
 from dotenv import load_dotenv
 
-from sentence_transformers import SentenceTransformer
+from embeddings import get_embedding_service
+
+from llm_backends import OPENAI_MODEL, calculate_cost, build_messages
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 from langchain.memory import ConversationBufferMemory
 
+from elasticsearch import ApiError, TransportError, AsyncElasticsearch
+
 
 
 
@@ -15,8 +24,17 @@ load_dotenv()
 # Instantiating the OpenAI Client
 OpenAI_client = OpenAI()
 
-# Initialize the embeddings model
-embeddings_model = SentenceTransformer('all-MiniLM-L6-v2') 
+# Shared embeddings service. The model is loaded once per process, and the query embeddings are cached.
+embeddings_model = get_embedding_service('all-MiniLM-L6-v2')
+
+# Thread pool for sending the searches concurrently
+search_executor = ThreadPoolExecutor(max_workers=4)
+
+# Thread for running the async pipeline from sync code called inside an event loop (e.g. a notebook)
+sync_runner_executor = ThreadPoolExecutor(max_workers=1)
+
+# Disabled once the server-side RRF is rejected as not supported by the license or the cluster
+server_side_rrf_available = True
 
 
 #############################################################################################
@@ -25,10 +43,10 @@ embeddings_model = SentenceTransformer('all-MiniLM-L6-v2')
 
 
 
-# Function to make a text search to the Elastic Search client
-def text_search(user_query, es_client, index):
+# Function for building the query of the text search
+def build_text_query(user_query, size=5):
     query = {
-        "size": 5,  
+        "size": size,  
         "query": {
             "bool": {
                 "must": [
@@ -42,21 +60,30 @@ def text_search(user_query, es_client, index):
         }
     }
 
-    results = es_client.search(index=index, body=query)
+    return query
+
+
+
+# Function to make a text search to the Elastic Search client
+def text_search(user_query, es_client, index, size=5):
+
+    results = es_client.search(index=index, body=build_text_query(user_query, size))
     
     return results["hits"]["hits"]
 
 
 
 # Function to make a KNN search to the Elastic Search client
-def knn_search(user_query, es_client, index, embeddings_model):
+# The query vector can be passed if it was already encoded.
+def knn_search(user_query, es_client, index, embeddings_model, size=5, query_vector=None):
 
-    user_query = embeddings_model.encode(user_query)
+    if query_vector is None:
+        query_vector = embeddings_model.encode(user_query)
 
     query = {
-        "k": 5,  
+        "k": size,  
         "field": "content_embeddings",
-        "query_vector": user_query
+        "query_vector": query_vector
     }
 
     results = es_client.search(index=index, knn=query)
@@ -65,18 +92,257 @@ def knn_search(user_query, es_client, index, embeddings_model):
 
 
 
+# Function to make a KNN search oversampled on the quantized vectors of the index, and rescored with the float vectors.
+# The oversample times size candidates of the kNN search are reordered by the exact cosine similarity (+ 1, as the scores can not be negative).
+def knn_rescore_search(user_query, es_client, index, embeddings_model, size=5, oversample=4, query_vector=None):
+
+    if query_vector is None:
+        query_vector = embeddings_model.encode(user_query)
+
+    query = {
+        "k": size * oversample,
+        "num_candidates": max(100, size * oversample),
+        "field": "content_embeddings",
+        "query_vector": query_vector
+    }
+
+    rescore = {
+        "window_size": size * oversample,
+        "query": {
+            "rescore_query": {
+                "script_score": {
+                    "query": {"match_all": {}},
+                    "script": {"source": "cosineSimilarity(params.query_vector, 'content_embeddings') + 1.0", "params": {"query_vector": query_vector}}
+                }
+            },
+            "query_weight": 0,
+            "rescore_query_weight": 1
+        }
+    }
+
+    results = es_client.search(index=index, knn=query, rescore=rescore, size=size)
+
+    return results["hits"]["hits"]
+
+
+
+# Function for tagging the hits of a search with its name, so the lists concatenated by hybrid_search can be told apart
+def tag_hits(hits, search):
+    return [{**hit, "_search": search} for hit in hits]
+
+
+
 # Function to make an hybrid search using the text search and knn search
 def hybrid_search(user_query, es_client, index, embeddings_model):
 
     text_results = text_search(user_query=user_query, es_client=es_client, index=index)
     knn_results = knn_search(user_query=user_query, es_client=es_client, index=index, embeddings_model=embeddings_model)
         
-    combined_results = text_results + knn_results
+    combined_results = tag_hits(text_results, "text") + tag_hits(knn_results, "knn")
     
     return combined_results
 
 
 
+# Function for calculating the Reciprocal Rank Fusion score of a rank
+def compute_rrf(rank, k=60):
+    return 1 / (k + rank)
+
+
+
+# Function for fusing several lists of hits with RRF. The hits are deduplicated by chunk_id (or document id).
+def rrf_fuse(hits_lists, size=5, k=60):
+
+    rrf_scores = {}
+    fused_hits = {}
+
+    for hits in hits_lists:
+        for rank, hit in enumerate(hits):
+            doc_id = hit["_source"].get("chunk_id") or hit["_id"]
+            rrf_scores[doc_id] = rrf_scores.get(doc_id, 0) + compute_rrf(rank + 1, k)
+            fused_hits.setdefault(doc_id, hit)
+
+    reranked_doc_ids = sorted(rrf_scores, key=rrf_scores.get, reverse=True)[:size]
+
+    return [{**fused_hits[doc_id], "_score": rrf_scores[doc_id]} for doc_id in reranked_doc_ids]
+
+
+
+# Function for building the elasticsearch RRF retriever of the BM25 and kNN searches
+def build_rrf_retriever(user_query, query_vector, rank_window_size=20, rank_constant=60):
+    retriever = {
+        "rrf": {
+            "retrievers": [
+                {"standard": {"query": {"match": {"content": user_query}}}},
+                {"knn": {"field": "content_embeddings", "query_vector": query_vector, "k": rank_window_size,
+                         "num_candidates": max(100, rank_window_size)}},
+            ],
+            "rank_window_size": rank_window_size,
+            "rank_constant": rank_constant,
+        }
+    }
+
+    return retriever
+
+
+
+# Function for checking if an error of the server-side RRF means that the cluster can not run it at all: the license does not
+# include it (403, or 400 on some versions) or the cluster does not know the retriever (400). Other errors (e.g. 429, 503 or a
+# timeout) are transient, and only that request is fused on the client.
+def is_rrf_unsupported_error(error):
+
+    if not isinstance(error, ApiError) or error.status_code not in (400, 403):
+        return False
+
+    message = str(error).lower()
+
+    return "license" in message or (error.status_code == 400 and ("retriever" in message or "rrf" in message))
+
+
+
+# Function for handling a failure of the server-side RRF, disabling it if the cluster can not run it
+def handle_rrf_error(error):
+
+    global server_side_rrf_available
+
+    if is_rrf_unsupported_error(error):
+        print(f"Server-side RRF not available, fusing on the client: {error}")
+        server_side_rrf_available = False
+    else:
+        print(f"Server-side RRF failed, fusing this search on the client: {error}")
+
+
+
+# Function to make an hybrid search fused with RRF, returning only the top-k deduplicated chunks.
+# BM25 and kNN are sent in a single request with the elasticsearch RRF retriever. If the cluster does not support it
+# (RRF needs an enterprise or trial license), both searches are sent concurrently and fused with RRF on the client.
+def hybrid_search_rrf(user_query, es_client, index, embeddings_model, size=5, rank_window_size=20, rank_constant=60):
+
+    query_vector = embeddings_model.encode(user_query).tolist()
+
+    if server_side_rrf_available:
+        retriever = build_rrf_retriever(user_query, query_vector, rank_window_size, rank_constant)
+        try:
+            results = es_client.search(index=index, retriever=retriever, size=size)
+            return results["hits"]["hits"]
+        except (ApiError, TransportError) as e:
+            handle_rrf_error(e)
+
+    text_future = search_executor.submit(text_search, user_query=user_query, es_client=es_client, index=index, size=rank_window_size)
+    knn_future = search_executor.submit(knn_search, user_query=user_query, es_client=es_client, index=index, embeddings_model=embeddings_model,
+                                        size=rank_window_size, query_vector=query_vector)
+
+    return rrf_fuse([text_future.result(), knn_future.result()], size=size, k=rank_constant)
+
+
+
+# Function for sending a request with a sync or an async elasticsearch client without blocking the event loop.
+# The methods of the sync client are run in a worker thread.
+async def async_es_call(es_client, method, **kwargs):
+
+    if isinstance(es_client, AsyncElasticsearch):
+        return await method(**kwargs)
+
+    return await asyncio.to_thread(method, **kwargs)
+
+
+
+# Function for encoding a query without blocking the event loop
+async def async_encode_query(user_query, embeddings_model):
+
+    if hasattr(embeddings_model, "aencode_query"):
+        return await embeddings_model.aencode_query(user_query)
+
+    return await asyncio.to_thread(embeddings_model.encode, user_query)
+
+
+
+# Async version of text_search
+async def atext_search(user_query, es_client, index, size=5):
+
+    results = await async_es_call(es_client, es_client.search, index=index, body=build_text_query(user_query, size))
+
+    return results["hits"]["hits"]
+
+
+
+# Async version of knn_search
+async def aknn_search(user_query, es_client, index, embeddings_model, size=5, query_vector=None):
+
+    if query_vector is None:
+        query_vector = await async_encode_query(user_query, embeddings_model)
+
+    query = {
+        "k": size,
+        "field": "content_embeddings",
+        "query_vector": query_vector
+    }
+
+    results = await async_es_call(es_client, es_client.search, index=index, knn=query)
+
+    return results["hits"]["hits"]
+
+
+
+# Async version of hybrid_search. The text search runs while the query is encoded and searched with kNN.
+async def ahybrid_search(user_query, es_client, index, embeddings_model):
+
+    text_results, knn_results = await asyncio.gather(
+        atext_search(user_query=user_query, es_client=es_client, index=index),
+        aknn_search(user_query=user_query, es_client=es_client, index=index, embeddings_model=embeddings_model),
+    )
+
+    return tag_hits(text_results, "text") + tag_hits(knn_results, "knn")
+
+
+
+# Async version of hybrid_search_rrf. Without the server-side RRF, the text search runs while the query is encoded
+# and searched with kNN, and both lists are fused on the client.
+async def ahybrid_search_rrf(user_query, es_client, index, embeddings_model, size=5, rank_window_size=20, rank_constant=60):
+
+    query_vector = None
+
+    if server_side_rrf_available:
+        query_vector = (await async_encode_query(user_query, embeddings_model)).tolist()
+        retriever = build_rrf_retriever(user_query, query_vector, rank_window_size, rank_constant)
+        try:
+            results = await async_es_call(es_client, es_client.search, index=index, retriever=retriever, size=size)
+            return results["hits"]["hits"]
+        except (ApiError, TransportError) as e:
+            handle_rrf_error(e)
+
+    text_results, knn_results = await asyncio.gather(
+        atext_search(user_query=user_query, es_client=es_client, index=index, size=rank_window_size),
+        aknn_search(user_query=user_query, es_client=es_client, index=index, embeddings_model=embeddings_model,
+                    size=rank_window_size, query_vector=query_vector),
+    )
+
+    return rrf_fuse([text_results, knn_results], size=size, k=rank_constant)
+
+
+
+# Function for running a search function, sync or async, without blocking the event loop
+async def arun_search(search_function, **kwargs):
+
+    if inspect.iscoroutinefunction(search_function):
+        return await search_function(**kwargs)
+
+    return await asyncio.to_thread(search_function, **kwargs)
+
+
+
+# Function for getting the arguments of a search function. With a reranker, the search functions with a size parameter
+# retrieve its number of candidates, to be reranked down to its top_n (hybrid_search always retrieves 5 + 5 chunks).
+def get_search_kwargs(search_function, question, es_client, index_name, embeddings_model, reranker=None):
+
+    search_kwargs = {"user_query": question, "es_client": es_client, "index": index_name, "embeddings_model": embeddings_model}
+    if reranker is not None and "size" in inspect.signature(search_function).parameters:
+        search_kwargs["size"] = reranker.candidates
+
+    return search_kwargs
+
+
+
 # Function for get the text content of the answers
 def get_answers_content(answers):
 
@@ -115,44 +381,26 @@ QUESTION:
 
 
 
-# Function for calculate the cost of the interaction with the llm
-def calculate_cost(response):
-
-    input_tokens = response.usage.prompt_tokens
-    output_tokens = response.usage.completion_tokens
+# Function for building the prompt of a question, within the token budget of the context_assembler if there is one
+def assemble_prompt(question, top_k_chunks, memory, context_assembler=None):
 
-    input_tokens_cost_per_1k = 0.00015
-    output_tokens_cost_per_1k = 0.0006
+    if context_assembler is None:
+        return build_prompt(query=question, search_results_text_list=get_answers_content(top_k_chunks), conversation_history=memory)
 
-    input_tokens_cost = input_tokens_cost_per_1k * (input_tokens / 1000)
-    output_tokens_cost = output_tokens_cost_per_1k * (output_tokens / 1000)
-    total_cost = input_tokens_cost + output_tokens_cost
+    prompt, _ = context_assembler.assemble(question, top_k_chunks, memory)
 
-    costs = {"input_tokens_cost":input_tokens_cost,
-             "output_tokens_cost":output_tokens_cost,
-             "total_cost":total_cost}
-    
-    tokens = {"input_tokens":input_tokens,
-              "output_tokens":output_tokens,
-              "total_tokens":input_tokens+output_tokens}
-    #print("------------------------------------")
-    #print(f"Input Tokens: {input_tokens}       Cost: ${input_tokens_cost:.8f}")
-    #print(f"Completion Tokens: {output_tokens}       Cost: ${output_tokens_cost:.8f}")
-    #print(f"Total Cost: ${total_cost:.8f}")
-    #print("------------------------------------")
-
-    return costs, tokens
+    return prompt
 
 
 
 # Function for generate the answer with the LLM
-def llm_generate_answer(prompt, open_ai_client):
+def llm_generate_answer(prompt, open_ai_client, model=OPENAI_MODEL):
     response = open_ai_client.chat.completions.create(
-        model='gpt-4o-mini',
-        messages=[{"role": "user", "content": prompt}]
+        model=model,
+        messages=build_messages(prompt)
     )
     
-    costs, tokens = calculate_cost(response)
+    costs, tokens = calculate_cost(response, model)
 
     print(f"COSTS = {costs}")
 
@@ -160,21 +408,203 @@ def llm_generate_answer(prompt, open_ai_client):
 
 
 
-# Function that handles the request of generate the answer. Including the retrieval, prompt building and all the steps.
-def generate_answer(question, es_client, index_name, memory, embeddings_model=embeddings_model, search_function=hybrid_search, open_ai_client=OpenAI_client):
+# Async version of llm_generate_answer. A sync OpenAI client is run in a worker thread.
+async def allm_generate_answer(prompt, open_ai_client, model=OPENAI_MODEL):
 
-    top_k_chunks = search_function(user_query=question, es_client=es_client, index=index_name, embeddings_model=embeddings_model)
+    if not isinstance(open_ai_client, AsyncOpenAI):
+        return await asyncio.to_thread(llm_generate_answer, prompt, open_ai_client, model)
 
-    answers = get_answers_content(top_k_chunks)
-    
-    builded_prompt = build_prompt(query=question, search_results_text_list=answers, conversation_history=memory)
-    
-    answer, costs, tokens = llm_generate_answer(builded_prompt, open_ai_client=open_ai_client)
+    response = await open_ai_client.chat.completions.create(
+        model=model,
+        messages=build_messages(prompt)
+    )
+
+    costs, tokens = calculate_cost(response, model)
+
+    print(f"COSTS = {costs}")
+
+    return response.choices[0].message.content, costs, tokens
+
+
+
+# Streamed answer of the LLM. Iterating it yields the text deltas as they are generated.
+# Once consumed, it holds the whole answer, the costs and tokens (from the usage sent at the end of the stream)
+# and the moment the first token arrived. The costs use the prices of the model that generated it.
+class StreamedAnswer:
+
+    def __init__(self, deltas, on_complete=None, model=OPENAI_MODEL):
+        self.deltas = deltas
+        self.model = model
+        self.on_complete = on_complete
+        self.answer = ""
+        self.costs = {"input_tokens_cost": 0.0, "output_tokens_cost": 0.0, "total_cost": 0.0, "prompt_cache_savings": 0.0}
+        self.tokens = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+        self.first_token_time = None
+
+    def __iter__(self):
+        answer_parts = []
+        for delta in self.deltas:
+            if isinstance(delta, str):
+                if self.first_token_time is None:
+                    self.first_token_time = time.time()
+                answer_parts.append(delta)
+                yield delta
+            elif isinstance(delta, tuple):
+                # The streams of the LLM backends end with the costs and tokens, already priced by the backend
+                self.costs, self.tokens = delta
+            else:
+                # The last event of the stream carries the usage of the whole request, and the model that generated it
+                self.costs, self.tokens = calculate_cost(delta, getattr(delta, "model", None) or self.model)
+        self.answer = "".join(answer_parts)
+        if self.on_complete is not None:
+            self.on_complete(self)
+
+
+
+# Function for generate the answer with the LLM as a stream of deltas.
+# stream_options include_usage makes the last event carry the token usage, so the cost can still be calculated.
+def llm_generate_answer_stream(prompt, open_ai_client, model=OPENAI_MODEL):
+    stream = open_ai_client.chat.completions.create(
+        model=model,
+        messages=build_messages(prompt),
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+    for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+        if event.usage is not None:
+            yield event
+
+
+
+# Function that handles the request of generate the answer, asynchronously. Including the retrieval, prompt building and all the steps.
+# It accepts sync or async clients (Elasticsearch/AsyncElasticsearch, OpenAI/AsyncOpenAI). The calls of the sync clients run in worker threads.
+# The search_function can be sync or async. By default the BM25 and kNN searches run concurrently (ahybrid_search_rrf).
+# With a semantic_cache, questions without conversation history are first looked up in the cache of past answers.
+# With a context_assembler, the prompt is assembled within its token budget instead of with build_prompt.
+# With an llm_backend (see llm_backends.py), the answer is generated by it instead of by the open_ai_client, recording the model and latency.
+# With a reranker (see reranker.py), the retrieved chunks are reranked with a cross-encoder and only its top_n go to the prompt.
+async def agenerate_answer(question, es_client, index_name, memory, embeddings_model=embeddings_model, search_function=None,
+                           open_ai_client=OpenAI_client, semantic_cache=None, context_assembler=None, llm_backend=None, reranker=None):
+
+    if search_function is None:
+        search_function = ahybrid_search_rrf
+
+    # The cached answers do not depend on a conversation, so the cache is only used for the first question
+    use_semantic_cache = semantic_cache is not None and not memory.chat_memory.messages
+
+    if semantic_cache is not None:
+        semantic_cache.reset_last_lookup()
+
+    if context_assembler is not None:
+        context_assembler.reset_last_assembly()
+
+    if llm_backend is not None:
+        llm_backend.reset_last_call()
+
+    if reranker is not None:
+        reranker.reset_last_rerank()
+
+    if use_semantic_cache:
+        await semantic_cache.acheck_index(es_client, index_name)
+        query_vector = await async_encode_query(question, embeddings_model)
+        cached_entry = semantic_cache.lookup(query_vector, index_name)
+        if cached_entry is not None:
+            costs = {"input_tokens_cost": 0.0, "output_tokens_cost": 0.0, "total_cost": 0.0, "prompt_cache_savings": 0.0}
+            tokens = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+            return cached_entry["answer"], costs, tokens
+
+    top_k_chunks = await arun_search(search_function, **get_search_kwargs(search_function, question, es_client, index_name, embeddings_model, reranker))
+
+    if reranker is not None:
+        top_k_chunks = await reranker.arerank(question, top_k_chunks)
+
+    builded_prompt = assemble_prompt(question, top_k_chunks, memory, context_assembler)
+
+    if llm_backend is not None:
+        answer, costs, tokens = await llm_backend.agenerate(builded_prompt, question=question)
+    else:
+        answer, costs, tokens = await allm_generate_answer(builded_prompt, open_ai_client=open_ai_client)
+
+    if use_semantic_cache:
+        semantic_cache.add(question, query_vector, index_name, answer, costs, tokens)
 
     return answer, costs, tokens
 
 
 
+# Function for running a coroutine from sync code. Inside a running event loop it is run in a worker thread.
+def run_sync(coroutine):
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    return sync_runner_executor.submit(asyncio.run, coroutine).result()
+
+
+
+# Function that handles the request of generate the answer. Sync wrapper of agenerate_answer.
+# Each call runs its own event loop, so it should be used with the sync clients. The async clients belong to a long-lived
+# event loop, where agenerate_answer should be awaited directly.
+def generate_answer(question, es_client, index_name, memory, embeddings_model=embeddings_model, search_function=None, open_ai_client=OpenAI_client,
+                    semantic_cache=None, context_assembler=None, llm_backend=None, reranker=None):
+
+    return run_sync(agenerate_answer(question, es_client, index_name, memory, embeddings_model=embeddings_model, search_function=search_function,
+                                     open_ai_client=open_ai_client, semantic_cache=semantic_cache, context_assembler=context_assembler,
+                                     llm_backend=llm_backend, reranker=reranker))
+
+
+
+
+
+# Streaming version of generate_answer. It returns a StreamedAnswer to be rendered while it is generated.
+# The retrieval runs when the iteration starts, and the semantic cache is updated when the stream is completed.
+def generate_answer_stream(question, es_client, index_name, memory, embeddings_model=embeddings_model, search_function=None,
+                           open_ai_client=OpenAI_client, semantic_cache=None, context_assembler=None, llm_backend=None, reranker=None):
+
+    use_semantic_cache = semantic_cache is not None and not memory.chat_memory.messages
+
+    if semantic_cache is not None:
+        semantic_cache.reset_last_lookup()
+
+    if context_assembler is not None:
+        context_assembler.reset_last_assembly()
+
+    if llm_backend is not None:
+        llm_backend.reset_last_call()
+
+    if reranker is not None:
+        reranker.reset_last_rerank()
+
+    if use_semantic_cache:
+        semantic_cache.check_index(es_client, index_name)
+        query_vector = embeddings_model.encode(question)
+        cached_entry = semantic_cache.lookup(query_vector, index_name)
+        if cached_entry is not None:
+            return StreamedAnswer(iter([cached_entry["answer"]]))
+
+    def deltas():
+        stream_search_function = search_function or ahybrid_search_rrf
+        top_k_chunks = run_sync(arun_search(stream_search_function, **get_search_kwargs(stream_search_function, question, es_client, index_name,
+                                                                                        embeddings_model, reranker)))
+        if reranker is not None:
+            top_k_chunks = reranker.rerank(question, top_k_chunks)
+        builded_prompt = assemble_prompt(question, top_k_chunks, memory, context_assembler)
+        if llm_backend is not None:
+            yield from llm_backend.stream(builded_prompt, question=question)
+        else:
+            yield from llm_generate_answer_stream(builded_prompt, open_ai_client=open_ai_client)
+
+    def add_to_semantic_cache(streamed_answer):
+        semantic_cache.add(question, query_vector, index_name, streamed_answer.answer, streamed_answer.costs, streamed_answer.tokens)
+
+    return StreamedAnswer(deltas(), on_complete=add_to_semantic_cache if use_semantic_cache else None,
+                          model=llm_backend.model if llm_backend is not None else OPENAI_MODEL)
+
 
 
 #############################################################################################
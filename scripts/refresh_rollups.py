@@ -0,0 +1,33 @@
+import os
+import time
+import argparse
+
+os.environ['RUN_TIMEZONE_CHECK'] = '0'
+
+from db import refresh_rollups
+
+
+
+
+# Incremental refresh of the monitoring rollups queried by the Grafana dashboard.
+# The telemetry writer of the app already refreshes them after writing new rows; this script is meant for a cron job,
+# or to run as a loop with --interval.
+# Usage: python refresh_rollups.py [--interval 60]
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Incremental refresh of the monitoring rollups")
+    parser.add_argument("--interval", type=float, default=0, help="Seconds between refreshes. With 0 it refreshes once.")
+    args = parser.parse_args()
+
+    while True:
+        start_time = time.perf_counter()
+        refreshed_buckets = refresh_rollups()
+        print(f"Refreshed buckets: {refreshed_buckets} ({time.perf_counter() - start_time:.2f} seconds)")
+
+        if not args.interval:
+            break
+        time.sleep(args.interval)
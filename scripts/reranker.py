@@ -0,0 +1,188 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+from embeddings import content_hash, normalize_query
+
+
+
+
+# Default configuration of the reranking, overridable from the environment.
+RERANKER_MODEL_NAME = os.getenv("RERANKER_MODEL_NAME", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANKER_DEVICE = os.getenv("RERANKER_DEVICE", "cpu")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "3"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "50000"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "512"))
+
+# Rerankers already loaded in this process, by model name
+rerankers = {}
+rerankers_lock = threading.Lock()
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for removing the repeated chunks of the hits (e.g. found by both searches of hybrid_search), keeping the first one
+def deduplicate_hits(hits):
+
+    unique_hits = {}
+    for hit in hits:
+        unique_hits.setdefault(hit["_source"].get("chunk_id") or hit["_id"], hit)
+
+    return list(unique_hits.values())
+
+
+
+# Reranker of the retrieved chunks with a cross-encoder, which scores each (question, chunk) pair together and is more precise
+# than the BM25 and kNN scores. The candidates of a search are scored in a single batched forward pass on the CPU, and only
+# the top_n are kept, so fewer chunks go to the prompt.
+# The scores are kept in a bounded LRU cache keyed by the normalized question and the content hash of the chunk, so repeated
+# questions only score the chunks not seen before. The model is loaded once, when it is first needed.
+class CrossEncoderReranker:
+
+    def __init__(self, model_name=RERANKER_MODEL_NAME, top_n=RERANK_TOP_N, candidates=RERANK_CANDIDATES, batch_size=RERANK_BATCH_SIZE,
+                 cache_size=RERANK_CACHE_SIZE, max_length=RERANK_MAX_LENGTH, device=RERANKER_DEVICE):
+        self.model_name = model_name
+        self.top_n = top_n
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.max_length = max_length
+        self.device = device
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reranks = 0
+        self.total_rerank_time = 0.0
+        self.model_load_time = None
+        self._model = None
+
+        # Metrics of the last rerank of each thread (each streamlit session runs in its own thread)
+        self.last_rerank = threading.local()
+
+
+    @property
+    def model(self):
+        with self.lock:
+            if self._model is None:
+                # Imported here so the module can be used without loading torch until a model is needed
+                from sentence_transformers import CrossEncoder
+                start_time = time.perf_counter()
+                self._model = CrossEncoder(self.model_name, max_length=self.max_length, device=self.device)
+                self.model_load_time = time.perf_counter() - start_time
+        return self._model
+
+
+    # Returns the scores of the (question, content) pairs. The pairs not in the cache are scored in a single batch.
+    def score(self, question, contents):
+
+        normalized_question = normalize_query(question)
+        keys = [(normalized_question, content_hash(content)) for content in contents]
+
+        scores = {}
+        with self.lock:
+            for key in keys:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    scores[key] = self.cache[key]
+
+        missing = {key: content for key, content in zip(keys, contents) if key not in scores}
+        if missing:
+            # With batch_size >= candidates the whole search is a single forward pass
+            predicted = self.model.predict([(question, content) for content in missing.values()], batch_size=max(self.batch_size, len(missing)),
+                                           show_progress_bar=False)
+            with self.lock:
+                for key, score in zip(missing, predicted):
+                    scores[key] = self.cache[key] = float(score)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        return [scores[key] for key in keys], len(keys) - len(missing)
+
+
+    # Returns the top_n hits sorted by their cross-encoder score (in _score), and the metrics of the rerank
+    def rerank_hits(self, question, hits, top_n=None):
+
+        start_time = time.perf_counter()
+        unique_hits = deduplicate_hits(hits)
+        scores, cache_hits = self.score(question, [hit["_source"]["content"] for hit in unique_hits])
+
+        ranked_hits = sorted(({**hit, "_score": score} for hit, score in zip(unique_hits, scores)), key=lambda hit: hit["_score"], reverse=True)
+        rerank_time = time.perf_counter() - start_time
+
+        with self.lock:
+            self.reranks += 1
+            self.total_rerank_time += rerank_time
+
+        metrics = {"rerank_time": rerank_time, "rerank_candidates": len(unique_hits), "rerank_cache_hits": cache_hits}
+
+        return ranked_hits[:top_n or self.top_n], metrics
+
+
+    def rerank(self, question, hits, top_n=None):
+
+        ranked_hits, self.last_rerank.metrics = self.rerank_hits(question, hits, top_n)
+
+        return ranked_hits
+
+
+    # Async version of rerank. The model runs in a worker thread, and the metrics are kept for the thread running the event loop.
+    async def arerank(self, question, hits, top_n=None):
+
+        ranked_hits, self.last_rerank.metrics = await asyncio.to_thread(self.rerank_hits, question, hits, top_n)
+
+        return ranked_hits
+
+
+    # Metrics of the last rerank of the current thread, to be stored with the answer
+    def last_rerank_metrics(self):
+        return dict(getattr(self.last_rerank, "metrics", None) or {"rerank_time": 0.0, "rerank_candidates": 0, "rerank_cache_hits": 0})
+
+
+    def reset_last_rerank(self):
+        self.last_rerank.metrics = None
+
+
+    def metrics(self):
+        with self.lock:
+            pairs_count = self.hits + self.misses
+            return {
+                "model_name": self.model_name,
+                "model_load_time": self.model_load_time,
+                "reranks": self.reranks,
+                "pair_hits": self.hits,
+                "pair_misses": self.misses,
+                "hit_rate": self.hits / pairs_count if pairs_count else 0.0,
+                "avg_rerank_time": self.total_rerank_time / self.reranks if self.reranks else 0.0,
+                "cache_entries": len(self.cache),
+            }
+
+
+
+# Function for getting the reranker of a model. The reranker (and its model) is created once per process.
+def get_reranker(model_name=RERANKER_MODEL_NAME):
+
+    with rerankers_lock:
+        if model_name not in rerankers:
+            rerankers[model_name] = CrossEncoderReranker(model_name)
+
+    return rerankers[model_name]
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
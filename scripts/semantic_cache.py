@@ -0,0 +1,230 @@
+import os
+import time
+import asyncio
+import threading
+
+import numpy as np
+
+from elasticsearch import AsyncElasticsearch
+
+from vector_index import get_vector_index_dir
+from bm25 import get_bm25_index_dir
+
+
+
+
+# Default configuration of the semantic answers cache, overridable from the environment.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+SEMANTIC_CACHE_INDEX_CHECK_SECONDS = float(os.getenv("SEMANTIC_CACHE_INDEX_CHECK_SECONDS", "30"))
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for getting a fingerprint of the content of an elasticsearch index.
+# It changes whenever documents are indexed or deleted, which invalidates the cached answers.
+def get_index_fingerprint(es_client, index_name):
+
+    return index_fingerprint_from_stats(es_client.indices.stats(index=index_name, metric=["docs", "indexing"]))
+
+
+
+# Async version of get_index_fingerprint. A sync client is run in a worker thread.
+async def aget_index_fingerprint(es_client, index_name):
+
+    if not isinstance(es_client, AsyncElasticsearch):
+        return await asyncio.to_thread(get_index_fingerprint, es_client, index_name)
+
+    return index_fingerprint_from_stats(await es_client.indices.stats(index=index_name, metric=["docs", "indexing"]))
+
+
+
+# Function for getting a fingerprint of the local vector and BM25 indexes of an index (see vector_index.py and bm25.py), for the
+# retrieval without elasticsearch. It changes whenever one of them is rebuilt, as the builds write a new meta.json.
+def get_local_index_fingerprint(index_name):
+
+    fingerprint = []
+    for index_dir in (get_vector_index_dir(index_name), get_bm25_index_dir(index_name)):
+        metadata_path = os.path.join(index_dir, "meta.json")
+        fingerprint.append(os.path.getmtime(metadata_path) if os.path.exists(metadata_path) else None)
+
+    return tuple(fingerprint)
+
+
+
+def index_fingerprint_from_stats(index_stats):
+
+    stats = index_stats["_all"]["primaries"]
+
+    return (stats["docs"]["count"], stats["docs"]["deleted"], stats["indexing"]["index_total"], stats["indexing"]["delete_total"])
+
+
+
+# Semantic cache of answers. The embeddings of the past questions are kept in a small in-memory matrix, and a new question
+# gets the stored answer when its cosine similarity with a past question is above the threshold.
+# Entries expire after ttl_seconds, the least recently used entry is evicted when the cache is full, and the whole cache
+# is cleared when the content of the index changes. With local_index, the content is checked on the local indexes of the
+# embedded retrieval instead of on elasticsearch, so the cache works without it.
+class SemanticAnswerCache:
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 index_check_seconds=SEMANTIC_CACHE_INDEX_CHECK_SECONDS, local_index=False):
+        self.local_index = local_index
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.index_check_seconds = index_check_seconds
+        self.lock = threading.Lock()
+
+        self.vectors = None             # (n, dims) matrix of normalized question embeddings
+        self.entries = []               # Row i of the matrix belongs to entries[i]
+        self.index_fingerprints = {}
+        self.index_checked_at = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        # Result of the last lookup of each thread (each streamlit session runs in its own thread)
+        self.last_lookup = threading.local()
+
+
+    @staticmethod
+    def normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+    def clear(self):
+        with self.lock:
+            self.vectors = None
+            self.entries = []
+
+
+    # Clearing the cache if the content of the index changed. The index is checked at most every index_check_seconds.
+    def check_index(self, es_client, index_name):
+
+        if not self.is_index_check_due(index_name):
+            return
+
+        if self.local_index:
+            self.update_index_fingerprint(index_name, get_local_index_fingerprint(index_name))
+        else:
+            self.update_index_fingerprint(index_name, get_index_fingerprint(es_client, index_name))
+
+
+    async def acheck_index(self, es_client, index_name):
+
+        if not self.is_index_check_due(index_name):
+            return
+
+        if self.local_index:
+            self.update_index_fingerprint(index_name, get_local_index_fingerprint(index_name))
+        else:
+            self.update_index_fingerprint(index_name, await aget_index_fingerprint(es_client, index_name))
+
+
+    def is_index_check_due(self, index_name):
+
+        now = time.monotonic()
+        if now - self.index_checked_at.get(index_name, 0) < self.index_check_seconds:
+            return False
+        self.index_checked_at[index_name] = now
+        return True
+
+
+    def update_index_fingerprint(self, index_name, fingerprint):
+
+        if self.index_fingerprints.get(index_name) not in (None, fingerprint):
+            self.clear()
+        self.index_fingerprints[index_name] = fingerprint
+
+
+    def remove_rows(self, rows):
+        keep = [row for row in range(len(self.entries)) if row not in set(rows)]
+        self.entries = [self.entries[row] for row in keep]
+        self.vectors = self.vectors[keep] if keep else None
+
+
+    # Returns the cached entry of the most similar past question, or None
+    def lookup(self, query_vector, index_name):
+
+        query_vector = self.normalize(query_vector)
+        now = time.time()
+        entry = None
+        similarity = 0.0
+
+        with self.lock:
+            if self.entries:
+                expired_rows = [row for row, cached in enumerate(self.entries) if now - cached["created_at"] > self.ttl_seconds]
+                if expired_rows:
+                    self.remove_rows(expired_rows)
+
+            # Only the questions answered from the same index are compared, so a closer question of another index does not hide them
+            index_rows = [row for row, cached in enumerate(self.entries) if cached["index_name"] == index_name]
+            if index_rows:
+                similarities = self.vectors[index_rows] @ query_vector
+                best_row = index_rows[int(np.argmax(similarities))]
+                similarity = float(similarities.max())
+                if similarity >= self.threshold:
+                    entry = self.entries[best_row]
+                    entry["last_used_at"] = now
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        self.last_lookup.hit = entry is not None
+        self.last_lookup.similarity = similarity
+        self.last_lookup.cost_saved = entry["costs"]["total_cost"] if entry else 0.0
+
+        return entry
+
+
+    def add(self, question, query_vector, index_name, answer, costs, tokens):
+
+        query_vector = self.normalize(query_vector)
+        now = time.time()
+
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                least_recently_used_row = min(range(len(self.entries)), key=lambda row: self.entries[row]["last_used_at"])
+                self.remove_rows([least_recently_used_row])
+
+            self.entries.append({"question": question, "index_name": index_name, "answer": answer, "costs": costs, "tokens": tokens,
+                                 "created_at": now, "last_used_at": now})
+            self.vectors = query_vector[None, :] if self.vectors is None else np.vstack([self.vectors, query_vector])
+
+
+    # Metrics of the last lookup done by the current thread, to be stored with the answer
+    def last_lookup_metrics(self):
+        return {
+            "semantic_cache_hit": getattr(self.last_lookup, "hit", False),
+            "semantic_cache_similarity": getattr(self.last_lookup, "similarity", 0.0),
+            "cost_saved": getattr(self.last_lookup, "cost_saved", 0.0),
+        }
+
+
+    def reset_last_lookup(self):
+        self.last_lookup.hit = False
+        self.last_lookup.similarity = 0.0
+        self.last_lookup.cost_saved = 0.0
+
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
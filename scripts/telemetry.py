@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+from db import refresh_rollups, save_batch, tz
+
+
+
+
+# Default configuration of the telemetry writer, overridable from the environment.
+TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", "50"))
+TELEMETRY_FLUSH_SECONDS = float(os.getenv("TELEMETRY_FLUSH_SECONDS", "2"))
+TELEMETRY_MAX_QUEUE_SIZE = int(os.getenv("TELEMETRY_MAX_QUEUE_SIZE", "10000"))
+TELEMETRY_RETRY_SECONDS = float(os.getenv("TELEMETRY_RETRY_SECONDS", "30"))
+TELEMETRY_SPILL_PATH = os.getenv("TELEMETRY_SPILL_PATH", "../data/telemetry/spill.jsonl")
+TELEMETRY_ROLLUP_REFRESH_SECONDS = float(os.getenv("TELEMETRY_ROLLUP_REFRESH_SECONDS", "60"))
+TELEMETRY_METRICS_LOG_SECONDS = float(os.getenv("TELEMETRY_METRICS_LOG_SECONDS", "300"))
+
+# Errors meaning that the database can not be reached. The records are spilled to the local file and replayed later.
+DB_UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+# Telemetry writers already created in this process, by spill path
+telemetry_writers = {}
+telemetry_writers_lock = threading.Lock()
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Background writer of the answers and feedbacks records.
+# The records are queued in memory and flushed by a worker thread in batches (multi-row inserts in a single transaction),
+# when batch_size records are queued or flush_seconds have passed since the first one.
+# When the database is unreachable, the batches are appended to a local spill file, and no connection is attempted for
+# retry_seconds. The spill file is replayed, in order, before writing any new batch once the database is back. It is moved
+# aside to be replayed, so the records spilled meanwhile (with the queue full) go to a new spill file without waiting for it.
+# The answers and feedbacks carry their own ids, so the records replayed twice are only stored once.
+# The rollups of the dashboard are refreshed incrementally every rollup_refresh_seconds after new rows are written, and the
+# metrics of the writer (queue depth, flush latency, spilled records...) are logged every metrics_log_seconds.
+class TelemetryWriter:
+
+    def __init__(self, batch_size=TELEMETRY_BATCH_SIZE, flush_seconds=TELEMETRY_FLUSH_SECONDS, max_queue_size=TELEMETRY_MAX_QUEUE_SIZE,
+                 retry_seconds=TELEMETRY_RETRY_SECONDS, spill_path=TELEMETRY_SPILL_PATH, rollup_refresh_seconds=TELEMETRY_ROLLUP_REFRESH_SECONDS,
+                 metrics_log_seconds=TELEMETRY_METRICS_LOG_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.retry_seconds = retry_seconds
+        self.rollup_refresh_seconds = rollup_refresh_seconds
+        self.rollups_refreshed_at = 0.0
+        self.rollups_pending = False
+        self.metrics_log_seconds = metrics_log_seconds
+        self.metrics_logged_at = time.monotonic()
+        self.spill_path = spill_path
+        self.replay_path = f"{spill_path}.replay"
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.spill_lock = threading.Lock()
+        self.metrics_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.db_unavailable_until = 0.0
+
+        self.flushed_records = 0
+        self.spilled_records = 0
+        self.replayed_records = 0
+        self.rejected_records = 0
+        self.flushes = 0
+        self.total_flush_latency = 0.0
+        self.last_flush_latency = 0.0
+
+        spill_dir = os.path.dirname(spill_path)
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.thread = threading.Thread(target=self.run, name="telemetry_writer", daemon=True)
+        self.thread.start()
+
+        # The records still queued are written (or spilled) when the process exits
+        atexit.register(self.close)
+
+
+    def record_answer(self, conversation_id, answer_data, timestamp=None):
+        self.put({"type": "answer", "conversation_id": conversation_id, "answer_data": answer_data,
+                  "timestamp": (timestamp or datetime.now(tz)).isoformat()})
+
+
+    def record_feedback(self, conversation_id, feedback, timestamp=None, idempotency_key=None):
+        self.put({"type": "feedback", "conversation_id": conversation_id, "feedback": feedback,
+                  "timestamp": (timestamp or datetime.now(tz)).isoformat(), "idempotency_key": idempotency_key or str(uuid.uuid4())})
+
+
+    # Queues a record without blocking the caller. With the queue full, the record goes straight to the spill file.
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.spill([record])
+
+
+    # Worker loop. It collects records until the batch is full or the flush time is reached.
+    def run(self):
+        while not self.stop_event.is_set() or not self.queue.empty():
+            try:
+                batch = [self.queue.get(timeout=self.flush_seconds)]
+            except queue.Empty:
+                # Retrying the spill file even without new records, once the database may be back
+                if self.has_spilled_records() and time.monotonic() >= self.db_unavailable_until:
+                    self.flush([])
+                self.refresh_rollups()
+                self.log_metrics()
+                continue
+
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining_time))
+                except queue.Empty:
+                    break
+
+            self.flush(batch)
+            self.refresh_rollups()
+            self.log_metrics()
+
+
+    def flush(self, batch):
+        start_time = time.monotonic()
+
+        if start_time < self.db_unavailable_until:
+            self.spill(batch)
+            return
+
+        try:
+            # The spilled records are older, so they are written first
+            self.replay_spill()
+            if batch:
+                self.write(batch)
+                with self.metrics_lock:
+                    self.flushed_records += len(batch)
+        except DB_UNAVAILABLE_ERRORS as e:
+            print(f"Database unavailable, spilling the telemetry records: {e}")
+            self.db_unavailable_until = time.monotonic() + self.retry_seconds
+            self.spill(batch)
+            return
+
+        self.rollups_pending = True
+
+        flush_latency = time.monotonic() - start_time
+        with self.metrics_lock:
+            self.flushes += 1
+            self.total_flush_latency += flush_latency
+            self.last_flush_latency = flush_latency
+
+
+    # Refreshes the rollups if rows were written since the last refresh, at most every rollup_refresh_seconds
+    def refresh_rollups(self):
+        now = time.monotonic()
+        if not self.rollups_pending or now - self.rollups_refreshed_at < self.rollup_refresh_seconds or now < self.db_unavailable_until:
+            return
+
+        self.rollups_refreshed_at = now
+        try:
+            refresh_rollups()
+            self.rollups_pending = False
+        except psycopg2.Error as e:
+            print(f"Error refreshing the monitoring rollups: {e}")
+
+
+    # Logs the metrics of the writer every metrics_log_seconds (never with 0)
+    def log_metrics(self):
+        now = time.monotonic()
+        if not self.metrics_log_seconds or now - self.metrics_logged_at < self.metrics_log_seconds:
+            return
+
+        self.metrics_logged_at = now
+        metrics = self.metrics()
+        print(f"Telemetry writer: queue_depth={metrics['queue_depth']} flushes={metrics['flushes']} "
+              f"flushed={metrics['flushed_records']} spilled={metrics['spilled_records']} replayed={metrics['replayed_records']} "
+              f"rejected={metrics['rejected_records']} last_flush_latency={metrics['last_flush_latency'] * 1000:.1f}ms "
+              f"avg_flush_latency={metrics['avg_flush_latency'] * 1000:.1f}ms db_available={metrics['db_available']}")
+
+
+    # Writes a batch in a single transaction. If the batch is rejected (e.g. a record with invalid data),
+    # the records are written one by one, so only the invalid ones are lost.
+    def write(self, batch):
+        try:
+            save_batch(*self.split_records(batch))
+        except DB_UNAVAILABLE_ERRORS:
+            raise
+        except psycopg2.Error as e:
+            print(f"Telemetry batch rejected, writing the records one by one: {e}")
+            for record in batch:
+                try:
+                    save_batch(*self.split_records([record]))
+                except DB_UNAVAILABLE_ERRORS:
+                    raise
+                except psycopg2.Error as e:
+                    print(f"Telemetry record rejected: {e}")
+                    with self.metrics_lock:
+                        self.rejected_records += 1
+
+
+    @staticmethod
+    def split_records(records):
+        answers = [(record["conversation_id"], record["answer_data"], record["timestamp"]) for record in records if record["type"] == "answer"]
+        # The feedbacks spilled before they had an idempotency key are stored without it
+        feedbacks = [(record["conversation_id"], record["feedback"], record["timestamp"], record.get("idempotency_key"))
+                     for record in records if record["type"] == "feedback"]
+        return answers, feedbacks
+
+
+    # Appends records to the spill file, one JSON per line
+    def spill(self, records):
+        if not records:
+            return
+        with self.spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                for record in records:
+                    spill_file.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+        with self.metrics_lock:
+            self.spilled_records += len(records)
+
+
+    def has_spilled_records(self):
+        return os.path.exists(self.replay_path) or os.path.exists(self.spill_path)
+
+
+    # Writes the spilled records in batches, the oldest first. The spill file is moved to the replay file under the lock, and the
+    # replay file (only used by the worker thread) is written without holding it, so put() is never blocked by the database.
+    # If the database fails again, the records not written yet are kept in the replay file, and are replayed first next time.
+    def replay_spill(self):
+        replayed = 0
+        try:
+            while True:
+                with self.spill_lock:
+                    if not os.path.exists(self.replay_path):
+                        if not os.path.exists(self.spill_path):
+                            break
+                        os.replace(self.spill_path, self.replay_path)
+
+                with open(self.replay_path, "r", encoding="utf-8") as replay_file:
+                    records = [json.loads(line) for line in replay_file if line.strip()]
+
+                written = 0
+                try:
+                    for start in range(0, len(records), self.batch_size):
+                        self.write(records[start:start + self.batch_size])
+                        written = min(start + self.batch_size, len(records))
+                finally:
+                    replayed += written
+                    with self.metrics_lock:
+                        self.replayed_records += written
+                    if written == len(records):
+                        os.remove(self.replay_path)
+                    elif written:
+                        with open(self.replay_path, "w", encoding="utf-8") as replay_file:
+                            for record in records[written:]:
+                                replay_file.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+        finally:
+            if replayed:
+                print(f"Replayed {replayed} spilled telemetry records")
+
+
+    # Stops the worker after writing the queued records
+    def close(self, timeout=10):
+        self.stop_event.set()
+        self.thread.join(timeout=timeout)
+
+
+    def metrics(self):
+        with self.metrics_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "flushes": self.flushes,
+                "flushed_records": self.flushed_records,
+                "spilled_records": self.spilled_records,
+                "replayed_records": self.replayed_records,
+                "rejected_records": self.rejected_records,
+                "last_flush_latency": self.last_flush_latency,
+                "avg_flush_latency": self.total_flush_latency / self.flushes if self.flushes else 0.0,
+                "db_available": time.monotonic() >= self.db_unavailable_until,
+            }
+
+
+
+# Function for getting the telemetry writer of a spill file. The writer (and its worker thread) is created once per process.
+def get_telemetry_writer(spill_path=TELEMETRY_SPILL_PATH):
+
+    with telemetry_writers_lock:
+        if spill_path not in telemetry_writers:
+            telemetry_writers[spill_path] = TelemetryWriter(spill_path=spill_path)
+
+    return telemetry_writers[spill_path]
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
@@ -0,0 +1,114 @@
+import hashlib
+from collections import OrderedDict
+
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Token counter wrapping a tiktoken encoding, usable wherever the chunker expects an encoding (see ingestion.count_tokens).
+# Modes:
+#   - "exact": every text is encoded, as with the raw encoding.
+#   - "cached": exact counts memoized by text hash (bounded LRU), so repeated texts are only encoded once.
+#   - "estimate": counts estimated from the number of characters. The exact encoder is only used near the max_chunk_size
+#     boundary (see is_near_boundary), where the estimate could change the chunking decision.
+class TokenCounter:
+
+    def __init__(self, encoding, mode="cached", max_entries=100_000, boundary_margin=0.15, chars_per_token=4.0):
+        if mode not in ("exact", "cached", "estimate"):
+            raise ValueError(f"Unknown token counting mode: {mode}")
+
+        self.encoding = encoding
+        self.mode = mode
+        self.max_entries = max_entries
+        self.boundary_margin = boundary_margin
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # The chars/token ratio is calibrated with every exact count
+        self.counted_chars = chars_per_token * 1000
+        self.counted_tokens = 1000
+
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+    def store(self, key, tokens):
+        self.cache[key] = tokens
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+
+    def calibrate(self, text, tokens):
+        self.counted_chars += len(text)
+        self.counted_tokens += tokens
+
+
+    # Exact count, memoized except in "exact" mode
+    def count_exact(self, text):
+        if self.mode == "exact":
+            return len(self.encoding.encode(text))
+
+        key = self.text_hash(text)
+        tokens = self.cache.get(key)
+        if tokens is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return tokens
+
+        self.misses += 1
+        tokens = len(self.encoding.encode(text))
+        self.store(key, tokens)
+        self.calibrate(text, tokens)
+        return tokens
+
+
+    def estimate(self, text):
+        return int(len(text) * self.counted_tokens / self.counted_chars) + 1
+
+
+    def count(self, text):
+        if self.mode == "estimate":
+            return self.estimate(text)
+        return self.count_exact(text)
+
+
+    # Whether an estimated count is close enough to the limit for needing the exact count
+    def is_near_boundary(self, tokens, max_tokens):
+        return self.mode == "estimate" and abs(tokens - max_tokens) <= max_tokens * self.boundary_margin
+
+
+    # Batch encoding of the texts not cached yet. tiktoken encodes the batch with several threads.
+    def prefetch(self, texts):
+        if self.mode == "exact":
+            return
+
+        missing = {}
+        for text in texts:
+            key = self.text_hash(text)
+            if key not in self.cache:
+                missing[key] = text
+
+        if not missing:
+            return
+
+        for (key, text), tokens in zip(missing.items(), self.encoding.encode_batch(list(missing.values()))):
+            self.store(key, len(tokens))
+            self.calibrate(text, len(tokens))
+
+
+    def stats(self):
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses, "entries": len(self.cache)}
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
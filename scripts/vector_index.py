@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from datetime import datetime
+
+import numpy as np
+
+import pandas as pd
+
+from dotenv import load_dotenv
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+
+from embeddings import EMBEDDINGS_MODEL_NAME, encode_texts, get_embedding_service
+
+# hnswlib is optional, the exact search is used without it
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+
+
+# Default configuration of the local vector index, overridable from the environment.
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "../data/vector_index/")
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float32")
+VECTOR_INDEX_BLOCK_SIZE = int(os.getenv("VECTOR_INDEX_BLOCK_SIZE", "65536"))
+VECTOR_INDEX_HNSW_EF = int(os.getenv("VECTOR_INDEX_HNSW_EF", "64"))
+VECTOR_INDEX_RESCORE_OVERSAMPLE = int(os.getenv("VECTOR_INDEX_RESCORE_OVERSAMPLE", "4"))
+
+VECTOR_INDEX_DTYPES = ("float32", "int8", "binary")
+
+# Number of bits set in each byte, for the hamming distance of the binary embeddings
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint16)
+
+# Local vector indexes already loaded in this process, by directory
+vector_indexes = {}
+vector_indexes_lock = threading.Lock()
+
+
+
+#############################################################################################
+######################################### Functions #########################################
+#############################################################################################
+
+
+
+# Function for quantizing the rows of a matrix to int8, with a scale per row (symmetric quantization)
+def quantize_int8(matrix):
+
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+
+    return quantized, scales.astype(np.float32)
+
+
+
+# Function for quantizing the rows of a matrix to 1 bit per dimension (the sign), packed in bytes
+def quantize_binary(matrix):
+    return np.packbits(matrix > 0, axis=1)
+
+
+
+# Function for normalizing the rows of a matrix, so the cosine similarity is a dot product
+def normalize_rows(matrix):
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return matrix / norms
+
+
+
+# Function for building the local vector index of a list of chunks with their 'content_embeddings'.
+# The files are written to a temporary directory and swapped at the end, so the index being served is never half written:
+#   embeddings.npy          normalized embeddings (float32, int8 with scales.npy, or binary packed in bytes)
+#   rescore_embeddings.npy  float32 embeddings of a quantized index, only read for rescoring the candidates (rescore=True)
+#   chunks.jsonl            chunks without the embeddings, in the same order as the rows
+#   hnsw.bin                optional HNSW graph (hnswlib), for corpora too large for the exact search
+def build_vector_index(chunks, index_dir, dtype=VECTOR_INDEX_DTYPE, rescore=False, hnsw=False, hnsw_m=16, hnsw_ef_construction=200):
+
+    if dtype not in VECTOR_INDEX_DTYPES:
+        raise ValueError(f"Unknown vector index dtype: {dtype}")
+    if hnsw and hnswlib is None:
+        raise ImportError("hnswlib is needed for building the HNSW index (pip install hnswlib)")
+
+    chunks = list(chunks)
+    if not chunks:
+        raise ValueError("No chunks for building the vector index")
+
+    embeddings = normalize_rows(np.asarray([chunk["content_embeddings"] for chunk in chunks], dtype=np.float32))
+
+    tmp_dir = index_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    if dtype == "int8":
+        quantized, scales = quantize_int8(embeddings)
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), quantized)
+        np.save(os.path.join(tmp_dir, "scales.npy"), scales)
+    elif dtype == "binary":
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), quantize_binary(embeddings))
+    else:
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), embeddings)
+
+    rescore = rescore and dtype != "float32"
+    if rescore:
+        np.save(os.path.join(tmp_dir, "rescore_embeddings.npy"), embeddings)
+
+    with open(os.path.join(tmp_dir, "chunks.jsonl"), "w", encoding="utf-8") as chunks_file:
+        for chunk in chunks:
+            source = {key: value for key, value in chunk.items() if key != "content_embeddings"}
+            chunks_file.write(json.dumps(source, default=str, ensure_ascii=False) + "\n")
+
+    if hnsw:
+        hnsw_index = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+        hnsw_index.init_index(max_elements=len(embeddings), ef_construction=hnsw_ef_construction, M=hnsw_m)
+        hnsw_index.add_items(embeddings, np.arange(len(embeddings)))
+        hnsw_index.save_index(os.path.join(tmp_dir, "hnsw.bin"))
+
+    metadata = {"count": len(chunks), "dims": int(embeddings.shape[1]), "dtype": dtype, "rescore": rescore, "hnsw": hnsw,
+                "model_name": EMBEDDINGS_MODEL_NAME, "built_at": datetime.now().isoformat()}
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+    return metadata
+
+
+
+# In-process vector index of the chunks. The embeddings matrix is memory-mapped, so it is shared with the page cache
+# instead of being copied into every process. The search is an exact top-k of the cosine similarity, computed with
+# matrix-vector products by blocks of rows, or an approximate one with the HNSW graph when it was built.
+# With quantized embeddings, rescore_oversample times k candidates are taken from the quantized scores and reordered with
+# the float32 embeddings, when they were kept. Only the rows of the candidates are read from the float32 file.
+class LocalVectorIndex:
+
+    def __init__(self, index_dir, use_hnsw=True, hnsw_ef=VECTOR_INDEX_HNSW_EF, block_size=VECTOR_INDEX_BLOCK_SIZE,
+                 rescore_oversample=VECTOR_INDEX_RESCORE_OVERSAMPLE):
+        self.index_dir = index_dir
+        self.block_size = block_size
+        self.rescore_oversample = rescore_oversample
+
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.loaded_mtime = os.path.getmtime(os.path.join(index_dir, "meta.json"))
+
+        self.embeddings = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r")
+        self.scales = None
+        if self.metadata["dtype"] == "int8":
+            self.scales = np.load(os.path.join(index_dir, "scales.npy"))
+
+        self.rescore_embeddings = None
+        if self.metadata.get("rescore") and rescore_oversample > 0:
+            self.rescore_embeddings = np.load(os.path.join(index_dir, "rescore_embeddings.npy"), mmap_mode="r")
+
+        with open(os.path.join(index_dir, "chunks.jsonl"), "r", encoding="utf-8") as chunks_file:
+            self.chunks = [json.loads(line) for line in chunks_file if line.strip()]
+
+        self.hnsw_index = None
+        if use_hnsw and self.metadata.get("hnsw") and hnswlib is not None:
+            self.hnsw_index = hnswlib.Index(space="ip", dim=self.metadata["dims"])
+            self.hnsw_index.load_index(os.path.join(index_dir, "hnsw.bin"), max_elements=self.metadata["count"])
+            self.hnsw_index.set_ef(max(hnsw_ef, 1))
+
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+    # Whether the index was rebuilt on disk after being loaded
+    def is_stale(self):
+        try:
+            return os.path.getmtime(os.path.join(self.index_dir, "meta.json")) != self.loaded_mtime
+        except OSError:
+            return False
+
+
+    # Bytes of the embeddings scanned by every exact search (the float32 embeddings for rescoring are only read by rows)
+    def memory_bytes(self):
+        return self.embeddings.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+
+    # Cosine similarity of the query with every row, by blocks so the int8 rows are dequantized a block at a time.
+    # For the binary embeddings the similarity is estimated from the hamming distance with the binarized query, 1 - 2 * hamming / dims.
+    def exact_scores(self, query_vector):
+
+        if self.metadata["dtype"] == "binary":
+            query_bits = quantize_binary(query_vector[None, :])[0]
+
+        scores = np.empty(len(self.embeddings), dtype=np.float32)
+        for start in range(0, len(self.embeddings), self.block_size):
+            block = self.embeddings[start:start + self.block_size]
+            if self.metadata["dtype"] == "binary":
+                hamming = POPCOUNT_TABLE[np.bitwise_xor(block, query_bits)].sum(axis=1)
+                scores[start:start + len(block)] = 1 - 2 * hamming / self.metadata["dims"]
+            elif self.scales is None:
+                scores[start:start + len(block)] = block @ query_vector
+            else:
+                scores[start:start + len(block)] = (block.astype(np.float32) @ query_vector) * self.scales[start:start + len(block)]
+
+        return scores
+
+
+    # Returns the positions and cosine similarities of the top-k rows
+    def search_vector(self, query_vector, k=5):
+
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1.0)
+        k = min(k, len(self))
+
+        if self.hnsw_index is not None:
+            self.hnsw_index.set_ef(max(self.hnsw_index.ef, k))
+            labels, distances = self.hnsw_index.knn_query(query_vector, k=k)
+            return labels[0], 1 - distances[0]
+
+        candidates_count = min(k * self.rescore_oversample, len(self)) if self.rescore_embeddings is not None else k
+
+        scores = self.exact_scores(query_vector)
+        top_k = np.argpartition(-scores, candidates_count - 1)[:candidates_count]
+
+        if self.rescore_embeddings is not None:
+            # Sorted positions, so the rows are read from the memory-mapped file in order
+            top_k = np.sort(top_k)
+            scores = np.zeros(len(self), dtype=np.float32)
+            scores[top_k] = self.rescore_embeddings[top_k] @ query_vector
+            top_k = top_k[np.argsort(-scores[top_k])[:k]]
+        else:
+            top_k = top_k[np.argsort(-scores[top_k])]
+
+        return top_k, scores[top_k]
+
+
+    # Returns the top-k chunks as elasticsearch hits. The score is scaled as the elasticsearch cosine similarity, (1 + cosine) / 2.
+    def search(self, query_vector, k=5):
+
+        positions, similarities = self.search_vector(query_vector, k)
+
+        return [{"_id": self.chunks[position].get("chunk_id") or str(position), "_score": float((1 + similarity) / 2),
+                 "_source": self.chunks[position]} for position, similarity in zip(positions, similarities)]
+
+
+
+# Function for getting the directory of the local vector index of an elasticsearch index
+def get_vector_index_dir(index_name, vector_index_dir=VECTOR_INDEX_DIR):
+    return os.path.join(vector_index_dir, index_name)
+
+
+
+# Function for getting the local vector index of an elasticsearch index. The index is loaded once per process,
+# and loaded again if it was rebuilt on disk.
+def get_local_vector_index(index_name, vector_index_dir=VECTOR_INDEX_DIR):
+
+    index_dir = get_vector_index_dir(index_name, vector_index_dir)
+
+    with vector_indexes_lock:
+        vector_index = vector_indexes.get(index_dir)
+        if vector_index is None or vector_index.is_stale():
+            vector_index = vector_indexes[index_dir] = LocalVectorIndex(index_dir)
+
+    return vector_index
+
+
+
+# Function to make a KNN search on the local vector index, without calling elasticsearch.
+# Same parameters of knn_search, so it can be passed as the search_function of generate_answer (es_client is not used).
+def local_knn_search(user_query, es_client, index, embeddings_model, size=5, query_vector=None):
+
+    if query_vector is None:
+        query_vector = embeddings_model.encode(user_query)
+
+    return get_local_vector_index(index).search(query_vector, k=size)
+
+
+
+# Function to make an hybrid search fused with RRF, with the BM25 search on elasticsearch and the kNN search on the local vector index
+def local_hybrid_search_rrf(user_query, es_client, index, embeddings_model, size=5, rank_window_size=20, rank_constant=60):
+
+    # Imported here so the local index can be used without loading the RAG clients
+    from rag import text_search, rrf_fuse
+
+    knn_results = local_knn_search(user_query, es_client, index, embeddings_model, size=rank_window_size)
+    text_results = text_search(user_query=user_query, es_client=es_client, index=index, size=rank_window_size)
+
+    return rrf_fuse([text_results, knn_results], size=size, k=rank_constant)
+
+
+
+# Generator of the chunks indexed in elasticsearch, with their embeddings
+def iter_indexed_chunks(es_client, index_name):
+    for hit in scan(es_client, index=index_name, query={"query": {"match_all": {}}}):
+        yield hit["_source"]
+
+
+
+# Function for benchmarking the latency of the kNN search on elasticsearch vs. the local vector index.
+# The questions are encoded beforehand, so only the retrieval is measured. The overlap is the share of the
+# elasticsearch top-k chunks also returned by the local index.
+def benchmark_knn(questions, es_client, index_name, vector_index, embeddings_model, size=5):
+
+    # Imported here so the local index can be used without loading the RAG clients
+    from rag import knn_search
+
+    query_vectors = encode_texts(questions, embeddings_model)
+
+    latencies = {"elasticsearch": [], "local": []}
+    overlaps = []
+    for question, query_vector in zip(questions, query_vectors):
+        start_time = time.perf_counter()
+        es_hits = knn_search(question, es_client, index_name, embeddings_model, size=size, query_vector=query_vector.tolist())
+        latencies["elasticsearch"].append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        local_hits = vector_index.search(query_vector, k=size)
+        latencies["local"].append(time.perf_counter() - start_time)
+
+        es_chunk_ids = {hit["_source"]["chunk_id"] for hit in es_hits}
+        local_chunk_ids = {hit["_source"]["chunk_id"] for hit in local_hits}
+        overlaps.append(len(es_chunk_ids & local_chunk_ids) / len(es_chunk_ids) if es_chunk_ids else 1.0)
+
+    report = [{"backend": backend, "queries": len(values), "p50_ms": np.percentile(values, 50) * 1000,
+               "p99_ms": np.percentile(values, 99) * 1000, "mean_ms": np.mean(values) * 1000}
+              for backend, values in latencies.items()]
+
+    return pd.DataFrame(report), float(np.mean(overlaps))
+
+
+
+#############################################################################################
+###################################### End of Functions #####################################
+#############################################################################################
+
+
+
+
+# Build and benchmark of the local vector index.
+# Usage:
+#   python vector_index.py build [--dtype int8|binary] [--rescore] [--hnsw]
+#   python vector_index.py benchmark --ground-truth ../tests/wiki_Lionel_Messi-GroundTruth.csv --sample 500
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Local in-process vector index of the chunks")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--index", default="messixpert_cosine", help="Elasticsearch index with the chunks indexed by ingestion.py")
+    parser.add_argument("--vector-index-dir", default=VECTOR_INDEX_DIR)
+    parser.add_argument("--dtype", default=VECTOR_INDEX_DTYPE, choices=VECTOR_INDEX_DTYPES)
+    parser.add_argument("--rescore", action="store_true", help="Keep the float32 embeddings for rescoring the candidates of a quantized index")
+    parser.add_argument("--hnsw", action="store_true", help="Also build an HNSW graph (needs hnswlib)")
+    parser.add_argument("--exact", action="store_true", help="Benchmark the exact search even if the HNSW graph was built")
+    parser.add_argument("--ground-truth", default="../tests/wiki_Lionel_Messi-GroundTruth.csv")
+    parser.add_argument("--sample", type=int, default=500)
+    parser.add_argument("--size", type=int, default=5)
+    args = parser.parse_args()
+
+    es_client = Elasticsearch("http://localhost:9200")
+    index_dir = get_vector_index_dir(args.index, args.vector_index_dir)
+
+    if args.command == "build":
+        metadata = build_vector_index(iter_indexed_chunks(es_client, args.index), index_dir, dtype=args.dtype, rescore=args.rescore, hnsw=args.hnsw)
+        print(f"Local vector index built in {index_dir}: {metadata}")
+
+    else:
+        ground_truth_df = pd.read_csv(args.ground_truth, sep=";")
+        questions = ground_truth_df.question.sample(n=min(args.sample, len(ground_truth_df)), random_state=1).tolist()
+
+        vector_index = LocalVectorIndex(index_dir, use_hnsw=not args.exact)
+        report_df, overlap = benchmark_knn(questions, es_client, args.index, vector_index, get_embedding_service(), size=args.size)
+
+        print(report_df.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+        print(f"Top-{args.size} overlap with elasticsearch: {overlap:.4f}")
@@ -9,11 +9,17 @@ import os
 # Add scripts filepath for importing the rag functions
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
 
-from rag import generate_answer
-from db import save_answer, save_feedback
+from rag import generate_answer, generate_answer_stream
+from telemetry import get_telemetry_writer
+from embeddings import get_embedding_service
+from semantic_cache import SemanticAnswerCache
+from context_assembler import ContextAssembler
+from llm_backends import get_llm_backend
+from reranker import get_reranker
+from vector_index import local_hybrid_search_rrf
+from bm25 import bm25_hybrid_search_rrf
 from dotenv import load_dotenv
 
-from sentence_transformers import SentenceTransformer
 from elasticsearch import Elasticsearch
 
 # Loading the environment variables.
@@ -22,11 +28,84 @@ load_dotenv()
 # Global configuration of the page
 st.set_page_config(page_title="MessiXpert Assistant", page_icon="⚽")
 
+
+# Search function of the RAG, by retrieval backend. With "local" the kNN search runs on the local vector index (see vector_index.py),
+# and with "embedded" the BM25 search also runs in process (see bm25.py). By default both searches run on elasticsearch.
+SEARCH_FUNCTIONS = {"elasticsearch": None, "local": local_hybrid_search_rrf, "embedded": bm25_hybrid_search_rrf}
+retrieval_backend = os.getenv("RETRIEVAL_BACKEND", "elasticsearch")
+search_function = SEARCH_FUNCTIONS[retrieval_backend]
+
+
+# Loading the embeddings service once per process. The model is warmed up here, so the first question does not pay the cold start.
+@st.cache_resource
+def load_embeddings_model():
+    embeddings_service = get_embedding_service('all-MiniLM-L6-v2')
+    embeddings_service.model
+    return embeddings_service
+
+
+# Creating the Elasticsearch client once per process, reusing its connections between reruns.
+@st.cache_resource
+def load_es_client():
+    return Elasticsearch("http://localhost:9200")
+
+
+# Semantic cache of the answers, shared by all the sessions of the process.
+# With the embedded retrieval it is invalidated by the rebuilds of the local indexes, so it does not need elasticsearch.
+@st.cache_resource
+def load_semantic_cache():
+    return SemanticAnswerCache(local_index=retrieval_backend == "embedded")
+
+
+# Assembler of the prompts within the token budget, shared by all the sessions of the process.
+@st.cache_resource
+def load_context_assembler():
+    return ContextAssembler()
+
+
+# LLM backend of the answers (LLM_BACKEND: openai, ollama or fake), with its client shared by all the sessions of the process.
+@st.cache_resource
+def load_llm_backend():
+    return get_llm_backend()
+
+
+# Cross-encoder reranker of the retrieved chunks, enabled with RERANK_ENABLED. The model is warmed up here, as the embeddings one.
+@st.cache_resource
+def load_reranker():
+    if os.getenv("RERANK_ENABLED", "false").lower() != "true":
+        return None
+    reranker = get_reranker()
+    reranker.model
+    return reranker
+
+
+# Background writer of the answers and feedbacks, shared by all the sessions of the process.
+@st.cache_resource
+def load_telemetry_writer():
+    return get_telemetry_writer()
+
+
+
 # Initialize the embeddings model
-embeddings_model = SentenceTransformer('all-MiniLM-L6-v2')
+embeddings_model = load_embeddings_model()
+
+# Initialize the semantic cache of answers
+semantic_cache = load_semantic_cache()
+
+# Initialize the context assembler
+context_assembler = load_context_assembler()
+
+# Initialize the LLM backend
+llm_backend = load_llm_backend()
+
+# Initialize the reranker (None when disabled)
+reranker = load_reranker()
+
+# Initialize the telemetry writer
+telemetry_writer = load_telemetry_writer()
 
 # Initialize the Elasticsearch client
-es_client = Elasticsearch("http://localhost:9200")
+es_client = load_es_client()
 
 # ElasticSearch Index names
 es_index_name = "messixpert_cosine"
@@ -101,41 +180,33 @@ if 'api_key' not in st.session_state:
     st.session_state.api_key = ""
 
 
-# Function to insert feedback to the database
+# Function to insert feedback to the database. The record is queued and written in the background.
 def insert_feedback_to_db(conversation_id, feedback):
     try:
-        save_feedback(conversation_id, feedback, timestamp=None)
+        telemetry_writer.record_feedback(conversation_id, feedback, timestamp=None)
         return True
     except Exception as e:
         print(f"Error inserting feedback: {e}")
         return False
 
 
-# Function to insert an answer to the database
+# Function to insert an answer to the database. The record is queued and written in the background, off the response path.
 def insert_answer_to_db(answer_data, conversation_id):
     try:
-        save_answer(conversation_id, answer_data, timestamp=None)
+        telemetry_writer.record_answer(conversation_id, answer_data, timestamp=None)
         return True
     except Exception as e:
         print(f"Error inserting answer: {e}")
         return False
 
 
-# Function for asking the Knowledge database
-def ask_to_vectorDB(question, es_client, es_index_name):
-    start_time = time()
-    memory = st.session_state.memory
-    answer, costs, tokens = generate_answer(question, es_client, es_index_name, memory)
-    
-    memory.save_context({"user": question}, {"assistant": answer})
-    end_time = time()
-    total_time = end_time - start_time 
-
-    answer_data = {
+# Function for building the monitoring data of an answer
+def build_answer_data(question, answer, costs, tokens, total_time, time_to_first_token=None):
+    return {
         "question": question,
         "answer": answer,
-        "model_used": "gpt-4o-mini",
         "response_time": total_time,
+        "time_to_first_token": total_time if time_to_first_token is None else time_to_first_token,
         "relevance": "UNKNOWN",
         "relevance_explanation": "UNKNOWN",
         "prompt_tokens": tokens.get("input_tokens"),
@@ -145,15 +216,64 @@ def ask_to_vectorDB(question, es_client, es_index_name):
         "eval_completion_tokens": 0,
         "eval_total_tokens": 0,
         "openai_cost": costs.get("total_cost"),
+        "cached_prompt_tokens": tokens.get("cached_tokens", 0),
+        "cached_tokens_ratio": tokens.get("cached_tokens", 0) / tokens["input_tokens"] if tokens.get("input_tokens") else 0.0,
+        "prompt_cache_savings": costs.get("prompt_cache_savings", 0.0),
+        **embeddings_model.last_query_metrics(),
+        **semantic_cache.last_lookup_metrics(),
+        **context_assembler.last_assembly_metrics(),
+        **llm_backend.last_call_metrics(),
+        **(reranker.last_rerank_metrics() if reranker is not None else {}),
     }
 
+
+# Function for storing an answer in the database, linked to the index of its chat message for the feedback
+def store_answer(answer_data, message_index):
     answer_id = str(uuid.uuid4())
-    st.session_state.conversations_id[len(st.session_state.conversations_id)] = answer_id
+    st.session_state.conversations_id[message_index] = answer_id
     insert_answer_to_db(answer_data, answer_id)
 
+
+# Function for asking the Knowledge database
+def ask_to_vectorDB(question, es_client, es_index_name, message_index):
+    start_time = time()
+    memory = st.session_state.memory
+    answer, costs, tokens = generate_answer(question, es_client, es_index_name, memory, embeddings_model=embeddings_model,
+                                            search_function=search_function, semantic_cache=semantic_cache,
+                                            context_assembler=context_assembler, llm_backend=llm_backend,
+                                            reranker=reranker)
+    
+    memory.save_context({"user": question}, {"assistant": answer})
+    end_time = time()
+    total_time = end_time - start_time 
+
+    store_answer(build_answer_data(question, answer, costs, tokens, total_time), message_index)
+
     return answer
 
 
+# Function for asking the Knowledge database with a streamed answer.
+# It yields the answer deltas as they are generated, and stores the answer once the stream is completed.
+def ask_to_vectorDB_stream(question, es_client, es_index_name, message_index):
+    start_time = time()
+    memory = st.session_state.memory
+    streamed_answer = generate_answer_stream(question, es_client, es_index_name, memory, embeddings_model=embeddings_model,
+                                             search_function=search_function, semantic_cache=semantic_cache,
+                                             context_assembler=context_assembler, llm_backend=llm_backend,
+                                             reranker=reranker)
+
+    yield from streamed_answer
+
+    answer = streamed_answer.answer
+    memory.save_context({"user": question}, {"assistant": answer})
+    end_time = time()
+    total_time = end_time - start_time
+    time_to_first_token = (streamed_answer.first_token_time or end_time) - start_time
+
+    store_answer(build_answer_data(question, answer, streamed_answer.costs, streamed_answer.tokens, total_time, time_to_first_token),
+                 message_index)
+
+
 # Function to handle feedback
 def handle_feedback(index, feedback):
     st.session_state.likes[index] = feedback
@@ -163,9 +283,14 @@ def handle_feedback(index, feedback):
 
 
 # Display chat messages
+# The content can be a stream of deltas, which is rendered incrementally. The whole text of the message is returned.
 def display_chat_message(message, is_user=False, index=None):
     with st.chat_message("user" if is_user else "assistant"):
-        st.markdown(message["content"])
+        if isinstance(message["content"], str):
+            content = message["content"]
+            st.markdown(content)
+        else:
+            content = st.write_stream(message["content"])
         
         if not is_user and index is not None:
             col1, col2, col3 = st.columns([1, 1, 8])
@@ -180,6 +305,8 @@ def display_chat_message(message, is_user=False, index=None):
                 with col3:
                     st.write(f"Feedback: {'👍' if st.session_state.likes[index] == 'like' else '👎'}")
 
+    return content
+
 
 # Main app logic
 def main():
@@ -200,11 +327,12 @@ def main():
             st.session_state.chat_history.append({"role": "user", "content": prompt})
             display_chat_message({"role": "user", "content": prompt}, is_user=True)
 
-            with st.spinner("Thinking..."):
-                response = ask_to_vectorDB(prompt, es_client, es_index_name)
+            # The answer is rendered while it is generated
+            message_index = len(st.session_state.chat_history)
+            response_stream = ask_to_vectorDB_stream(prompt, es_client, es_index_name, message_index)
+            response = display_chat_message({"role": "assistant", "content": response_stream}, index=message_index)
             
             st.session_state.chat_history.append({"role": "assistant", "content": response})
-            display_chat_message({"role": "assistant", "content": response}, index=len(st.session_state.chat_history)-1)
 
         # Clean chat button
         if st.button("Clean chat"):